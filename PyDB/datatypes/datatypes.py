@@ -1,9 +1,10 @@
+import struct
 from itertools import islice
 
-from PyDB.utils import int_to_bytes, bytes_to_int
+from PyDB.utils import int_to_bytes, bytes_to_int, encode_varint, decode_varint
 
 from PyDB.exceptions import PyDBTypeError, PyDBValueError
-from PyDB.exceptions import PyDBTypeConstraintError
+from PyDB.exceptions import PyDBTypeConstraintError, PyDBInternalError
 
 class DefaultDummyType:
     pass
@@ -15,15 +16,28 @@ class TypeHeader(object):
     SIZE_SIZE = 4
 
     SIZE_TOTAL = SIZE_NULL + SIZE_SIZE
+    STRUCT = struct.Struct(">bi")
 
     def __init__(self, null, size):
         self.null = int(null)
         self.size = size
 
     def encode_header(self):
-        res = int_to_bytes(self.null, self.SIZE_NULL)
-        res += int_to_bytes(self.size, self.SIZE_SIZE)
-        return res
+        return self.STRUCT.pack(self.null, self.size)
+
+    def encode_into(self, buf):
+        buf += self.STRUCT.pack(self.null, self.size)
+
+    @classmethod
+    def decode_from(cls, buf, offset=0):
+        """
+        Decodes the header at `offset` in any bytes-like `buf`. Returns the
+        header and the offset right after it.
+        """
+        if offset + cls.SIZE_TOTAL > len(buf):
+            raise PyDBInternalError("Type header past the end of the buffer.")
+        null, size = cls.STRUCT.unpack_from(buf, offset)
+        return TypeHeader(null, size), offset + cls.SIZE_TOTAL
 
     @classmethod
     def decode_header(cls, barr):
@@ -73,7 +87,21 @@ class GenericType(object):
     def get_header(self, val):
         return TypeHeader(val is None, 0)
 
+    def get_max_size(self):
+        """
+        The most bytes encode() can return, None if there's no limit.
+        """
+        return None
+
     def encode(self, val):
+        buf = bytearray()
+        self.encode_into(buf, val)
+        return bytes(buf)
+
+    def encode_into(self, buf, val):
+        """
+        Appends the encoding of `val` to the bytearray `buf`.
+        """
         header = self.get_header(val)
         if header.null == 0:
             data = self.encode_value(val)
@@ -81,7 +109,8 @@ class GenericType(object):
         else:
             data = b''
             header.size = 0
-        return header.encode_header() + data
+        header.encode_into(buf)
+        buf += data
 
     def decode(self, gen):
         th = TypeHeader.decode_header(gen)
@@ -92,15 +121,91 @@ class GenericType(object):
         self.check_value(val)
         return val
 
+    def decode_from(self, buf, offset=0):
+        """
+        Decodes the value at `offset` in any bytes-like `buf`, without copying
+        it first. Returns the value and the offset right after it.
+        """
+        th, offset = TypeHeader.decode_from(buf, offset)
+        if th.null:
+            return None, offset
+        end = offset + th.size
+        if end > len(buf):
+            raise PyDBInternalError("Value past the end of the buffer.")
+        val = self.decode_value(buf[offset:end])
+        self.check_value(val)
+        return val, end
+
+    def skip_from(self, buf, offset=0):
+        """
+        Returns the offset right after the value at `offset`, without decoding
+        the value.
+        """
+        th, offset = TypeHeader.decode_from(buf, offset)
+        return offset + th.size
+
 
 class IntegerType(GenericType):
-    def __init__(self, size=4, **kwargs):
-        super().__init__(**kwargs)
+    """
+    With encoding="varint", values are stored without a TypeHeader, as the
+    LEB128 encoding of 0 for NULL or of 1 + the zigzag mapping of the value
+    (0, -1, 1, -2, ... become 0, 1, 2, 3, ...), so small values of either sign
+    take a single byte. `size` still bounds the values.
+    """
+    ENCODING_FIXED = "fixed"
+    ENCODING_VARINT = "varint"
+
+    def __init__(self, size=4, encoding=ENCODING_FIXED, **kwargs):
+        if encoding not in (self.ENCODING_FIXED, self.ENCODING_VARINT):
+            raise PyDBValueError("Unknown integer encoding: {}.".format(encoding))
         self.size = size
+        self.encoding = encoding
+        super().__init__(**kwargs)
 
     def get_type(self):
         return int
 
+    def get_max_size(self):
+        if self.encoding == self.ENCODING_FIXED:
+            return TypeHeader.SIZE_TOTAL + self.size
+        return (8 * self.size + 1 + 6) // 7
+
+    def encode_into(self, buf, val):
+        if self.encoding == self.ENCODING_FIXED:
+            super().encode_into(buf, val)
+        elif val is None:
+            buf.append(0)
+        else:
+            limit = 1 << (8 * self.size - 1)
+            if not -limit <= val < limit:
+                raise OverflowError("int too big to convert")
+            buf += encode_varint((val << 1 if val >= 0 else (-val << 1) - 1) + 1)
+
+    def decode_from(self, buf, offset=0):
+        if self.encoding == self.ENCODING_FIXED:
+            return super().decode_from(buf, offset)
+        res, offset = decode_varint(buf, offset)
+        if res == 0:
+            return None, offset
+        val = (res - 1) >> 1 if res & 1 else -(res >> 1)
+        self.check_value(val)
+        return val, offset
+
+    def skip_from(self, buf, offset=0):
+        if self.encoding == self.ENCODING_FIXED:
+            return super().skip_from(buf, offset)
+        return decode_varint(buf, offset)[1]
+
+    def decode(self, gen):
+        if self.encoding == self.ENCODING_FIXED:
+            return super().decode(gen)
+        buf = bytearray()
+        for byte in gen:
+            buf += byte
+            if byte[0] < 0x80:
+                break
+        return self.decode_from(buf)[0]
+
     def encode_value(self, val):
         return int_to_bytes(val, self.size)
 
@@ -113,6 +218,10 @@ class StringType(GenericType):
         super().__init__(**kwargs)
         self.max_length = size
 
+    def get_max_size(self):
+        # Only ASCII strings can be decoded, so a character is a byte.
+        return TypeHeader.SIZE_TOTAL + self.max_length
+
     def check_constraints(self, val):
         if len(val) >= self.max_length:
             raise PyDBTypeConstraintError("String size exceeds {}".format(
@@ -125,5 +234,5 @@ class StringType(GenericType):
         return str.encode(val)
 
     def decode_value(self, val):
-        return bytes.decode(val, 'ascii')
+        return str(val, 'ascii')
 
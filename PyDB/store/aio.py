@@ -0,0 +1,111 @@
+import asyncio
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyDB.exceptions import PyDBValueError, PyDBInternalError
+from PyDB.structure.aio import Batcher, coalesce
+
+
+class AsyncRecordStore(object):
+    """
+    Async access to a RecordStore. Records are read and written on a thread
+    pool of `max_workers` threads (or the given `executor`).
+
+    The get_record() calls made in the same loop iteration are served by one
+    executor job: records whose bytes touch or overlap are read with a single
+    read and decoded from it. add_record() calls are grouped the same way and
+    written with one RecordStore.add_records() call, in the order they were
+    made.
+
+    Needs Python 3.7 or later.
+    """
+    def __init__(self, store, executor=None, max_workers=4):
+        self.store = store
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.write_lock = threading.Lock()
+        self.reads = Batcher(self.executor, self.get_records)
+        self.writes = Batcher(self.executor, self.add_records)
+
+    async def get_record(self, pos):
+        return await self.reads.submit(pos)
+
+    async def add_record(self, obj):
+        """
+        Returns the position of the record.
+        """
+        return await self.writes.submit(obj)
+
+    async def scan(self, columns=None, where=None, batch_size=64):
+        """
+        Yields the records of RecordStore.scan(), reading `batch_size` of them
+        per executor job.
+        """
+        loop = asyncio.get_running_loop()
+        batches = self.store.scan(columns, where, batch_size=batch_size)
+        while True:
+            records = await loop.run_in_executor(self.executor, next, batches, None)
+            if records is None:
+                break
+            for record in records:
+                yield record
+
+    def get_records(self, positions):
+        store = self.store
+        if store.heap is not None:
+            error = PyDBValueError("Records in a heap are found by row id.")
+            return [error] * len(positions)
+
+        # Rows without a bound on their size are read READ_SIZE bytes at
+        # first. The few that go on past that are read again on their own.
+        codec = store.codec
+        size = codec.max_size or codec.READ_SIZE
+        ranges = [(x, size) for x in positions]
+
+        cursor = store.io.cursor()
+        results = [None] * len(positions)
+        for start, end, group in coalesce(ranges):
+            try:
+                buf = memoryview(cursor.read(end - start, pos=start))
+            except Exception as e:
+                for i in group:
+                    results[i] = e
+                continue
+            for i in group:
+                try:
+                    results[i] = self.decode_record(cursor, buf, start, positions[i])
+                except Exception as e:
+                    results[i] = e
+        return results
+
+    def decode_record(self, cursor, buf, start, pos):
+        store = self.store
+        try:
+            values, end = store.codec.decode_from(buf, pos - start)
+        except (PyDBInternalError, struct.error):
+            end = None
+        if end is None or end > len(buf):
+            values, _ = store.codec.read_from(cursor, pos)
+        store.cls._check_values(values)
+        return store.cls._from_values(values)
+
+    def add_records(self, objs):
+        with self.write_lock:
+            try:
+                results = self.store.add_records(objs, batch_size=len(objs))
+            except Exception:
+                # add_records() checks the whole batch before it writes any
+                # of it: find out which records failed one at a time.
+                results = []
+                for obj in objs:
+                    try:
+                        results.append(self.store.add_record(obj))
+                    except Exception as e:
+                        results.append(e)
+            self.store.io.flush()
+        return results
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown()
@@ -0,0 +1,282 @@
+import struct
+from bisect import bisect_left, bisect_right
+
+from PyDB.exceptions import PyDBUniqueKeyViolation, PyDBKeyNotFoundError
+from PyDB.exceptions import PyDBValueError, PyDBInternalError
+
+
+class Node(object):
+    """
+    A node of a BTreeIndex. In a leaf, `values` are the values of `keys` and
+    `next` is the page of the next leaf (-1 for the last one). In an inner
+    node, `values` are the pages of the children: keys[i] is the smallest key
+    under values[i + 1].
+    """
+    LEAF = 0
+    INNER = 1
+
+    def __init__(self, kind, keys, values, nxt=-1):
+        self.kind = kind
+        self.keys = keys
+        self.values = values
+        self.next = nxt
+
+    def is_leaf(self):
+        return self.kind == self.LEAF
+
+
+class BTreeIndex(object):
+    """
+    A B+tree from keys of `key_type` to integers (the locations of records),
+    with a node per block of `structure`. Nodes are found by page: the index
+    of their block in the chain. The root is always page 0, so it is the one
+    node that gets copied when it splits.
+
+    | KIND | COUNT | NEXT | KEY | VALUE | KEY | VALUE | ... |
+
+    Keys are stored as key_type encodes them. Values are 8 byte integers in
+    leaves and child pages in inner nodes, where NEXT holds the first child.
+    Nodes hold as many entries as fit in their block.
+
+    A lookup reads one page per level. Writes are serialized with the lock of
+    the structure. Keys are removed from their leaf only: nodes aren't merged.
+    """
+
+    NODE_HEADER = struct.Struct(">bii")
+    VALUE = struct.Struct(">q")
+    CHILD = struct.Struct(">i")
+
+    ROOT = 0
+
+    def __init__(self, fh, structure, key_type):
+        self.fh = fh
+        self.structure = structure
+        self.key_type = key_type
+        self.page_size = structure.blocks[0].size
+
+    @classmethod
+    def create(cls, fh, mbs, key_type, page_size=4096):
+        """
+        Creates the index in a new structure of the MultiBlockStructure `mbs`.
+        """
+        return cls(fh, mbs.add_structure(fh, page_size), key_type)
+
+    def read_node(self, page):
+        block = self.structure.blocks[page]
+        buf = block.read_data(self.fh, 0, block.size)
+        kind, count, nxt = self.NODE_HEADER.unpack_from(buf)
+        if kind < 0:
+            # Never written: the block still holds its fill.
+            return Node(Node.LEAF, [], [])
+
+        value = self.VALUE if kind == Node.LEAF else self.CHILD
+        decode_key = self.key_type.decode_from
+        keys = []
+        values = []
+        offset = self.NODE_HEADER.size
+        for _ in range(count):
+            key, offset = decode_key(buf, offset)
+            keys.append(key)
+            values.append(value.unpack_from(buf, offset)[0])
+            offset += value.size
+
+        if kind == Node.LEAF:
+            return Node(kind, keys, values, nxt)
+        return Node(kind, keys, [nxt] + values)
+
+    def encode_node(self, node):
+        if node.is_leaf():
+            value, values, nxt = self.VALUE, node.values, node.next
+        else:
+            value, values, nxt = self.CHILD, node.values[1:], node.values[0]
+        buf = bytearray(self.NODE_HEADER.pack(node.kind, len(node.keys), nxt))
+        for key, val in zip(node.keys, values):
+            self.key_type.encode_into(buf, key)
+            buf += value.pack(val)
+        return buf
+
+    def write_node(self, page, node, buf=None):
+        block = self.structure.blocks[page]
+        buf = self.encode_node(node) if buf is None else buf
+        if len(buf) > block.size:
+            raise PyDBInternalError("Node doesn't fit in its page.")
+        block.write_data(self.fh, 0, buf)
+
+    def add_page(self):
+        block = self.structure.add_block(self.fh, block_size=self.page_size)
+        return self.structure.index_of(block)
+
+    def find_leaf(self, key):
+        """
+        Returns the leaf where `key` is or would be, and the pages on the way
+        to it.
+        """
+        path = []
+        page = self.ROOT
+        node = self.read_node(page)
+        while not node.is_leaf():
+            path.append((page, node))
+            page = node.values[bisect_right(node.keys, key)]
+            node = self.read_node(page)
+        return page, node, path
+
+    def get(self, key):
+        _, node, _ = self.find_leaf(key)
+        index = bisect_left(node.keys, key)
+        if index == len(node.keys) or node.keys[index] != key:
+            raise PyDBKeyNotFoundError(key)
+        return node.values[index]
+
+    def __contains__(self, key):
+        _, node, _ = self.find_leaf(key)
+        index = bisect_left(node.keys, key)
+        return index < len(node.keys) and node.keys[index] == key
+
+    def range(self, start=None, stop=None):
+        """
+        Yields the (key, value) pairs with start <= key < stop, in key order.
+        """
+        if start is None:
+            node = self.read_node(self.ROOT)
+            while not node.is_leaf():
+                node = self.read_node(node.values[0])
+            index = 0
+        else:
+            _, node, _ = self.find_leaf(start)
+            index = bisect_left(node.keys, start)
+
+        while True:
+            for key, value in zip(node.keys[index:], node.values[index:]):
+                if stop is not None and key >= stop:
+                    return
+                yield key, value
+            if node.next == -1:
+                return
+            node = self.read_node(node.next)
+            index = 0
+
+    def insert(self, key, value):
+        with self.structure.lock:
+            page, node, path = self.find_leaf(key)
+            index = bisect_left(node.keys, key)
+            if index < len(node.keys) and node.keys[index] == key:
+                raise PyDBUniqueKeyViolation(key)
+            node.keys.insert(index, key)
+            node.values.insert(index, value)
+
+            # Split on the way up for as long as nodes overflow.
+            while True:
+                buf = self.encode_node(node)
+                if len(buf) <= self.structure.blocks[page].size:
+                    self.write_node(page, node, buf)
+                    return
+                separator, right = self.split(page, node)
+                if not path:
+                    break
+                page, node = path.pop()
+                index = bisect_right(node.keys, separator)
+                node.keys.insert(index, separator)
+                node.values.insert(index + 1, right)
+
+            # The root split: its left half moves out, so that it stays at page 0.
+            left = self.add_page()
+            self.write_node(left, node)
+            self.write_node(self.ROOT, Node(Node.INNER, [separator], [left, right]))
+
+    def split(self, page, node):
+        """
+        Moves the upper half of `node` to a new page and writes both halves,
+        except for the left half of the root, which insert() moves. Returns
+        the key that separates them and the page of the right half.
+        """
+        if len(node.keys) < 3:
+            raise PyDBValueError("Keys too long for pages of {} bytes.".format(
+                    self.page_size))
+        mid = len(node.keys) // 2
+        right = self.add_page()
+        if node.is_leaf():
+            separator = node.keys[mid]
+            right_node = Node(Node.LEAF, node.keys[mid:], node.values[mid:], node.next)
+            node.keys, node.values, node.next = node.keys[:mid], node.values[:mid], right
+        else:
+            separator = node.keys[mid]
+            right_node = Node(Node.INNER, node.keys[mid + 1:], node.values[mid + 1:])
+            node.keys, node.values = node.keys[:mid], node.values[:mid + 1]
+        self.write_node(right, right_node)
+        if page != self.ROOT:
+            self.write_node(page, node)
+        return separator, right
+
+    def remove(self, key):
+        with self.structure.lock:
+            page, node, _ = self.find_leaf(key)
+            index = bisect_left(node.keys, key)
+            if index == len(node.keys) or node.keys[index] != key:
+                raise PyDBKeyNotFoundError(key)
+            del node.keys[index]
+            del node.values[index]
+            self.write_node(page, node)
+
+    def bulk_load(self, items):
+        """
+        Builds the index from (key, value) pairs in increasing key order,
+        filling every node up to its page size. The index must be empty.
+        """
+        with self.structure.lock:
+            if len(self.structure.blocks) > 1 or self.read_node(self.ROOT).keys:
+                raise PyDBValueError("Can only bulk load an empty index.")
+
+            capacity = self.page_size - self.NODE_HEADER.size
+            level = []
+            page = None
+            node = Node(Node.LEAF, [], [])
+            size = 0
+            for key, value in items:
+                if node.keys and key <= node.keys[-1]:
+                    raise PyDBValueError("Keys aren't in increasing order.")
+                entry = len(self.key_type.encode(key)) + self.VALUE.size
+                if size + entry > capacity and node.keys:
+                    # The next leaf gets a page first, so that this one can
+                    # point to it.
+                    page = self.add_page() if page is None else page
+                    node.next = self.add_page()
+                    self.write_node(page, node)
+                    level.append((node.keys[0], page))
+                    page, node, size = node.next, Node(Node.LEAF, [], []), 0
+                node.keys.append(key)
+                node.values.append(value)
+                size += entry
+
+            if not level:
+                self.write_node(self.ROOT, node)
+                return
+            self.write_node(page, node)
+            level.append((node.keys[0], page))
+
+            while True:
+                nodes = self.inner_nodes(level, capacity)
+                if len(nodes) == 1:
+                    self.write_node(self.ROOT, nodes[0][1])
+                    return
+                level = []
+                for first, node in nodes:
+                    level.append((first, self.add_page()))
+                    self.write_node(level[-1][1], node)
+
+    def inner_nodes(self, children, capacity):
+        """
+        Returns the inner nodes over `children` ((smallest key, page) pairs),
+        each with its smallest key.
+        """
+        nodes = []
+        size = capacity
+        for key, page in children:
+            entry = len(self.key_type.encode(key)) + self.CHILD.size
+            if size + entry > capacity:
+                nodes.append((key, Node(Node.INNER, [], [page])))
+                size = 0
+            else:
+                nodes[-1][1].keys.append(key)
+                nodes[-1][1].values.append(page)
+                size += entry
+        return nodes
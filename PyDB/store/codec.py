@@ -0,0 +1,427 @@
+import struct
+from weakref import WeakKeyDictionary
+
+from PyDB.datatypes import IntegerType, StringType, TypeHeader
+from PyDB.exceptions import PyDBValueError, PyDBInternalError
+from PyDB.utils import int_to_bytes, bytes_to_int, encode_varint, decode_varint
+
+
+HEADER = TypeHeader.STRUCT
+NULL = HEADER.pack(1, 0)
+INT_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+LENGTH_FORMATS = [(1 << 8, 'B'), (1 << 16, 'H'), (1 << 32, 'I')]
+
+
+class Column(object):
+    """
+    Any column, through the encode_into()/decode_from() of its type.
+    """
+    def __init__(self, name, col_type):
+        self.name = name
+        self.names = [name]
+        self.col_type = col_type
+        self.max_size = col_type.get_max_size()
+
+    def encode(self, values, buf):
+        self.col_type.encode_into(buf, values.get(self.name))
+
+    def decode(self, buf, offset, values):
+        values[self.name], offset = self.col_type.decode_from(buf, offset)
+        return offset
+
+    def skip(self, buf, offset):
+        return self.col_type.skip_from(buf, offset)
+
+
+class StringColumn(Column):
+    def encode(self, values, buf):
+        val = values.get(self.name)
+        if val is None:
+            buf += NULL
+        else:
+            data = val.encode()
+            buf += HEADER.pack(0, len(data))
+            buf += data
+
+    def decode(self, buf, offset, values):
+        null, size = HEADER.unpack_from(buf, offset)
+        offset += HEADER.size
+        if null:
+            values[self.name] = None
+            return offset
+        values[self.name] = str(buf[offset:offset + size], 'ascii')
+        return offset + size
+
+    def skip(self, buf, offset):
+        return offset + HEADER.size + HEADER.unpack_from(buf, offset)[1]
+
+
+class IntegerRun(object):
+    """
+    Consecutive integer columns. As long as none of them is NULL, they are
+    packed and unpacked with one struct.
+    """
+    def __init__(self, columns):
+        self.names = [x for x, _ in columns]
+        self.sizes = tuple(x.size for _, x in columns)
+        self.zeros = (0,) * len(columns)
+        self.columns = [Column(x, y) for x, y in columns]
+        self.struct = struct.Struct(">" + "".join("bi" + INT_FORMATS[x.size]
+                for _, x in columns))
+        self.max_size = self.struct.size
+
+    def encode(self, values, buf):
+        vals = [values.get(x) for x in self.names]
+        if None not in vals:
+            try:
+                buf += self.struct.pack(*[x for column in
+                        zip(self.zeros, self.sizes, vals) for x in column])
+                return
+            except struct.error:
+                # Out of range: let the type raise the usual error.
+                pass
+        for column in self.columns:
+            column.encode(values, buf)
+
+    def decode(self, buf, offset, values):
+        end = offset + self.struct.size
+        if end <= len(buf):
+            vals = self.struct.unpack_from(buf, offset)
+            if vals[0::3] == self.zeros and vals[1::3] == self.sizes:
+                values.update(zip(self.names, vals[2::3]))
+                return end
+        for column in self.columns:
+            offset = column.decode(buf, offset, values)
+        return offset
+
+    def skip(self, buf, offset):
+        end = offset + self.struct.size
+        if end <= len(buf):
+            vals = self.struct.unpack_from(buf, offset)
+            if vals[0::3] == self.zeros and vals[1::3] == self.sizes:
+                return end
+        for column in self.columns:
+            offset = column.skip(buf, offset)
+        return offset
+
+
+class RecordCodec(object):
+    """
+    Encodes and decodes whole rows of a Record class, in the same format as
+    the encode() of each column type:
+
+    | NULL | SIZE | VALUE | NULL | SIZE | VALUE | ... |
+
+    The columns are compiled once per class (see for_class()): integer
+    columns next to each other share a precompiled struct, strings use a
+    precompiled header, and other types go through their own methods. A row
+    is built in one buffer and decoded from one, so it takes one write, and
+    one read of at most max_size bytes (None if a column type has no bound;
+    see read_from()).
+    """
+
+    codecs = WeakKeyDictionary()
+
+    READ_SIZE = 4096
+
+    def __init__(self, columns):
+        self.steps = []
+        run = []
+        for name, col_type in columns:
+            if (type(col_type) is IntegerType and col_type.size in INT_FORMATS and
+                    col_type.encoding == IntegerType.ENCODING_FIXED):
+                run.append((name, col_type))
+                continue
+            if run:
+                self.steps.append(IntegerRun(run))
+                run = []
+            if type(col_type) is StringType:
+                self.steps.append(StringColumn(name, col_type))
+            else:
+                self.steps.append(Column(name, col_type))
+        if run:
+            self.steps.append(IntegerRun(run))
+
+        sizes = [x.max_size for x in self.steps]
+        self.max_size = None if None in sizes else sum(sizes)
+
+    @classmethod
+    def for_class(cls, record_cls):
+        codec = cls.codecs.get(record_cls)
+        if codec is None:
+            codec = cls.codecs[record_cls] = cls(record_cls._get_columns())
+        return codec
+
+    def encode(self, values):
+        buf = bytearray()
+        for step in self.steps:
+            step.encode(values, buf)
+        return buf
+
+    def read_from(self, io, pos):
+        """
+        Reads the row at `pos` in `io`, and returns its values and where it
+        ends. A row with no bound on its size is read READ_SIZE bytes at
+        first, then twice as many more at a time while it goes on past the
+        end of what was read.
+        """
+        size = self.max_size or self.READ_SIZE
+        buf = io.read(size, pos=pos)
+        eof = len(buf) < size
+        while True:
+            try:
+                values, end = self.decode_from(memoryview(buf))
+            except (PyDBInternalError, struct.error):
+                end = None
+            if end is not None and end <= len(buf):
+                return values, pos + end
+            if eof or self.max_size is not None:
+                raise PyDBInternalError("Incomplete record at {}.".format(pos))
+            size *= 2
+            data = io.read(size)
+            eof = len(data) < size
+            buf = bytes(buf) + data
+
+    def decode_from(self, buf, offset=0, columns=None):
+        """
+        Returns the values of the row at `offset` in `buf`, and where it ends.
+        With `columns` (a set of names), only those are decoded and returned;
+        the others are skipped over.
+        """
+        values = {}
+        if columns is None:
+            for step in self.steps:
+                offset = step.decode(buf, offset, values)
+            return values, offset
+
+        for step in self.steps:
+            if columns.isdisjoint(step.names):
+                offset = step.skip(buf, offset)
+            else:
+                offset = step.decode(buf, offset, values)
+        if len(values) != len(columns):
+            values = {x: values[x] for x in columns}
+        return values, offset
+
+
+class FixedRowCodec(RecordCodec):
+    """
+    Rows that all take max_size bytes: a bitmap of the NULL columns (bit
+    i % 8 of byte i // 8 for column i), then each column in a slot of its own:
+
+     - integers: `size` bytes, big endian, whatever their encoding;
+     - strings: their length in 1, 2 or 4 bytes (depending on max_length),
+       then max_length bytes, zero padded.
+
+    NULL values are stored as zeros. Only IntegerType and StringType
+    columns have a fixed width.
+    """
+
+    codecs = WeakKeyDictionary()
+
+    KIND_INT = 0
+    KIND_ODD_INT = 1
+    KIND_STRING = 2
+
+    def __init__(self, columns):
+        self.bitmap_size = (len(columns) + 7) // 8
+        fmt = [">{}s".format(self.bitmap_size)]
+        self.columns = []
+        index = 1
+        for name, col_type in columns:
+            if isinstance(col_type, IntegerType) and col_type.size in INT_FORMATS:
+                kind, empty = self.KIND_INT, (0,)
+                fmt.append(INT_FORMATS[col_type.size])
+            elif isinstance(col_type, IntegerType):
+                kind, empty = self.KIND_ODD_INT, (b'',)
+                fmt.append("{}s".format(col_type.size))
+            elif isinstance(col_type, StringType):
+                kind, empty = self.KIND_STRING, (0, b'')
+                length = [y for x, y in LENGTH_FORMATS if col_type.max_length < x][0]
+                fmt.append("{}{}s".format(length, col_type.max_length))
+            else:
+                raise PyDBValueError("Column {} has no fixed width.".format(name))
+            self.columns.append((name, col_type, kind, empty, index))
+            index += len(empty)
+
+        self.struct = struct.Struct("".join(fmt))
+        self.max_size = self.struct.size
+
+    def encode(self, values):
+        bitmap = bytearray(self.bitmap_size)
+        args = [None]
+        for i, (name, col_type, kind, empty, _) in enumerate(self.columns):
+            val = values.get(name)
+            if val is None:
+                bitmap[i >> 3] |= 1 << (i & 7)
+                args.extend(empty)
+            elif kind == self.KIND_INT:
+                args.append(val)
+            elif kind == self.KIND_ODD_INT:
+                args.append(int_to_bytes(val, col_type.size))
+            else:
+                data = val.encode()
+                if len(data) > col_type.max_length:
+                    raise PyDBValueError("Value of {} doesn't fit in its slot.".format(name))
+                args.extend((len(data), data))
+        args[0] = bytes(bitmap)
+
+        try:
+            return self.struct.pack(*args)
+        except struct.error as e:
+            # Only integers can be out of range.
+            raise OverflowError(str(e))
+
+    def decode_from(self, buf, offset=0, columns=None):
+        if offset + self.max_size > len(buf):
+            raise PyDBInternalError("Row past the end of the buffer.")
+        vals = self.struct.unpack_from(buf, offset)
+        bitmap = vals[0]
+        res = {}
+        for i, (name, col_type, kind, _, index) in enumerate(self.columns):
+            if columns is not None and name not in columns:
+                continue
+            if bitmap[i >> 3] >> (i & 7) & 1:
+                res[name] = None
+            elif kind == self.KIND_INT:
+                res[name] = vals[index]
+            elif kind == self.KIND_ODD_INT:
+                res[name] = bytes_to_int(vals[index])
+            else:
+                res[name] = str(vals[index + 1][:vals[index]], 'ascii')
+        return res, offset + self.max_size
+
+
+class CompactValue(object):
+    """
+    A value of a CompactRowCodec row with its length in front, as a varint.
+    """
+    def __init__(self, name, col_type):
+        self.name = name
+        self.col_type = col_type
+        max_size = col_type.get_max_size()
+        if max_size is None:
+            self.max_size = None
+        else:
+            max_size -= TypeHeader.SIZE_TOTAL
+            self.max_size = len(encode_varint(max_size)) + max_size
+
+    def encode(self, buf, val):
+        data = self.col_type.encode_value(val)
+        buf += encode_varint(len(data))
+        buf += data
+
+    def decode(self, buf, offset):
+        size, offset = decode_varint(buf, offset)
+        if offset + size > len(buf):
+            raise PyDBInternalError("Value past the end of the buffer.")
+        return self.col_type.decode_value(buf[offset:offset + size]), offset + size
+
+    def skip(self, buf, offset):
+        size, offset = decode_varint(buf, offset)
+        return offset + size
+
+
+class CompactInteger(CompactValue):
+    """
+    A fixed-width integer, `size` bytes without a length.
+    """
+    def __init__(self, name, col_type):
+        self.name = name
+        self.col_type = col_type
+        self.size = col_type.size
+        self.max_size = col_type.size
+        fmt = INT_FORMATS.get(col_type.size)
+        self.struct = struct.Struct(">" + fmt) if fmt else None
+
+    def encode(self, buf, val):
+        if self.struct is not None and -1 << (8 * self.size - 1) <= val < 1 << (8 * self.size - 1):
+            buf += self.struct.pack(val)
+        else:
+            buf += int_to_bytes(val, self.size)
+
+    def decode(self, buf, offset):
+        end = offset + self.size
+        if end > len(buf):
+            raise PyDBInternalError("Value past the end of the buffer.")
+        if self.struct is not None:
+            return self.struct.unpack_from(buf, offset)[0], end
+        return bytes_to_int(buf[offset:end]), end
+
+    def skip(self, buf, offset):
+        return offset + self.size
+
+
+class CompactVarint(CompactValue):
+    """
+    A varint integer, in its own encoding.
+    """
+    def __init__(self, name, col_type):
+        self.name = name
+        self.col_type = col_type
+        self.max_size = col_type.get_max_size()
+
+    def encode(self, buf, val):
+        self.col_type.encode_into(buf, val)
+
+    def decode(self, buf, offset):
+        return self.col_type.decode_from(buf, offset)
+
+    def skip(self, buf, offset):
+        return self.col_type.skip_from(buf, offset)
+
+
+class CompactRowCodec(RecordCodec):
+    """
+    Rows with a bitmap of the NULL columns (as in FixedRowCodec) instead of
+    a TypeHeader per value:
+
+    | BITMAP | VALUE | VALUE | ... |
+
+    NULL values take no room at all. Fixed-width integers are stored in
+    `size` bytes and varint ones in their own encoding, both without a
+    length. Any other value has its length in front, as a varint.
+    """
+
+    codecs = WeakKeyDictionary()
+
+    def __init__(self, columns):
+        self.bitmap_size = (len(columns) + 7) // 8
+        self.columns = []
+        for name, col_type in columns:
+            if isinstance(col_type, IntegerType):
+                if col_type.encoding == IntegerType.ENCODING_VARINT:
+                    self.columns.append(CompactVarint(name, col_type))
+                else:
+                    self.columns.append(CompactInteger(name, col_type))
+            else:
+                self.columns.append(CompactValue(name, col_type))
+
+        sizes = [x.max_size for x in self.columns]
+        self.max_size = None if None in sizes else self.bitmap_size + sum(sizes)
+
+    def encode(self, values):
+        buf = bytearray(self.bitmap_size)
+        for i, column in enumerate(self.columns):
+            val = values.get(column.name)
+            if val is None:
+                buf[i >> 3] |= 1 << (i & 7)
+            else:
+                column.encode(buf, val)
+        return buf
+
+    def decode_from(self, buf, offset=0, columns=None):
+        bitmap = buf[offset:offset + self.bitmap_size]
+        if len(bitmap) != self.bitmap_size:
+            raise PyDBInternalError("Row past the end of the buffer.")
+        offset += self.bitmap_size
+        res = {}
+        for i, column in enumerate(self.columns):
+            if bitmap[i >> 3] >> (i & 7) & 1:
+                if columns is None or column.name in columns:
+                    res[column.name] = None
+            elif columns is None or column.name in columns:
+                res[column.name], offset = column.decode(buf, offset)
+            else:
+                offset = column.skip(buf, offset)
+        return res, offset
@@ -1,18 +1,71 @@
+import struct
+from functools import partial
+from itertools import islice
+from operator import eq
+
 from PyDB.datatypes import GenericType
-from PyDB.exceptions import PyDBInternalError, PyDBValueError
+from PyDB.exceptions import PyDBInternalError, PyDBValueError, PyDBIterationError
+from PyDB.exceptions import PyDBUniqueKeyViolation
+from PyDB.structure.heap import HeapFile, RowId
 from .tablemetadata import TableMetadata
+from .codec import RecordCodec, FixedRowCodec, CompactRowCodec
+from .btree import BTreeIndex
+
+class RecordMeta(type):
+    """
+    Compiles Record subclasses: their columns (the GenericType attributes)
+    are taken out of the class and become __slots__, so values live in the
+    instance and are read by the slot descriptors, with no instance dict.
+    The columns and the TableMetadata are worked out once, for the class.
+    """
+    def __new__(mcs, name, bases, namespace):
+        columns = {}
+        for base in reversed(bases):
+            columns.update(getattr(base, '_columns', ()))
+        inherited = set(columns)
+
+        for attr, value in list(namespace.items()):
+            if isinstance(value, GenericType):
+                columns[attr] = namespace.pop(attr)
+
+        slots = tuple(namespace.get('__slots__', ()))
+        namespace['__slots__'] = slots + tuple(sorted(set(columns) - inherited))
+        # In name order, as dir() would list them.
+        namespace['_columns'] = tuple(sorted(columns.items()))
+        namespace['_column_names'] = frozenset(columns)
+
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls._metadata = TableMetadata(cls)
+        return cls
+
+
+class Record(object, metaclass=RecordMeta):
+    __slots__ = ()
 
-class Record(object):
     def __init__(self, **kwargs):
-        self._values = {}
-        self._metadata = TableMetadata(self.__class__)
-        self._values = self._extract_column_values(**kwargs)
+        if not kwargs.keys() <= self._column_names:
+            extra_attrs = set(kwargs) - self._column_names
+            raise PyDBValueError("Unexpected attributes: {}.".format(extra_attrs))
+        for attr_name, _ in self._columns:
+            setattr(self, attr_name, kwargs.get(attr_name))
+
+    @classmethod
+    def _from_values(cls, values):
+        """
+        A record holding the decoded `values`, without going through __init__.
+        """
+        res = cls.__new__(cls)
+        res._values = values
+        return res
 
-    def __getattribute__(self, key):
-        self_values = object.__getattribute__(self, '_values')
-        if key in self_values:
-            return self_values[key]
-        return super().__getattribute__(key)
+    @property
+    def _values(self):
+        return {x: getattr(self, x) for x, _ in self._columns}
+
+    @_values.setter
+    def _values(self, values):
+        for attr_name, _ in self._columns:
+            setattr(self, attr_name, values.get(attr_name))
 
     def __eq__(self, other):
         if self.__class__ != other.__class__:
@@ -23,65 +76,313 @@ class Record(object):
         params = ", ".join("{}={}".format(x, repr(y)) for x, y in self._values.items())
         return "{}({})".format(self.__class__.__name__, params)
 
-    def _extract_column_values(self, **kwargs):
-        expected_attrs = set(self._metadata.column_names)
-        got_attrs = set(kwargs)
-
-        extra_attrs = got_attrs - expected_attrs
-        if extra_attrs:
-            raise PyDBValueError("Unexpected attributes: {}.".format(extra_attrs))
-
-        res = {}
-        for attr_name, attr_type in self._metadata.columns:
-            if attr_name in kwargs:
-                res[attr_name] = kwargs[attr_name]
-        return res
-
-    def _check_values(self, values):
-        for attr_name, attr_type in self._metadata.columns:
+    @classmethod
+    def _check_values(cls, values):
+        for attr_name, attr_type in cls._columns:
             attr_type.check_value(values.get(attr_name))
 
-    def _encode_obj(self, io, pos=-1):
+    def _encode_obj(self, io, pos=-1, codec=None):
         self._check_values(self._values)
 
         if pos >= 0:
             io.seek(pos)
 
-        for col_name, col_type in self._metadata.columns:
-            io.write(col_type.encode(self._values[col_name]))
+        codec = codec or RecordCodec.for_class(self.__class__)
+        io.write(codec.encode(self._values))
 
-    def _decode_obj(self, io, pos=-1):
-        if pos >= 0:
-            io.seek(pos)
+    def _decode_obj(self, io, pos=-1, codec=None):
+        if pos < 0:
+            pos = io.tell()
 
-        res = {}
-        for col_name, col_type in self._metadata.columns:
-            res[col_name] = col_type.decode(io.iterdata())
+        codec = codec or RecordCodec.for_class(self.__class__)
+        res, end = codec.read_from(io, pos)
+        io.seek(end)
 
         self._check_values(res)
         self._values = res
 
     @classmethod
     def _get_columns(cls):
-        cols = []
-        for x in dir(cls):
-            typ = getattr(cls, x)
-            if isinstance(typ, GenericType):
-                cols.append((x, typ))
-        return cols
+        return list(cls._columns)
 
 class RecordStore(object):
-    def __init__(self, io, cls):
+    """
+    Records of class `cls`, one after the other in `io`. Records are found by
+    their position in `io`, which add_record() returns.
+
+    With row_format=ROW_FORMAT_FIXED, every row takes row_width bytes (see
+    FixedRowCodec), so row n is at n * row_width and get_row()/get_rows()
+    find rows by number. ROW_FORMAT_COMPACT stores rows in as few bytes as
+    possible (see CompactRowCodec).
+
+    Row formats are the format versions of TableMetadata: a store written
+    before those existed is in ROW_FORMAT_VARIABLE.
+
+    With storage=STORAGE_HEAP, rows are kept in the slotted pages of a
+    HeapFile over the blocks of `io` instead. They are found by the RowId that
+    add_record() returns, with get(), and can be updated and deleted.
+
+    A `pk_index` (a BTreeIndex, see create_pk_index()) maps the primary key
+    of every record added to its location, for get_by_pk(). It is kept up to
+    date as records are added, updated and deleted.
+    """
+
+    STORAGE_STREAM = "stream"
+    STORAGE_HEAP = "heap"
+
+    ROW_FORMAT_VARIABLE = TableMetadata.FORMAT_VARIABLE
+    ROW_FORMAT_FIXED = TableMetadata.FORMAT_FIXED
+    ROW_FORMAT_COMPACT = TableMetadata.FORMAT_COMPACT
+
+    CODECS = {
+        ROW_FORMAT_VARIABLE: RecordCodec,
+        ROW_FORMAT_FIXED: FixedRowCodec,
+        ROW_FORMAT_COMPACT: CompactRowCodec,
+    }
+
+    def __init__(self, io, cls, row_format=ROW_FORMAT_VARIABLE, storage=STORAGE_STREAM,
+            pk_index=None):
+        if row_format not in self.CODECS:
+            raise PyDBValueError("Unknown row format: {}.".format(row_format))
+        if storage not in (self.STORAGE_STREAM, self.STORAGE_HEAP):
+            raise PyDBValueError("Unknown storage: {}.".format(storage))
         self.io = io
         self.cls = cls
+        self.row_format = row_format
+        self.codec = self.CODECS[row_format].for_class(cls)
+        self.row_width = self.codec.max_size \
+                if row_format == self.ROW_FORMAT_FIXED else None
+        if pk_index is not None and cls._metadata.primary_key is None:
+            raise PyDBValueError("{} has no primary key.".format(cls.__name__))
+        self.pk_index = pk_index
+        self.heap = None
+        if storage == self.STORAGE_HEAP:
+            self.heap = HeapFile(io.fh, io.block_structure)
+            self.row_width = None
+
+    @staticmethod
+    def create_pk_index(fh, mbs, cls, page_size=4096):
+        """
+        Creates an empty primary key index for `cls`, in a new structure of
+        the MultiBlockStructure `mbs`.
+        """
+        if cls._metadata.primary_key is None:
+            raise PyDBValueError("{} has no primary key.".format(cls.__name__))
+        key_type = dict(cls._columns)[cls._metadata.primary_key]
+        return BTreeIndex.create(fh, mbs, key_type, page_size=page_size)
+
+    @classmethod
+    def from_metadata(cls, io, record_cls, metadata):
+        return cls(io, record_cls, row_format=metadata.format_version)
 
     def get_record(self, pos):
+        if self.heap is not None:
+            raise PyDBValueError("Records in a heap are found by row id.")
+        return self.read_record(self.io.cursor(), pos=pos)
+
+    def read_record(self, io, pos=-1):
         res = self.cls()
-        res._decode_obj(self.io, pos=pos)
+        res._decode_obj(io, pos=pos, codec=self.codec)
         return res
 
+    def get(self, rowid):
+        values, _ = self.codec.decode_from(self.get_heap().get(rowid))
+        self.cls._check_values(values)
+        return self.cls._from_values(values)
+
+    def get_by_pk(self, key):
+        """
+        Returns the record with primary key `key`, found through the index in
+        O(log n) page reads.
+        """
+        if self.pk_index is None:
+            raise PyDBValueError("There is no primary key index.")
+        location = self.pk_index.get(key)
+        if self.heap is None:
+            return self.get_record(location)
+        return self.get(RowId(location >> 32, location & 0xFFFFFFFF))
+
+    def update(self, rowid, obj):
+        data = self.encode(obj)
+        if self.pk_index is None:
+            self.get_heap().update(rowid, data)
+            return
+
+        old_key = self.get_pk(self.get(rowid))
+        key = self.get_pk(obj)
+        if key != old_key and key in self.pk_index:
+            raise PyDBUniqueKeyViolation(key)
+        self.heap.update(rowid, data)
+        if key != old_key:
+            self.pk_index.remove(old_key)
+            self.pk_index.insert(key, self.get_location(rowid))
+
+    def delete(self, rowid):
+        if self.pk_index is not None:
+            self.pk_index.remove(self.get_pk(self.get(rowid)))
+        self.get_heap().delete(rowid)
+
+    def get_heap(self):
+        if self.heap is None:
+            raise PyDBValueError("Row ids are only used with heap storage.")
+        return self.heap
+
+    def get_pk(self, obj):
+        return getattr(obj, self.cls._metadata.primary_key)
+
+    def get_location(self, where):
+        """
+        The value kept in the index for a position, or a row id.
+        """
+        if self.heap is None:
+            return where
+        return where.page << 32 | where.slot
+
+    def encode(self, obj):
+        values = obj._values
+        obj._check_values(values)
+        return self.codec.encode(values)
+
     def add_record(self, obj):
-        self.io.seek(self.io.size())
-        obj._encode_obj(self.io)
+        return self.add_records([obj])[0]
+
+    def add_records(self, objs, batch_size=1024):
+        """
+        Appends the records of the iterable `objs`. Each batch of `batch_size`
+        records is checked and encoded into one buffer, which is written with
+        a single write. If a record is invalid, none of its batch is written.
+        Returns the positions of the records (their row ids in a heap).
+        """
+        objs = iter(objs)
+        res = []
+        pos = self.io.size() if self.heap is None else None
+        for batch in iter(lambda: list(islice(objs, batch_size)), []):
+            rows = [self.encode(x) for x in batch]
+            if self.pk_index is not None:
+                keys = [self.get_pk(x) for x in batch]
+                self.check_new_keys(keys)
+
+            if self.heap is not None:
+                locations = [self.heap.insert(x) for x in rows]
+            else:
+                locations = []
+                buf = bytearray()
+                for row in rows:
+                    locations.append(pos + len(buf))
+                    buf += row
+                self.io.seek(pos)
+                self.io.write(buf)
+                pos += len(buf)
+
+            if self.pk_index is not None:
+                for key, location in zip(keys, locations):
+                    self.pk_index.insert(key, self.get_location(location))
+            res.extend(locations)
+        return res
+
+    def check_new_keys(self, keys):
+        seen = set()
+        for key in keys:
+            if key in seen or key in self.pk_index:
+                raise PyDBUniqueKeyViolation(key)
+            seen.add(key)
+
+    def row_count(self):
+        if self.row_width is None:
+            raise PyDBValueError("Rows are only numbered in the fixed-width format.")
+        return self.io.size() // self.row_width
+
+    def get_row(self, n):
+        return self.get_rows(n, n + 1)[0]
+
+    def get_rows(self, start, stop):
+        """
+        Returns rows start to stop - 1, read with a single read.
+        """
+        if not 0 <= start < stop <= self.row_count():
+            raise PyDBIterationError("Invalid row numbers.")
+        width = self.row_width
+        buf = memoryview(self.io.cursor().read((stop - start) * width,
+                pos=start * width))
+        res = []
+        for offset in range(0, len(buf), width):
+            values, _ = self.codec.decode_from(buf, offset)
+            self.cls._check_values(values)
+            res.append(self.cls._from_values(values))
+        return res
+
+    def scan(self, columns=None, where=None, batch_size=None, chunk_size=64 * 1024):
+        """
+        Yields the records in the order they were added. The data is read
+        sequentially, `chunk_size` bytes at a time, so memory use doesn't grow
+        with the table.
+
+        Only `columns` (all of them by default) are decoded: the others are
+        skipped over and left as None. `where` maps column names to the value
+        they must have, or to a function of the value that returns whether the
+        row is wanted; rows are filtered before any record is built.
+
+        With `batch_size`, lists of up to that many records are yielded.
+        """
+        where = where or {}
+        unknown = (set(columns or ()) | set(where)) - self.cls._column_names
+        if unknown:
+            raise PyDBValueError("Unknown columns: {}.".format(unknown))
+
+        records = self.iter_records(columns, where, chunk_size)
+        if batch_size is None:
+            return records
+        return iter(lambda: list(islice(records, batch_size)), [])
+
+    def iter_records(self, columns, where, chunk_size):
+        conditions = [(x, y if callable(y) else partial(eq, y)) for x, y in where.items()]
+        if columns is None:
+            decoded = None
+            checks = self.cls._columns
+        else:
+            decoded = set(columns) | set(where)
+            checks = [(x, y) for x, y in self.cls._columns if x in columns]
+        projected = [x for x, _ in checks] if decoded and len(checks) < len(decoded) else None
+
+        if self.heap is not None:
+            rows = (self.codec.decode_from(x, 0, decoded)[0] for _, x in self.heap.rows())
+        else:
+            rows = self.iter_values(decoded, chunk_size)
+        for values in rows:
+            if not all(cond(values[name]) for name, cond in conditions):
+                continue
+            if projected is not None:
+                values = {x: values[x] for x in projected}
+            for name, col_type in checks:
+                col_type.check_value(values[name])
+            yield self.cls._from_values(values)
 
+    def iter_values(self, columns, chunk_size):
+        """
+        Yields the decoded values of each row, reading the data in chunks.
+        """
+        io = self.io.cursor(read_ahead=True)
+        io.seek(0)
+        min_size = self.codec.max_size or 1
+        read_size = max(chunk_size, min_size)
+        buf = b''
+        offset = 0
+        eof = False
+        while offset < len(buf) or not eof:
+            if eof or len(buf) - offset >= min_size:
+                try:
+                    values, end = self.codec.decode_from(buf, offset, columns)
+                except (PyDBInternalError, struct.error):
+                    # The row goes on past the end of the buffer.
+                    end = None
+                if end is not None and end <= len(buf):
+                    offset = end
+                    yield values
+                    continue
+                if eof:
+                    raise PyDBInternalError("Incomplete record at the end of the data.")
 
+            data = io.read(read_size)
+            eof = len(data) < read_size
+            buf = buf[offset:] + data
+            offset = 0
@@ -7,37 +7,62 @@ from PyDB.datatypes import GenericType
 from PyDB.utils import get_qualified_name
 from PyDB.utils import int_to_bytes, bytes_to_int, bytes_to_ints
 from PyDB.utils import string_to_bytes, bytes_to_string
-from PyDB.utils import SafeReader
+from PyDB.utils import SafeReader, BufferReader
 from PyDB.exceptions import PyDBMetadataError, PyDBConsistencyError
 from PyDB.exceptions import PyDBInternalError, PyDBValueError
 
 
 class TableMetadata(object):
-    MAGIC_VALUE = 2123427274
+    """
+    The layout of a table, as written at the start of its file:
+
+    | MAGIC | LENGTH | CLASS | COLUMNS | PRIMARY_KEY | UNIQUE_KEYS | ROW_COUNT | FORMAT |
+
+    LENGTH is the size of what follows it. Metadata written before there were
+    row formats has LEGACY_MAGIC, no LENGTH and no FORMAT: it ends at the row
+    count and reads as FORMAT_VARIABLE. It is encoded in that layout again,
+    so that it keeps its size and doesn't run into what follows it.
+    """
+    MAGIC_VALUE = 2123427275
     MAGIC_BYTES = int_to_bytes(MAGIC_VALUE, 4)
+    LEGACY_MAGIC_VALUE = 2123427274
+    LEGACY_MAGIC_BYTES = int_to_bytes(LEGACY_MAGIC_VALUE, 4)
 
     INT_BYTE_LEN = 4
     COLUMN_BYTE_LEN = 128
     CLASS_BYTE_LEN = 512
 
-    def __init__(self, cls):
+    # Row formats of the table.
+    FORMAT_VARIABLE = 0
+    FORMAT_FIXED = 1
+    FORMAT_COMPACT = 2
+
+    def __init__(self, cls, format_version=FORMAT_VARIABLE):
         self.class_name = get_qualified_name(cls)
         self.columns = cls._get_columns()
         self.column_names = [x[0] for x in self.columns]
         self.primary_key = ([x for x,y in self.columns if y.primary_key] + [None])[0]
         self.unique_keys = [x for x,y in self.columns if y.unique]
         self.row_count = 0
+        self.format_version = format_version
+        self.legacy = False
         self.check_valid()
 
     def check_valid(self):
         pass
 
     def decode_metadata(self, io):
+        # Only the bytes of the metadata are read: rows may follow them.
         reader = SafeReader(io)
-
         magic = reader.next_int(self.INT_BYTE_LEN)
 
-        if magic != self.MAGIC_VALUE:
+        if magic == self.MAGIC_VALUE:
+            length = reader.next_int(self.INT_BYTE_LEN)
+            data = io.read(length) if length >= 0 else b''
+            if len(data) != length:
+                raise PyDBInternalError("Invalid metatadata.")
+            reader = SafeReader(BufferReader(data))
+        elif magic != self.LEGACY_MAGIC_VALUE:
             raise PyDBInternalError("Invalid metatadata.")
 
         class_name = reader.next_string(self.CLASS_BYTE_LEN)
@@ -58,34 +83,49 @@ class TableMetadata(object):
 
         row_count = reader.next_int(self.INT_BYTE_LEN)
 
+        format_version = self.FORMAT_VARIABLE
+        if magic == self.MAGIC_VALUE:
+            format_version = reader.next_int(self.INT_BYTE_LEN)
+
         self.check_compatibility(class_name, col_names, row_count, primary_key, unique_keys)
 
         #Updating attributes that might have changed.
         self.row_count = row_count
+        self.format_version = format_version
+        self.legacy = magic == self.LEGACY_MAGIC_VALUE
 
     def encode_metadata(self, io, pos=0):
-        io.seek(pos)
-        io.write(self.MAGIC_BYTES)
+        if self.legacy and self.format_version != self.FORMAT_VARIABLE:
+            raise PyDBValueError("Legacy metadata has no row format.")
 
-        io.write(int_to_bytes(len(self.class_name)))
-        io.write(string_to_bytes(self.class_name))
+        buf = bytearray()
+        buf += int_to_bytes(len(self.class_name))
+        buf += string_to_bytes(self.class_name)
 
-        io.write(int_to_bytes(len(self.column_names)))
+        buf += int_to_bytes(len(self.column_names))
 
         for x in self.column_names:
-            io.write(int_to_bytes(len(x)))
-            io.write(string_to_bytes(x))
+            buf += int_to_bytes(len(x))
+            buf += string_to_bytes(x)
 
-        io.write(int_to_bytes(len(self.primary_key)))
-        io.write(string_to_bytes(self.primary_key))
+        buf += int_to_bytes(len(self.primary_key))
+        buf += string_to_bytes(self.primary_key)
 
-        io.write(int_to_bytes(len(self.unique_keys)))
+        buf += int_to_bytes(len(self.unique_keys))
 
         for x in self.unique_keys:
-            io.write(int_to_bytes(len(x)))
-            io.write(string_to_bytes(x))
+            buf += int_to_bytes(len(x))
+            buf += string_to_bytes(x)
+
+        buf += int_to_bytes(self.row_count)
+
+        io.seek(pos)
+        if self.legacy:
+            io.write(self.LEGACY_MAGIC_BYTES + buf)
+            return
 
-        io.write(int_to_bytes(self.row_count))
+        buf += int_to_bytes(self.format_version)
+        io.write(self.MAGIC_BYTES + int_to_bytes(len(buf)) + buf)
 
     def check_compatibility(self, class_name, col_names, row_count, primary_key, unique_keys):
         if class_name != self.class_name:
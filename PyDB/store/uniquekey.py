@@ -51,10 +51,12 @@ class SmallUniqueKeyStore(object):
         self.write_data(data)
 
     def get_data(self):
+        buf = memoryview(self.io.read(pos=0))
+        self.count = bytes_to_int(buf[:self.SIZE_HEADER])
+        offset = self.SIZE_HEADER
         data = []
-        self.read_header()
         for _ in range(self.count):
-            obj = self.data_type.decode(self.io.iterdata())
+            obj, offset = self.data_type.decode_from(buf, offset)
             data.append(obj)
         return data
 
@@ -62,7 +64,7 @@ class SmallUniqueKeyStore(object):
         self.io.seek(0)
 
         self.count = len(data)
-        self.write_header()
-        for obj in data:
-            self.io.write(self.data_type.encode(obj))
+        encoded = [int_to_bytes(self.count, self.SIZE_HEADER)]
+        encoded += [self.data_type.encode(obj) for obj in data]
+        self.io.write(b''.join(encoded), truncate=True)
 
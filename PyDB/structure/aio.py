@@ -0,0 +1,130 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Batcher(object):
+    """
+    Collects the calls to submit() made during one iteration of the event
+    loop and passes their arguments to `handler` as one list, in a single
+    executor job. The handler returns one result per argument, in order; an
+    exception instance in its place is raised to that caller only.
+    """
+    def __init__(self, executor, handler):
+        self.executor = executor
+        self.handler = handler
+        self.pending = []
+
+    def submit(self, arg):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.pending:
+            loop.call_soon(self.dispatch, loop)
+        self.pending.append((arg, future))
+        return future
+
+    def dispatch(self, loop):
+        batch, self.pending = self.pending, []
+        job = loop.run_in_executor(self.executor, self.handler, [x for x, _ in batch])
+        job.add_done_callback(lambda job: self.resolve(batch, job))
+
+    @staticmethod
+    def resolve(batch, job):
+        if job.cancelled():
+            results = [asyncio.CancelledError()] * len(batch)
+        elif job.exception() is not None:
+            results = [job.exception()] * len(batch)
+        else:
+            results = job.result()
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def coalesce(ranges):
+    """
+    Sorts the (pos, size) pairs in `ranges` and joins the ones that touch or
+    overlap. Yields the start and end of each joined range, with the indexes
+    in `ranges` of the pairs it covers.
+    """
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i])
+    index = 0
+    while index < len(order):
+        start, size = ranges[order[index]]
+        end = start + size
+        group = [order[index]]
+        index += 1
+        while index < len(order) and ranges[order[index]][0] <= end:
+            pos, size = ranges[order[index]]
+            end = max(end, pos + size)
+            group.append(order[index])
+            index += 1
+        yield start, end, group
+
+
+class AsyncBlockIO(object):
+    """
+    Async reads and writes on a BlockStructureOrderedDataIO, done on a thread
+    pool of `max_workers` threads (or the given `executor`) so that the event
+    loop never waits for the file.
+
+    Reads issued in the same loop iteration are sorted, and ranges that touch
+    or overlap are read at once. Writes issued together go to the file in
+    the order they were made, with back-to-back ones joined.
+    """
+    def __init__(self, io, executor=None, max_workers=4):
+        self.io = io
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.write_lock = threading.Lock()
+        self.reads = Batcher(self.executor, self.read_ranges)
+        self.writes = Batcher(self.executor, self.write_ranges)
+
+    async def read(self, size, pos):
+        return await self.reads.submit((pos, size))
+
+    async def write(self, data, pos):
+        await self.writes.submit((pos, bytes(data)))
+
+    def size(self):
+        return self.io.size()
+
+    def read_ranges(self, ranges):
+        cursor = self.io.cursor()
+        results = [None] * len(ranges)
+        for start, end, group in coalesce(ranges):
+            try:
+                data = cursor.read(end - start, pos=start)
+            except Exception as e:
+                data = e
+            for i in group:
+                if isinstance(data, Exception):
+                    results[i] = data
+                else:
+                    pos, size = ranges[i]
+                    results[i] = data[pos - start:pos - start + size]
+        return results
+
+    def write_ranges(self, writes):
+        joined = []
+        for pos, data in writes:
+            if joined and joined[-1][0] + len(joined[-1][1]) == pos:
+                joined[-1][1] += data
+            else:
+                joined.append([pos, bytearray(data)])
+
+        with self.write_lock:
+            for pos, data in joined:
+                self.io.seek(pos)
+                self.io.write(data)
+            self.io.flush()
+        return [None] * len(writes)
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown()
@@ -0,0 +1,273 @@
+import io
+import os
+import mmap
+import threading
+from weakref import WeakKeyDictionary
+
+from PyDB.exceptions import PyDBInternalError, PyDBValueError
+
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+
+
+file_locks = WeakKeyDictionary()
+file_locks_lock = threading.Lock()
+
+
+def is_positional(fh):
+    """
+    Unbuffered files are read and written with os.pread()/os.pwrite(), which
+    leave the file position alone, so they need no locking. Open files with
+    buffering=0 to read them from several threads at once. A buffered file
+    keeps data in its own buffers, which os.pread() would bypass, so it
+    is read with a seek and a read under file_lock() instead.
+    """
+    return isinstance(fh, io.FileIO) and hasattr(os, 'pread')
+
+
+def file_lock(fh):
+    """
+    Returns the lock that serializes seek-then-read/write sequences on a file
+    that has no positional access.
+    """
+    with file_locks_lock:
+        lock = file_locks.get(fh)
+        if lock is None:
+            lock = file_locks[fh] = threading.RLock()
+        return lock
+
+
+def read_at(fh, position, size):
+    if hasattr(fh, 'read_at'):
+        return fh.read_at(position, size)
+    if is_positional(fh):
+        return pread(fh.fileno(), position, size)
+    with file_lock(fh):
+        fh.seek(position)
+        return fh.read(size)
+
+
+def readinto_at(fh, position, buf):
+    data = read_at(fh, position, len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+def write_at(fh, position, data):
+    if hasattr(fh, 'write_at'):
+        fh.write_at(position, data)
+    elif is_positional(fh):
+        pwrite(fh.fileno(), position, data)
+    else:
+        with file_lock(fh):
+            fh.seek(position)
+            fh.write(data)
+
+
+def writev_at(fh, position, buffers):
+    """
+    Writes `buffers` one after the other, starting at `position`: in one
+    os.pwritev() call for unbuffered files, without joining them otherwise.
+    """
+    if hasattr(fh, 'writev_at'):
+        fh.writev_at(position, buffers)
+    elif hasattr(fh, 'write_at'):
+        fh.write_at(position, b''.join(buffers))
+    elif is_positional(fh) and hasattr(os, 'pwritev'):
+        pwritev(fh.fileno(), position, buffers)
+    else:
+        with file_lock(fh):
+            fh.seek(position)
+            for buf in buffers:
+                fh.write(buf)
+
+
+def will_need(fh, position, size):
+    """
+    Tells the OS that `size` bytes at `position` will be read soon, where the
+    file supports it.
+    """
+    if hasattr(fh, 'will_need'):
+        fh.will_need(position, size)
+    elif hasattr(os, 'posix_fadvise') and isinstance(fh, io.IOBase):
+        # A hint must never fail a read: in-memory files have no descriptor.
+        try:
+            fd = fh.fileno()
+        except (io.UnsupportedOperation, OSError):
+            return
+        os.posix_fadvise(fd, position, size, os.POSIX_FADV_WILLNEED)
+
+
+def file_size(fh):
+    if is_positional(fh):
+        return os.fstat(fh.fileno()).st_size
+    with file_lock(fh):
+        return fh.seek(0, os.SEEK_END)
+
+
+def pread(fd, position, size):
+    chunks = []
+    while size > 0:
+        data = os.pread(fd, size, position)
+        if not data:
+            break
+        chunks.append(data)
+        position += len(data)
+        size -= len(data)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+def pwrite(fd, position, data):
+    data = memoryview(data).cast('B')
+    while data:
+        written = os.pwrite(fd, data, position)
+        position += written
+        data = data[written:]
+
+
+def pwritev(fd, position, buffers):
+    buffers = [memoryview(x).cast('B') for x in buffers if len(x)]
+    while buffers:
+        written = os.pwritev(fd, buffers[:IOV_MAX], position)
+        position += written
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = buffers[0][written:]
+
+
+class MmapFile(object):
+    """
+    A file-like object over a shared memory map of `fh`, usable wherever the
+    block layer expects a file handle. Besides seek/read/write, it offers
+    positional access: read_at() returns memoryview slices of the map without
+    copying, and pack_into()/unpack_from() work on structs in place.
+
+    The map (and the file) grow `increment` bytes at a time, and the old map
+    is closed unless views from read_at() still use it. The logical size
+    of the file is tracked separately and the file is cut back to it on
+    close(). The views from read_at() must be released (or dropped) first:
+    close() raises while they are in use, and can be called again once they
+    are gone.
+    """
+
+    def __init__(self, fh, increment=16 * 1024 * 1024):
+        fh.flush()
+        self.fh = fh
+        self.increment = increment
+        self.length = os.fstat(fh.fileno()).st_size
+        self.pos = 0
+        self.map = None
+        self.old_maps = []
+        self.remap(self.length)
+
+    def remap(self, size):
+        size = max(self.increment, -(-size // self.increment) * self.increment)
+        if self.map is not None:
+            self.old_maps.append((self.map, self.view))
+            self.close_maps()
+        os.ftruncate(self.fh.fileno(), size)
+        self.map = mmap.mmap(self.fh.fileno(), size)
+        self.view = memoryview(self.map)
+
+    def ensure(self, end):
+        if end > len(self.map):
+            self.remap(end)
+        self.length = max(self.length, end)
+
+    def read_at(self, position, size):
+        end = min(position + size, self.length)
+        return self.view[position:max(position, end)]
+
+    def write_at(self, position, data):
+        self.ensure(position + len(data))
+        self.view[position:position + len(data)] = data
+
+    def writev_at(self, position, buffers):
+        self.ensure(position + sum(len(x) for x in buffers))
+        for buf in buffers:
+            self.view[position:position + len(buf)] = buf
+            position += len(buf)
+
+    def will_need(self, position, size):
+        if not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        start = position - position % mmap.PAGESIZE
+        end = min(position + size, len(self.map))
+        if start < end:
+            self.map.madvise(mmap.MADV_WILLNEED, start, end - start)
+
+    def pack_into(self, fmt, position, *values):
+        self.ensure(position + fmt.size)
+        fmt.pack_into(self.map, position, *values)
+
+    def unpack_from(self, fmt, position):
+        if position + fmt.size > self.length:
+            raise PyDBInternalError("Read past the end of the file at {}.".format(position))
+        return fmt.unpack_from(self.map, position)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length - self.pos
+        res = bytes(self.read_at(self.pos, size))
+        self.pos += len(res)
+        return res
+
+    def readinto(self, buf):
+        data = self.read_at(self.pos, len(buf))
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def write(self, data):
+        self.write_at(self.pos, data)
+        self.pos += len(data)
+        return len(data)
+
+    def flush(self):
+        """
+        Writes to the map are visible to the OS as soon as they're made, just
+        like a flushed file object. Use sync() to force them to disk.
+        """
+
+    def sync(self):
+        self.map.flush()
+
+    def close_maps(self):
+        """
+        Closes the maps in old_maps. Those that views handed out by read_at()
+        still point into can't be closed yet, and are kept there.
+        """
+        maps, self.old_maps = self.old_maps, []
+        for m, view in maps:
+            view.release()
+            try:
+                m.close()
+            except BufferError:
+                self.old_maps.append((m, view))
+
+    def close(self):
+        if self.map is not None:
+            # All the maps share the pages of the file: the newest covers it all.
+            self.map.flush()
+            self.old_maps.append((self.map, self.view))
+        self.map = None
+        self.close_maps()
+
+        # Reading a view of the map past the end of the file would kill the
+        # process with SIGBUS, so the file is only cut once nothing maps it.
+        if self.old_maps:
+            raise PyDBValueError("Views read from the map are still in use.")
+        os.ftruncate(self.fh.fileno(), self.length)
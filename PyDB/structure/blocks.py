@@ -1,85 +1,269 @@
-import os
-from itertools import takewhile, islice
+import struct
+import threading
+from copy import copy
+from bisect import bisect_right
+from itertools import takewhile
+from weakref import WeakKeyDictionary
 
 from PyDB.exceptions import PyDBOutOfSpaceError, PyDBIterationError
-from PyDB.exceptions import PyDBInternalError
-from PyDB.utils import int_to_bytes, bytes_to_int, byte_chunker
+from PyDB.exceptions import PyDBInternalError, PyDBConsistencyError
+from PyDB.utils import int_to_bytes, bytes_to_int, bytes_to_ints
 from PyDB.utils import bytes_to_gen
+from .bufferpool import BufferPool
+from .backends import read_at, write_at, writev_at, file_size
+from .growth import GeometricGrowth
+from .readahead import ReadAhead
+from .compression import CODEC_ZLIB, BlockCache, get_codec, compress, decompress
+
+
+structure_locks = WeakKeyDictionary()
+structure_locks_lock = threading.Lock()
+
+
+def end_of_file(fh):
+    pool = BufferPool.for_file(fh)
+    if pool is not None:
+        return pool.end_of_file()
+    return file_size(fh)
+
+
+def structure_lock(fh):
+    """
+    Returns the lock held while the structures in `fh` are changed. It is
+    shared by all of them, since they allocate from the same file. Files can
+    provide their own as fh.structure_lock (see WriteAheadLog).
+    """
+    if hasattr(fh, 'structure_lock'):
+        return fh.structure_lock
+    with structure_locks_lock:
+        lock = structure_locks.get(fh)
+        if lock is None:
+            lock = structure_locks[fh] = threading.RLock()
+        return lock
+
+
+def allocate(fh, allocator, block_size, header_size=None):
+    """
+    Returns the position and size of a new block of at least `block_size`
+    bytes, reusing free space from `allocator` if possible.
+    """
+    if allocator is not None:
+        res = allocator.allocate(fh, block_size, header_size)
+        if res is not None:
+            return res
+    return end_of_file(fh), block_size
+
+
+def read_pairs(io):
+    """
+    Reads | COUNT | A | B | A | B | ... | from the start of `io`.
+    """
+    io.seek(0)
+    count = bytes_to_int(io.read(4))
+    values = bytes_to_ints(io.read(count * 8))
+    return [(values[i], values[i + 1]) for i in range(0, len(values), 2)]
 
 
 class BlockStructureOrderedDataIO(object):
-    def __init__(self, fh, block_structure, blocksize=1024):
+    """
+    A file-like view of the data in a BlockStructure. The current position
+    (cur_block, block_offset) belongs to this object alone and all reads are
+    positional, so threads can read the same structure at once, each with its
+    own cursor().
+
+    With read_ahead, the blocks ahead of a sequential reader are prefetched
+    (see PyDB.structure.readahead).
+    """
+    def __init__(self, fh, block_structure, blocksize=1024, read_ahead=False):
         self.fh = fh
         self.block_structure = block_structure
         self.blocksize = blocksize
+        self.read_ahead = ReadAhead(fh, block_structure) if read_ahead else None
         self.cur_block, self.block_offset = self.find_offset(0)
 
+    def cursor(self, read_ahead=None):
+        """
+        Returns a new IO over the same file and structure, at position 0.
+        read_ahead defaults to that of this IO.
+        """
+        if read_ahead is None:
+            read_ahead = self.read_ahead is not None
+        return BlockStructureOrderedDataIO(self.fh, self.block_structure,
+                blocksize=self.blocksize, read_ahead=read_ahead)
+
+    def add_block(self, pending):
+        """
+        Grows the structure by self.blocksize, unless it has a growth policy.
+        """
+        block_size = self.blocksize if self.block_structure.growth is None else None
+        return self.block_structure.add_block(self.fh, block_size, pending=pending)
+
     def write(self, data, truncate=False):
-        while True:
-            can_fit = self.cur_block.size - self.block_offset
+        """
+        Writes any bytes-like object at the current position. The pieces that
+        land in consecutive blocks lying next to each other in the file are
+        written together, along with the headers in between, in one
+        vectored write.
+        """
+        data = memoryview(data).cast('B')
+        if self.block_structure.growth is not None:
+            self.block_structure.growth.record_write(len(data))
 
+        pieces = []
+        offset = 0
+        while offset < len(data):
+            can_fit = self.cur_block.size - self.block_offset
             if can_fit <= 0:
                 if self.cur_block.next == -1:
-                    self.cur_block = self.block_structure.add_block(self.fh, self.blocksize)
+                    self.cur_block = self.add_block(len(data) - offset)
                 else:
                     self.cur_block = self.block_structure.next_block(self.cur_block)
                 self.block_offset = 0
-                can_fit = self.cur_block.size - self.block_offset
-
-            cur_data = data[:can_fit]
-            data = data[can_fit:]
-            cur_size = len(cur_data)
-            if cur_data:
-                self.cur_block.write_data(self.fh, self.block_offset, cur_data)
-                self.block_offset += cur_size
-                if truncate or self.cur_block.next_empty < self.block_offset:
-                    self.cur_block.next_empty = self.block_offset
-                    self.cur_block.write_header(self.fh)
+                continue
+
+            cur_size = min(can_fit, len(data) - offset)
+            pieces.append((self.cur_block, self.block_offset,
+                    data[offset:offset + cur_size]))
+            offset += cur_size
+            self.block_offset += cur_size
+
+        self.write_pieces(pieces, truncate)
+        self.block_structure.data_written(self.fh, [x[0] for x in pieces])
+        if truncate:
+            self.block_structure.set_next_empty(self.fh, self.cur_block,
+                    self.block_offset)
+            self.block_structure.truncate_blocks(self.fh, after=self.cur_block)
+
+    def write_pieces(self, pieces, truncate):
+        structure = self.block_structure
+        vectored = BufferPool.for_file(self.fh) is None and structure.codec is None
+        runs = []
+        headers = []
+        for block, offset, data in pieces:
+            changed = truncate or block.next_empty < offset + len(data)
+            if changed:
+                structure.update_next_empty(block, offset + len(data))
+
+            if not vectored:
+                block.write_data(self.fh, offset, data)
+                if changed:
+                    structure.header_changed(self.fh, block)
+                continue
+
+            # A run is [start, end, buffers]. The header of a block is part of
+            # the run if the run reaches it anyway, or if it changed and the
+            # data starts right after it.
+            if offset == 0 and (changed or runs and runs[-1][1] == block.start):
+                if runs and runs[-1][1] == block.start:
+                    run = runs[-1]
+                    run[2].append(block.encode_header())
+                else:
+                    run = [block.start, block.start, [block.encode_header()]]
+                    runs.append(run)
+                structure.dirty_headers.pop(block.start, None)
+                structure.record_fill(self.fh, block, written=False)
+                headers.append(block)
             else:
-                if truncate:
-                    self.cur_block.next_empty = self.block_offset + cur_size
-                    self.cur_block.write_header(self.fh)
-                    self.block_structure.truncate_blocks(self.fh, after=self.cur_block)
-                break
+                start = block.start + block.get_header_size() + offset
+                run = [start, start, []]
+                runs.append(run)
+                if changed:
+                    structure.header_changed(self.fh, block)
+            run[2].append(data)
+            run[1] = block.start + block.get_header_size() + offset + len(data)
+
+        for start, _, buffers in runs:
+            writev_at(self.fh, start, buffers)
+        for block in headers:
+            structure.record_fill(self.fh, block)
 
     def read(self, size=-1, pos=-1):
-        if size == -1:
-            return b''.join(self.iterdata(pos=pos))
-        return b''.join(islice(self.iterdata(pos), 0, size))
+        if pos >= 0:
+            self.seek(pos)
+
+        chunks = []
+        while size != 0:
+            available = self.cur_block.next_empty - self.block_offset
+            if available <= 0:
+                if not self.advance_block():
+                    break
+                continue
+
+            cur_size = available if size < 0 else min(size, available)
+            chunks.append(self.cur_block.read_data(self.fh, self.block_offset, cur_size))
+            self.block_offset += cur_size
+            if size > 0:
+                size -= cur_size
+        return b''.join(chunks)
 
     def seek(self, pos):
         self.cur_block, self.block_offset = self.find_offset(pos)
-        self.fh.seek(self.cur_block.start + self.cur_block.get_header_size() +
-                self.block_offset)
+        if self.read_ahead is not None:
+            self.read_ahead.visit(self.cur_block)
 
-    def iterdata(self, pos=-1, chunk_size=1):
-        def iterbytes():
-            while True:
-                if self.block_offset < self.cur_block.next_empty:
-                    result = self.fh.read(1)
-                    self.block_offset += 1
-                    yield result
-                else:
-                    if self.cur_block.next == -1:
-                        break
+    def tell(self):
+        structure = self.block_structure
+        return structure.offsets[structure.index_of(self.cur_block)] + self.block_offset
 
-                    self.cur_block = Block.read_block(self.fh, self.cur_block.next)
-                    self.block_offset = 0
-                    start = self.cur_block.start + self.cur_block.get_header_size()
+    def iterdata(self, pos=-1, chunk_size=1):
+        """
+        Yields chunks of `chunk_size` bytes (the last one may be shorter). The
+        filled part of each block is read at once, and self.block_offset is
+        kept in sync with what has been yielded so far.
+        """
         if pos >= 0:
             self.seek(pos)
-        for b in byte_chunker(iterbytes(), chunk_size=chunk_size):
-            yield b
+
+        # Chunks that cross blocks are put together here: with some files,
+        # read_data() returns memoryviews, which can't be concatenated.
+        pending = bytearray()
+        while True:
+            available = self.cur_block.next_empty - self.block_offset
+            if available <= 0:
+                if not self.advance_block():
+                    break
+                continue
+
+            payload = self.cur_block.read_data(self.fh, self.block_offset, available)
+            start = 0
+            if pending:
+                start = min(chunk_size - len(pending), available)
+                pending += payload[:start]
+                self.block_offset += start
+                if len(pending) < chunk_size:
+                    continue
+                result, pending = bytes(pending), bytearray()
+                yield result
+
+            end = start + (available - start) // chunk_size * chunk_size
+            for offset in range(start, end, chunk_size):
+                self.block_offset += chunk_size
+                yield payload[offset:offset + chunk_size]
+
+            if end < available:
+                pending += payload[end:]
+                self.block_offset += available - end
+        if pending:
+            yield bytes(pending)
+
+    def flush(self):
+        self.block_structure.flush(self.fh)
+        self.fh.flush()
+
+    def advance_block(self):
+        if self.cur_block.next == -1:
+            return False
+        self.cur_block = self.block_structure.next_block(self.cur_block)
+        self.block_offset = 0
+        if self.read_ahead is not None:
+            self.read_ahead.visit(self.cur_block)
+        return True
 
     def find_offset(self, offset):
-        for cur_block in self.block_structure.blocks:
-            if offset < cur_block.size:
-                return cur_block, offset
-            offset -= cur_block.size
-        raise PyDBIterationError("Invalid offset.")
+        return self.block_structure.find_block(offset)
 
     def size(self):
-        return sum(x.next_empty for x in self.block_structure.blocks)
+        return self.block_structure.data_size()
 
 class Block(object):
     """
@@ -95,6 +279,7 @@ class Block(object):
     SIZE_NEXT_EMPTY = 4
 
     SIZE_HEADER = SIZE_MAGIC + SIZE_SIZE + SIZE_NEXT + SIZE_PREV + SIZE_NEXT_EMPTY
+    HEADER_STRUCT = struct.Struct(">4siiii")
 
     def __init__(self, start, size, nxt, prev, next_empty=0):
         self.start = start
@@ -106,20 +291,50 @@ class Block(object):
     def get_header_size(self):
         return self.SIZE_HEADER
 
+    def get_total_size(self):
+        return self.get_header_size() + self.size
+
+    def encode_header(self):
+        return self.HEADER_STRUCT.pack(self.MAGIC_BYTES, self.size, self.next,
+                self.prev, self.next_empty)
+
     def write_header(self, fh):
-        fh.seek(self.start)
-        fh.write(self.MAGIC_BYTES)
-        fh.write(int_to_bytes(self.size, self.SIZE_SIZE))
-        fh.write(int_to_bytes(self.next, self.SIZE_NEXT))
-        fh.write(int_to_bytes(self.prev, self.SIZE_PREV))
-        fh.write(int_to_bytes(self.next_empty, self.SIZE_NEXT_EMPTY))
+        if BufferPool.for_file(fh) is None and hasattr(fh, 'pack_into'):
+            fh.pack_into(self.HEADER_STRUCT, self.start, self.MAGIC_BYTES,
+                    self.size, self.next, self.prev, self.next_empty)
+        else:
+            self.write_raw(fh, 0, self.encode_header())
+
+    def read_raw(self, fh, position, size):
+        """
+        Reads `size` bytes at `position`, counted from the start of the block,
+        through the buffer pool of `fh` if it has one.
+        """
+        pool = BufferPool.for_file(fh)
+        if pool is not None:
+            return pool.read(self.start, self.get_total_size(), position, size)
+        return read_at(fh, self.start + position, size)
+
+    def write_raw(self, fh, position, data):
+        pool = BufferPool.for_file(fh)
+        if pool is not None:
+            pool.write(self.start, self.get_total_size(), position, data)
+        else:
+            write_at(fh, self.start + position, data)
 
     def fill_data(self, fh, data):
         if self.size % len(data) != 0:
             raise PyDBInternalError("Can't fill data. Not aligned.")
-        fh.seek(self.start + self.get_header_size())
-        for _ in range(self.size // len(data)):
-            fh.write(data)
+        self.write_raw(fh, self.get_header_size(), data * (self.size // len(data)))
+
+    def read_data(self, fh, position, size):
+        """
+        Reads `size` bytes of data starting at `position`. Depending on the
+        file, the result may be a memoryview rather than bytes.
+        """
+        if position < 0 or position + size > self.size:
+            raise PyDBInternalError("Invalid position to read from.")
+        return self.read_raw(fh, self.get_header_size() + position, size)
 
     def write_data(self, fh, position, data):
         """
@@ -127,8 +342,16 @@ class Block(object):
         """
         if position < 0 or position + len(data) > self.size:
             raise PyDBInternalError("Invalid position to write in.")
-        fh.seek(self.start + self.get_header_size() + position)
-        fh.write(data)
+        self.write_raw(fh, self.get_header_size() + position, data)
+
+    def copy_to(self, fh, position):
+        """
+        Writes this block, header and data, at `position`.
+        """
+        data = self.read_data(fh, 0, self.size)
+        copy = Block(position, self.size, self.next, self.prev, self.next_empty)
+        copy.write_header(fh)
+        copy.write_data(fh, 0, data)
 
     def __repr__(self):
         return ("Block(start={s.start}, size={s.size}, nxt={s.next}, "
@@ -136,32 +359,267 @@ class Block(object):
 
     @classmethod
     def read_block(cls, fh, start):
-        fh.seek(start)
-        magic = fh.read(cls.SIZE_MAGIC)
-        if magic != cls.MAGIC_BYTES:
+        pool = BufferPool.for_file(fh)
+        header = pool.peek(start, cls.SIZE_HEADER) if pool is not None else None
+        if header is not None:
+            values = cls.HEADER_STRUCT.unpack(header)
+        elif hasattr(fh, 'unpack_from'):
+            values = fh.unpack_from(cls.HEADER_STRUCT, start)
+        else:
+            header = read_at(fh, start, cls.SIZE_HEADER)
+            if len(header) != cls.SIZE_HEADER:
+                raise PyDBInternalError("Not a block at start position: {}.".format(start))
+            values = cls.HEADER_STRUCT.unpack(header)
+
+        if values[0] != cls.MAGIC_BYTES:
+            if cls is Block and values[0] == CompressedBlock.MAGIC_BYTES:
+                return CompressedBlock.read_block(fh, start)
             raise PyDBInternalError("Not a block at start position: {}.".format(start))
+        return cls(start, *values[1:])
+
+class CompressedBlock(Block):
+    """
+    A block whose data is stored compressed (see PyDB.structure.compression):
+
+    | MAGIC | SIZE | NEXT | PREV | NEXT_EMPTY | CODEC | SPACE | STORED | PAYLOAD |
+
+    SIZE is how much data the block holds, as for any block. SPACE is the
+    room left for the payload on disk, and STORED the part of it in use.
+
+    The data is decompressed into self.buffer when first needed. Writes only
+    change the buffer, until BlockStructure.write_back() stores it again.
+    Until then, the header keeps the NEXT_EMPTY of the payload on disk
+    (self.written_empty), so that it never claims data that isn't there.
+    """
+
+    MAGIC_VALUE = -1208913506
+    MAGIC_BYTES = int_to_bytes(MAGIC_VALUE, 4)
+    HEADER_STRUCT = struct.Struct(">4siiiiiii")
+    SIZE_HEADER = HEADER_STRUCT.size
+
+    def __init__(self, start, size, nxt, prev, next_empty=0, codec=CODEC_ZLIB,
+            space=None, stored=0):
+        super().__init__(start, size, nxt, prev, next_empty=next_empty)
+        self.codec = codec
+        # One more byte than the data, so that it always fits uncompressed.
+        self.space = size + 1 if space is None else space
+        self.stored = stored
+        self.written_empty = next_empty
+        self.buffer = None
+        self.dirty = False
+        self.cache = None
+
+    def get_total_size(self):
+        return self.get_header_size() + self.space
+
+    def encode_header(self):
+        return self.HEADER_STRUCT.pack(self.MAGIC_BYTES, self.size, self.next,
+                self.prev, self.written_empty, self.codec, self.space, self.stored)
+
+    def write_header(self, fh):
+        self.write_raw(fh, 0, self.encode_header())
+
+    def load(self, fh):
+        buffer = self.buffer
+        if buffer is None:
+            buffer = bytearray(self.size)
+            if self.stored:
+                data = decompress(self.read_raw(fh, self.get_header_size(), self.stored))
+                buffer[:len(data)] = data
+            self.buffer = buffer
+        if self.cache is not None:
+            self.cache.touch(self)
+        return buffer
+
+    def fill_data(self, fh, data):
+        if self.size % len(data) != 0:
+            raise PyDBInternalError("Can't fill data. Not aligned.")
+        self.buffer = bytearray(data * (self.size // len(data)))
+        self.dirty = True
+        # Claims the whole space on disk, like writing the data would.
+        self.write_raw(fh, self.get_total_size() - 1, b'\x00')
+
+    def read_data(self, fh, position, size):
+        if position < 0 or position + size > self.size:
+            raise PyDBInternalError("Invalid position to read from.")
+        return bytes(self.load(fh)[position:position + size])
+
+    def write_data(self, fh, position, data):
+        if position < 0 or position + len(data) > self.size:
+            raise PyDBInternalError("Invalid position to write in.")
+        self.load(fh)[position:position + len(data)] = data
+        self.dirty = True
+
+    def compress(self, fh):
+        return compress(self.codec, self.load(fh)[:self.next_empty])
+
+    def write_payload(self, fh, payload):
+        """
+        Writes `payload`, made by compress(), and the header that goes with it.
+        """
+        self.stored = len(payload)
+        self.written_empty = self.next_empty
+        self.dirty = False
+        self.write_raw(fh, 0, self.encode_header() + payload)
+
+    def copy_to(self, fh, position):
+        # The payload is moved as it is, still compressed.
+        payload = self.read_raw(fh, self.get_header_size(), self.stored)
+        copy = CompressedBlock(position, self.size, self.next, self.prev,
+                self.written_empty, self.codec, self.space, self.stored)
+        copy.write_raw(fh, 0, copy.encode_header() + payload)
+
+    def __repr__(self):
+        return ("CompressedBlock(start={s.start}, size={s.size}, nxt={s.next}, "
+                "prev={s.prev}, next_empty={s.next_empty}, codec={s.codec}, "
+                "space={s.space}, stored={s.stored})").format(s=self)
+
+class MappedBlock(Block):
+    """
+    A block whose position and size come from an ExtentMap. The rest of its
+    header is read when first needed, and checked against the neighbours the
+    map implies. On a mismatch, `on_mismatch` rebuilds the chain and returns
+    its blocks, and the header of this block is taken from there.
+    """
+    def __init__(self, fh, start, size, nxt, prev, on_mismatch=None):
+        self.fh = fh
+        self.start = start
+        self.size = size
+        self.expected = (size, nxt, prev)
+        self.header = None
+        self.on_mismatch = on_mismatch
+
+    def load(self):
+        if self.header is None:
+            block = Block.read_block(self.fh, self.start)
+            if (block.size, block.next, block.prev) != self.expected:
+                blocks = self.on_mismatch() if self.on_mismatch is not None else []
+                block = next((x for x in blocks if x.start == self.start), None)
+                if block is None or block.size != self.size:
+                    raise PyDBConsistencyError("Extent map doesn't match block at {}."
+                            .format(self.start))
+            self.header = {'next': block.next, 'prev': block.prev,
+                    'next_empty': block.next_empty}
+        return self.header
+
+    def header_property(name):
+        def getter(self):
+            return self.load()[name]
+        def setter(self, value):
+            self.load()[name] = value
+        return property(getter, setter)
+
+    next = header_property('next')
+    prev = header_property('prev')
+    next_empty = header_property('next_empty')
+    del header_property
 
-        size = bytes_to_int(fh.read(cls.SIZE_SIZE))
-        nxt = bytes_to_int(fh.read(cls.SIZE_NEXT))
-        prev = bytes_to_int(fh.read(cls.SIZE_PREV))
-        next_empty = bytes_to_int(fh.read(cls.SIZE_NEXT_EMPTY))
-        return cls(start, size, nxt, prev, next_empty=next_empty)
 
 class BlockStructure(object):
-    def __init__(self, fh, position=0, block_size=1024, initialize=False, fill=None):
+    """
+    A doubly linked chain of blocks. Alongside self.blocks, it keeps the
+    logical offset at which each block starts (self.offsets), the position of
+    each block in the chain (keyed by block start) and the total number of
+    bytes filled, so that offset lookups are a bisect and size is O(1).
+
+    With defer_headers, changes to next_empty are only kept in memory until
+    flush_headers() is called, which writes each changed header once.
+
+    `growth` (see PyDB.structure.growth) picks the size of blocks added
+    without an explicit size.
+
+    With an `extent_map`, the structure is opened from the map instead of by
+    following the chain, and the map is kept up to date as blocks are added,
+    removed, and filled up.
+
+    Blocks are added and removed with self.lock held, and readers in other
+    threads don't need it: an index they hold keeps describing the chain as
+    it was when they took it. Blocks added at the end of the chain extend
+    the index in place, behind its published length (see append_to_index()).
+    Any other change builds a new index and swaps it in whole (see reindex()
+    and cut_index()).
+
+    Readers can share one file between threads without a lock only if it
+    is unbuffered (opened with buffering=0; see backends.is_positional()).
+    Buffered files take a lock around each seek and read.
+
+    With `compression` ("zlib" or "lzma"), the structure is made of
+    CompressedBlocks. Their data is written back when they fill up, or on
+    flush(). A full block is then moved to a spot that fits the compressed
+    payload, if there is an allocator to give the rest of its space to.
+    Compressed structures don't keep an extent map.
+    """
+    def __init__(self, fh, position=0, block_size=1024, initialize=False, fill=None,
+            allocator=None, defer_headers=False, growth=None, extent_map=None,
+            compression=None):
+        self.allocator = allocator
+        self.growth = growth
+        self.extent_map = extent_map
+        self.defer_headers = defer_headers
+        self.dirty_headers = {}
+        self.codec = get_codec(compression) if compression is not None else None
+        self.cache = BlockCache()
+        self.unwritten = {}
+        self.lock = structure_lock(fh)
+        self.filled = None
+        self.partial = set()
         if initialize:
-            self.blocks = self.init_structure(fh, position, block_size, fill=fill)
+            blocks = self.init_structure(fh, position, block_size, fill=fill)
         else:
-            self.blocks = self.read_structure(fh, position)
+            blocks = self.read_blocks(fh, position)
+        self.set_blocks(blocks)
+
+    def read_blocks(self, fh, position):
+        if self.extent_map is not None and self.extent_map.structure is not None:
+            return self.read_mapped_structure(fh, position)
+        return self.read_structure(fh, position)
+
+    def set_blocks(self, blocks):
+        if isinstance(blocks[0], CompressedBlock):
+            self.codec = blocks[0].codec
+            for block in blocks:
+                block.cache = self.cache
+        if self.codec is not None:
+            self.extent_map = None
+        self.reindex(blocks)
+
+    def reload(self, fh):
+        """
+        Reads the chain again from `fh`, dropping the changes only kept in
+        memory. Used when the writes behind them are rolled back.
+        """
+        with self.lock:
+            self.dirty_headers = {}
+            self.unwritten = {}
+            self.cache = BlockCache()
+            self.filled = None
+            self.set_blocks(self.read_blocks(fh, self.blocks[0].start))
 
     def init_structure(self, fh, position, block_size, fill=None):
         if fill is None:
             fill = int_to_bytes(-1, 4)
 
-        block = Block(position, block_size, -1, -1)
+        if self.codec is None:
+            block = Block(position, block_size, -1, -1)
+        else:
+            block = CompressedBlock(position, block_size, -1, -1, codec=self.codec)
+            block.cache = self.cache
         self.write_new_block(fh, block, fill)
+        self.partial = {block.start}
         return [block]
 
+    def allocate_block(self, fh, block_size, nxt, prev):
+        if self.codec is None:
+            pos, block_size = allocate(fh, self.allocator, block_size)
+            return Block(pos, block_size, nxt, prev)
+
+        pos, space = allocate(fh, self.allocator, block_size + 1,
+                CompressedBlock.SIZE_HEADER)
+        block = CompressedBlock(pos, space - 1, nxt, prev, codec=self.codec,
+                space=space)
+        block.cache = self.cache
+        return block
+
     def read_structure(self, fh, position):
         blocks = []
         cur = position
@@ -170,80 +628,597 @@ class BlockStructure(object):
             blocks.append(block)
             cur = block.next
 
+        self.partial = {x.start for x in blocks if x.next_empty != x.size}
+        return blocks
+
+    def read_mapped_structure(self, fh, position):
+        extents = self.extent_map.read_extents()
+        starts = [-1] + [x[0] for x in extents] + [-1]
+        blocks = [MappedBlock(fh, start, size, starts[i + 2], starts[i])
+                for i, (start, size, _) in enumerate(extents)]
+        self.partial = {start for start, _, partial in extents if partial}
+
+        # Only the ends of the chain are checked up front: the map is rewritten
+        # whenever the tail changes, so a crash in between shows up there.
+        # Changes in the middle of the chain write the headers before the
+        # map, so a block there may not match it: the first one found has
+        # the chain rebuilt (see remap()).
+        try:
+            if not blocks or blocks[0].start != position:
+                raise PyDBConsistencyError("Extent map doesn't start at {}.".format(position))
+            blocks[0].load()
+            blocks[-1].load()
+        except (PyDBConsistencyError, PyDBInternalError):
+            blocks = self.read_structure(fh, position)
+            self.extent_map.write_extents(fh, blocks, self.partial)
+            return blocks
+
+        for block in blocks:
+            block.on_mismatch = lambda: self.remap(fh)
         return blocks
 
+    def remap(self, fh):
+        """
+        Follows the chain from its first block and rewrites the extent map
+        from it. Returns the blocks of the chain.
+        """
+        with self.lock:
+            blocks = self.read_structure(fh, self.blocks[0].start)
+            self.extent_map.write_extents(fh, blocks, self.partial)
+            self.filled = None
+            self.reindex(blocks)
+            return blocks
+
+    def reindex(self, blocks, start=0):
+        """
+        Makes `blocks` the chain, reusing the index of the first `start` blocks,
+        which must not have changed. The index is built anew and swapped in at
+        once.
+        """
+        if start == 0:
+            offsets, positions, capacity = [], {}, 0
+        else:
+            offsets = self.offsets[:start]
+            positions = {x: i for x, i in self.positions.items() if i < start}
+            capacity = offsets[-1] + blocks[start - 1].size
+
+        for index, block in enumerate(blocks[start:], start):
+            offsets.append(capacity)
+            positions[block.start] = index
+            capacity += block.size
+
+        self.index = (blocks, offsets, positions, capacity, len(blocks))
+
+    def append_to_index(self, block):
+        """
+        Adds `block` at the end of the index in place. The lists grow first and
+        the new length is published last, so readers holding the index still
+        see the chain as it was.
+        """
+        blocks, offsets, positions, capacity, count = self.index
+        blocks.append(block)
+        offsets.append(capacity)
+        positions[block.start] = count
+        self.index = (blocks, offsets, positions, capacity + block.size, count + 1)
+
+    def cut_index(self, count):
+        """
+        Keeps the first `count` blocks of the index. The lists are copied, so
+        readers holding the index as it was can still use all of it.
+        """
+        blocks, offsets, positions, _, _ = self.index
+        blocks, offsets = blocks[:count], offsets[:count]
+        positions = {x: i for x, i in positions.items() if i < count}
+        self.index = (blocks, offsets, positions,
+                offsets[-1] + blocks[-1].size, count)
+
+    @property
+    def blocks(self):
+        return self.index[0]
+
+    @property
+    def offsets(self):
+        return self.index[1]
+
+    @property
+    def positions(self):
+        return self.index[2]
+
+    @property
+    def capacity(self):
+        return self.index[3]
+
+    def index_of(self, block):
+        return self.positions[block.start]
+
+    def find_block(self, offset):
+        blocks, offsets, _, capacity, count = self.index
+        if offset < 0 or offset > capacity:
+            raise PyDBIterationError("Invalid offset.")
+        if offset == capacity:
+            return blocks[count - 1], blocks[count - 1].size
+        index = bisect_right(offsets, offset, 0, count) - 1
+        return blocks[index], offset - offsets[index]
+
+    def data_size(self):
+        # Computed on first use. Only the blocks that may not be full have
+        # their fill read, so mapped blocks aren't all loaded.
+        if self.filled is None:
+            partial = self.partial
+            self.filled = sum(x.next_empty if x.start in partial else x.size
+                    for x in self.blocks)
+        return self.filled
+
+    def set_next_empty(self, fh, block, next_empty):
+        self.update_next_empty(block, next_empty)
+        self.header_changed(fh, block)
+
+    def update_next_empty(self, block, next_empty):
+        """
+        Updates next_empty in memory only; see header_changed().
+        """
+        if self.filled is not None:
+            self.filled += next_empty - block.next_empty
+        block.next_empty = next_empty
+
+    def header_changed(self, fh, block):
+        self.record_fill(fh, block, written=False)
+        if self.codec is not None:
+            # The fill of a compressed block goes to disk with its payload.
+            self.unwritten[id(block)] = block
+            return
+        if self.defer_headers:
+            self.dirty_headers[block.start] = block
+        else:
+            self.write_header(fh, block)
+            self.record_fill(fh, block)
+
+    def record_fill(self, fh, block, written=True):
+        """
+        Keeps self.partial, the starts of the blocks that may not be full, and
+        the extent map in step with the next_empty of `block`. A block is
+        recorded as partial before its header says so, and as full only once
+        its header is `written`, so that the map never counts a block as full
+        when its header on disk doesn't.
+        """
+        partial = block.next_empty != block.size
+        if partial == (block.start in self.partial) or not (partial or written):
+            return
+        if partial:
+            self.partial.add(block.start)
+        else:
+            self.partial.discard(block.start)
+        if self.extent_map is not None:
+            index = self.index_of(block)
+            self.extent_map.update(fh, self.blocks, self.partial, index, index + 1)
+
+    def write_header(self, fh, block):
+        self.dirty_headers.pop(block.start, None)
+        block.write_header(fh)
+
+    def flush_headers(self, fh):
+        dirty, self.dirty_headers = self.dirty_headers, {}
+        for start in sorted(dirty):
+            dirty[start].write_header(fh)
+            self.record_fill(fh, dirty[start])
+
+    def flush(self, fh):
+        for block in list(self.unwritten.values()):
+            self.write_back(fh, block)
+        self.flush_headers(fh)
+
+    def data_written(self, fh, blocks):
+        """
+        Records that the data in `blocks` changed. Compressed blocks are
+        written back once full, the others on flush().
+        """
+        if self.codec is None:
+            return
+        for block in blocks:
+            if block.next_empty == block.size:
+                self.write_back(fh, block)
+            else:
+                self.unwritten[id(block)] = block
+
+    def write_back(self, fh, block):
+        with self.lock:
+            self.unwritten.pop(id(block), None)
+            payload = block.compress(fh)
+            index = self.index_of(block)
+            shrink = (index > 0 and self.allocator is not None and
+                    block.next_empty == block.size and
+                    len(payload) * 4 <= block.space * 3)
+
+            if len(payload) > block.space or shrink:
+                position, space = allocate(fh, self.allocator, len(payload),
+                        block.get_header_size())
+                moved = copy(block)
+                moved.start, moved.space = position, space
+                moved.write_payload(fh, payload)
+                self.relink(fh, block, position)
+                block.space = space
+            else:
+                block.write_payload(fh, payload)
+            block.stored = len(payload)
+            block.written_empty = block.next_empty
+            block.dirty = False
+            self.dirty_headers.pop(block.start, None)
+
+    def relink(self, fh, block, position):
+        """
+        Points the neighbours of `block` at `position`, where a copy of it has
+        been written, and hands its old space to the allocator.
+        """
+        with self.lock:
+            old = copy(block)
+            index = self.index_of(block)
+            if index > 0:
+                prev_block = self.blocks[index - 1]
+                prev_block.next = position
+                self.write_header(fh, prev_block)
+            if index + 1 < len(self.blocks):
+                next_block = self.blocks[index + 1]
+                next_block.prev = position
+                self.write_header(fh, next_block)
+
+            # Positions change as a whole, like the rest of the index. Both
+            # stay in it until the block has moved, so that readers can find
+            # it either way.
+            blocks, offsets, positions, capacity, count = self.index
+            positions = dict(positions)
+            positions[position] = index
+            self.index = (blocks, offsets, positions, capacity, count)
+            if block.start in self.dirty_headers:
+                del self.dirty_headers[block.start]
+                self.dirty_headers[position] = block
+            block.start = position
+            positions = dict(positions)
+            del positions[old.start]
+            self.index = (blocks, offsets, positions, capacity, count)
+            if old.start in self.partial:
+                self.partial.discard(old.start)
+                self.partial.add(position)
+
+            if self.extent_map is not None:
+                self.extent_map.update(fh, self.blocks, self.partial, index, index + 1)
+            if self.allocator is not None:
+                self.allocator.free(fh, [old])
+
     def next_block(self, block):
-        pos = next(i for i, x in enumerate(self.blocks) if block is x)
-        return self.blocks[pos+1]
+        blocks, _, positions, _, _ = self.index
+        return blocks[positions[block.start] + 1]
 
     def truncate_blocks(self, fh, after=None, before=None):
-        to_remove = []
-        if after and not before:
-            pos = next(i for i, x in enumerate(self.blocks) if after is x)
-            to_remove += self.blocks[pos+1:]
-            self.blocks = self.blocks[:pos+1]
-        elif not after and before:
+        if before:
             raise NotImplementedError
+        with self.lock:
+            pos = self.index_of(after)
+            to_remove = self.blocks[pos+1:]
+            if to_remove:
+                self.cut_index(pos + 1)
 
-        for block in to_remove:
-            block.next = -1
-            block.prev = -1
-            block.write_header(fh)
-        after.next = -1
-        after.write_header(fh)
+            for block in to_remove:
+                self.unwritten.pop(id(block), None)
+                block.next = -1
+                block.prev = -1
+                self.write_header(fh, block)
+                self.partial.discard(block.start)
+                if self.filled is not None:
+                    self.filled -= block.next_empty
+            after.next = -1
+            self.write_header(fh, after)
 
-    def add_block(self, fh, block_size, after=None, fill=None):
-        if fill is None:
-            fill = int_to_bytes(-1, 4)
+            if self.extent_map is not None and to_remove:
+                self.extent_map.update(fh, self.blocks, self.partial, len(self.blocks))
+            if self.allocator is not None and to_remove:
+                self.allocator.free(fh, to_remove)
 
-        if after is None:
-            after = self.blocks[-1]
-        prior_block = after
-        next_block = Block.read_block(fh, after.next) if after.next != -1 else None
-        prior_block_pos = after.start
-        next_block_pos = after.next
+    def add_block(self, fh, block_size=None, after=None, fill=None, pending=0):
+        with self.lock:
+            if fill is None:
+                fill = int_to_bytes(-1, 4)
+            if block_size is None:
+                block_size = self.growth.next_block_size(self, pending)
 
-        pos = fh.seek(0, os.SEEK_END)
-        block = Block(pos, block_size, next_block_pos, prior_block_pos)
-        pos = self.write_new_block(fh, block, fill=fill)
+            if after is None:
+                after = self.blocks[-1]
+            index = self.index_of(after) + 1
+            prior_block = after
+            next_block = self.blocks[index] if after.next != -1 else None
+            prior_block_pos = after.start
+            next_block_pos = after.next
 
-        prior_block.next = pos
-        prior_block.write_header(fh)
-        block.write_header(fh)
-        if next_block is not None:
-            next_block.prev = block.start
-            next_block.write_header(fh)
+            block = self.allocate_block(fh, block_size, next_block_pos, prior_block_pos)
+            pos = self.write_new_block(fh, block, fill=fill)
+            if block.next_empty != block.size:
+                self.partial.add(block.start)
+            # Readers only move on to the new block once prior_block.next
+            # points at it, and by then it is in the index.
+            if next_block is None:
+                self.append_to_index(block)
+            else:
+                self.reindex(self.blocks[:index] + [block] + self.blocks[index:], index)
 
-        self.blocks.append(block)
-        fh.flush()
-        return block
+            prior_block.next = pos
+            self.write_header(fh, prior_block)
+            if next_block is not None:
+                next_block.prev = block.start
+                self.write_header(fh, next_block)
+
+            if self.extent_map is not None:
+                self.extent_map.update(fh, self.blocks, self.partial, index)
+            fh.flush()
+            return block
 
     def write_new_block(self, fh, block, fill):
-        pos = fh.seek(block.start)
         block.write_header(fh)
         block.fill_data(fh, fill)
+        if self.codec is not None:
+            self.unwritten[id(block)] = block
         fh.flush()
-        return pos
+        return block.start
+
+class BlockAllocator(object):
+    """
+    Keeps track of blocks unlinked from their structures so that their space
+    is handed out again before the file is grown. Free extents are kept sorted
+    by position, with adjacent ones merged, and persisted in a structure of
+    their own:
+
+    | COUNT | START | TOTAL_SIZE | START | TOTAL_SIZE | ... |
+
+    TOTAL_SIZE includes the block header. The structure is only created once
+    something is freed; `on_create` is called with its position.
+    """
+
+    MIN_BLOCK_SIZE = 16
+
+    def __init__(self, fh, position=None, block_size=128, on_create=None):
+        self.block_size = block_size
+        self.on_create = on_create
+        self.extents = []
+        self.structure = None
+        self.io = None
+        if position is not None:
+            self.structure = BlockStructure(fh, position)
+            self.io = BlockStructureOrderedDataIO(fh, self.structure,
+                    blocksize=block_size)
+            self.extents = self.read_extents()
+
+    def read_extents(self):
+        return read_pairs(self.io)
+
+    def write_extents(self, fh):
+        if self.structure is None:
+            position = end_of_file(fh)
+            self.structure = BlockStructure(fh, position=position,
+                    block_size=self.block_size, initialize=True)
+            self.io = BlockStructureOrderedDataIO(fh, self.structure,
+                    blocksize=self.block_size)
+            if self.on_create is not None:
+                self.on_create(position)
+
+        data = [int_to_bytes(len(self.extents))]
+        for start, total in self.extents:
+            data.append(int_to_bytes(start) + int_to_bytes(total))
+        self.io.seek(0)
+        self.io.write(b''.join(data))
+
+    def free(self, fh, blocks):
+        pool = BufferPool.for_file(fh)
+        for block in blocks:
+            if pool is not None:
+                pool.discard(block.start)
+            self.add_extent(block.start, block.get_total_size())
+        self.write_extents(fh)
+
+    def free_extent(self, fh, start, total):
+        self.add_extent(start, total)
+        self.write_extents(fh)
+
+    def add_extent(self, start, total):
+        index = bisect_right(self.extents, (start, total))
+        if index < len(self.extents):
+            next_start, next_total = self.extents[index]
+            if start + total == next_start:
+                total += next_total
+                del self.extents[index]
+        if index > 0:
+            prev_start, prev_total = self.extents[index - 1]
+            if prev_start + prev_total == start:
+                start, total = prev_start, prev_total + total
+                index -= 1
+                del self.extents[index]
+        self.extents.insert(index, (start, total))
+
+    def allocate(self, fh, block_size, header_size=None):
+        """
+        Returns (position, size) of a free block with room for at least
+        `block_size` bytes of data after a `header_size` bytes long header,
+        or None if there isn't any.
+        """
+        if header_size is None:
+            header_size = Block.SIZE_HEADER
+        needed = header_size + block_size
+        for index, (start, total) in enumerate(self.extents):
+            if total < needed:
+                continue
+
+            if total - needed >= Block.SIZE_HEADER + self.MIN_BLOCK_SIZE:
+                self.extents[index] = (start + needed, total - needed)
+            else:
+                # The block gets the rest too, in multiples of 4 bytes so that
+                # it can still be filled with ints.
+                del self.extents[index]
+                block_size += (total - needed) // 4 * 4
+            self.write_extents(fh)
+            return start, block_size
+        return None
+
+
+class ExtentMap(object):
+    """
+    The positions and sizes of the blocks of one structure, stored in a
+    structure of its own:
+
+    | COUNT | START | SIZE | START | SIZE | ... |
+
+    SIZE is negative for the blocks that may not be full (see
+    BlockStructure.record_fill()), so that the size of the data is known
+    without reading the headers of the others.
+
+    The map is only created once the structure has MIN_BLOCKS blocks;
+    `on_create` is called with its position.
+    """
+
+    MIN_BLOCKS = 8
+
+    def __init__(self, fh, position=None, block_size=128, on_create=None):
+        self.block_size = block_size
+        self.on_create = on_create
+        self.structure = None
+        self.io = None
+        if position is not None:
+            self.structure = BlockStructure(fh, position,
+                    growth=GeometricGrowth(block_size))
+            self.io = BlockStructureOrderedDataIO(fh, self.structure)
+
+    def read_extents(self):
+        """
+        Returns the (start, size, partial) of each block.
+        """
+        return [(start, abs(size), size < 0) for start, size in read_pairs(self.io)]
+
+    def update(self, fh, blocks, partial, start, end=None):
+        """
+        Records that blocks[start:end] changed (or that the chain now ends at
+        `start`). `partial` holds the starts of the blocks that may not be full.
+        """
+        if self.structure is None:
+            if len(blocks) < self.MIN_BLOCKS:
+                return
+            start, end = 0, None
+        self.write_extents(fh, blocks, partial, start, end)
+
+    def write_extents(self, fh, blocks, partial, start=0, end=None):
+        if self.structure is None:
+            position = end_of_file(fh)
+            self.structure = BlockStructure(fh, position=position,
+                    block_size=self.block_size, initialize=True,
+                    growth=GeometricGrowth(self.block_size))
+            self.io = BlockStructureOrderedDataIO(fh, self.structure)
+            if self.on_create is not None:
+                self.on_create(position)
+
+        self.io.seek(0)
+        self.io.write(int_to_bytes(len(blocks)))
+        self.io.seek(4 + start * 8)
+        self.io.write(b''.join(int_to_bytes(x.start) +
+                int_to_bytes(-x.size if x.start in partial else x.size)
+                for x in blocks[start:end]))
+
 
 class MultiBlockStructure(object):
+    """
+    The header structure lists the positions of all the other structures,
+    up to a -1. Other entries are tagged with a negative value:
+
+     - TAG_ALLOCATOR, position: the BlockAllocator.
+     - TAG_EXTENT_MAP, structure position, position: the ExtentMap of a
+       structure.
+    """
+
+    TAG_ALLOCATOR = -2
+    TAG_EXTENT_MAP = -3
+
     def __init__(self, fh, block_size=1024, initialize=False):
        self.header_structure = BlockStructure(fh, block_size=block_size,
                initialize=initialize, fill=int_to_bytes(-1, 4))
        self.header = BlockStructureOrderedDataIO(fh, self.header_structure)
+       self.super_blocks = []
        self.super_blocks = self.read_structure(fh, self.header_structure)
+       if hasattr(fh, 'add_rollback_listener'):
+           fh.add_rollback_listener(self)
+
+    def reload(self, fh):
+        """
+        Reads the header and the structures again. The structures still
+        listed keep their objects.
+        """
+        self.header_structure.reload(fh)
+        self.super_blocks = self.read_structure(fh, self.header_structure)
 
     def read_structure(self, fh, header_structure):
         self.header.seek(0)
         it = self.header.iterdata(chunk_size=4)
-        it = ((a, b, bytes_to_int(c)) for a, b, c in it)
-        super_blocks_pos = [x[2] for x in takewhile(lambda x: x[2] != -1, it)]
-        return [BlockStructure(fh, x) for x in super_blocks_pos]
-
-    def add_structure(self, fh, block_size, fill=None):
-        pos = fh.seek(0, os.SEEK_END)
-        block_structure = BlockStructure(fh, position=pos, initialize=True,
-                block_size=block_size, fill=fill)
-        self.header.write(int_to_bytes(pos))
-        fh.flush()
-        return block_structure
+        it = (bytes_to_int(x) for x in it)
+        entries = iter(list(takewhile(lambda x: x != -1, it)))
+
+        positions = []
+        allocator_pos = None
+        extent_maps = {}
+        for entry in entries:
+            if entry == self.TAG_ALLOCATOR:
+                allocator_pos = next(entries)
+            elif entry == self.TAG_EXTENT_MAP:
+                structure_pos = next(entries)
+                extent_maps[structure_pos] = next(entries)
+            else:
+                positions.append(entry)
+
+        self.allocator = BlockAllocator(fh, allocator_pos,
+                on_create=lambda pos: self.write_entries())
+        known = {x.blocks[0].start: x for x in self.super_blocks}
+        structures = []
+        for position in positions:
+            extent_map = self.get_extent_map(fh, extent_maps.get(position))
+            structure = known.get(position)
+            if structure is None:
+                structure = BlockStructure(fh, position, allocator=self.allocator,
+                        extent_map=extent_map)
+            else:
+                structure.allocator = self.allocator
+                structure.extent_map = extent_map
+                structure.reload(fh)
+            structures.append(structure)
+        return structures
+
+    def get_extent_map(self, fh, position=None):
+        return ExtentMap(fh, position, on_create=lambda pos: self.write_entries())
 
+    def write_entry(self, *values):
+        self.header.seek(self.header.size())
+        self.header.write(b''.join(int_to_bytes(x) for x in values))
+
+    def write_entries(self):
+        """
+        Rewrites the whole header from the structures currently known.
+        """
+        entries = [x.blocks[0].start for x in self.super_blocks]
+        if self.allocator.structure is not None:
+            entries += [self.TAG_ALLOCATOR, self.allocator.structure.blocks[0].start]
+        for structure in self.super_blocks:
+            extent_map = structure.extent_map
+            if extent_map is not None and extent_map.structure is not None:
+                entries += [self.TAG_EXTENT_MAP, structure.blocks[0].start,
+                        extent_map.structure.blocks[0].start]
+
+        self.header.seek(0)
+        self.header.write(b''.join(int_to_bytes(x) for x in entries), truncate=True)
+
+    def add_structure(self, fh, block_size, fill=None, compression=None):
+        with structure_lock(fh):
+            if compression is None:
+                pos, block_size = allocate(fh, self.allocator, block_size)
+            else:
+                # Room for the longer header, and for the data uncompressed.
+                pos, space = allocate(fh, self.allocator, block_size + 1,
+                        CompressedBlock.SIZE_HEADER)
+                block_size = space - 1
+            block_structure = BlockStructure(fh, position=pos, initialize=True,
+                    block_size=block_size, fill=fill, allocator=self.allocator,
+                    extent_map=self.get_extent_map(fh), compression=compression)
+            self.write_entry(pos)
+            self.super_blocks.append(block_structure)
+            fh.flush()
+            return block_structure
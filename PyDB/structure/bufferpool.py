@@ -0,0 +1,171 @@
+import threading
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+from PyDB.exceptions import PyDBInternalError
+from .backends import readinto_at, write_at, file_size
+
+
+class Page(object):
+    def __init__(self, start, data):
+        self.start = start
+        self.data = data
+        self.dirty = False
+        self.pins = 0
+
+    def __repr__(self):
+        return ("Page(start={s.start}, size={size}, dirty={s.dirty}, "
+                "pins={s.pins})").format(s=self, size=len(self.data))
+
+
+class BufferPool(object):
+    """
+    Caches whole blocks (header and data) of one file, keyed by the start
+    offset of the block. Pages are evicted in LRU order once the cached bytes
+    exceed `capacity`; dirty pages are written back on eviction or flush().
+
+    A pool is attached to a file handle, and every Block operation on that
+    handle goes through it, so all BlockStructures opened on the same handle
+    share it. Pages are only touched with self.lock held, so threads can
+    share the pool.
+    """
+
+    pools = WeakKeyDictionary()
+
+    def __init__(self, fh, capacity=4 * 1024 * 1024):
+        self.fh = fh
+        self.capacity = capacity
+        self.pages = OrderedDict()
+        self.used = 0
+        self.end = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    @classmethod
+    def attach(cls, fh, capacity=4 * 1024 * 1024):
+        if fh in cls.pools:
+            raise PyDBInternalError("A buffer pool is already attached.")
+        pool = cls(fh, capacity=capacity)
+        cls.pools[fh] = pool
+        return pool
+
+    @classmethod
+    def for_file(cls, fh):
+        return cls.pools.get(fh)
+
+    def detach(self):
+        self.flush()
+        del self.pools[self.fh]
+
+    def __contains__(self, start):
+        return start in self.pages
+
+    def get_page(self, start, size):
+        """
+        Returns the page for the `size` bytes long block at `start`, reading it
+        from the file if it isn't cached. Bytes past the end of the file read
+        as zeros.
+        """
+        with self.lock:
+            page = self.pages.get(start)
+            if page is not None:
+                if len(page.data) != size:
+                    raise PyDBInternalError("Cached block at {} has a different size."
+                            .format(start))
+                self.hits += 1
+                self.pages.move_to_end(start)
+                return page
+
+            self.misses += 1
+            data = bytearray(size)
+            readinto_at(self.fh, start, data)
+            page = Page(start, data)
+            self.pages[start] = page
+            self.used += size
+            self.end = max(self.end, start + size)
+            self.evict()
+            return page
+
+    def peek(self, start, length):
+        """
+        Returns the first `length` bytes of the page at `start` if it is cached,
+        None otherwise. Unlike get_page(), a miss doesn't load anything.
+        """
+        with self.lock:
+            page = self.pages.get(start)
+            if page is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pages.move_to_end(start)
+            return bytes(page.data[:length])
+
+    def read(self, start, size, position, length):
+        with self.lock:
+            page = self.get_page(start, size)
+            return bytes(page.data[position:position + length])
+
+    def write(self, start, size, position, data):
+        with self.lock:
+            page = self.get_page(start, size)
+            page.data[position:position + len(data)] = data
+            page.dirty = True
+
+    def pin(self, start, size):
+        with self.lock:
+            page = self.get_page(start, size)
+            page.pins += 1
+            return page
+
+    def unpin(self, start):
+        with self.lock:
+            page = self.pages[start]
+            if page.pins <= 0:
+                raise PyDBInternalError("Unpinning a page that isn't pinned.")
+            page.pins -= 1
+            self.evict()
+
+    def discard(self, start):
+        """
+        Drops the page at `start` without writing it back.
+        """
+        with self.lock:
+            page = self.pages.pop(start, None)
+            if page is not None:
+                self.used -= len(page.data)
+
+    def evict(self):
+        if self.used <= self.capacity:
+            return
+        # Pages are visited from the least recently used one, until enough
+        # of them are picked. The most recently used page is never evicted:
+        # it's the one the caller is working on.
+        newest = next(reversed(self.pages))
+        used = self.used
+        victims = []
+        for start, page in self.pages.items():
+            if used <= self.capacity or start == newest:
+                break
+            if not page.pins:
+                victims.append(page)
+                used -= len(page.data)
+
+        for page in victims:
+            self.write_back(page)
+            del self.pages[page.start]
+            self.used -= len(page.data)
+
+    def write_back(self, page):
+        if page.dirty:
+            write_at(self.fh, page.start, page.data)
+            page.dirty = False
+
+    def flush(self):
+        with self.lock:
+            for start in sorted(self.pages):
+                self.write_back(self.pages[start])
+            self.fh.flush()
+
+    def end_of_file(self):
+        return max(file_size(self.fh), self.end)
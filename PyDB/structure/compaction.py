@@ -0,0 +1,82 @@
+import sys
+
+from PyDB.structure.blocks import Block, MultiBlockStructure, allocate
+from PyDB.structure.backends import write_at
+
+
+class Compactor(object):
+    """
+    Rewrites the structures of a MultiBlockStructure so that the blocks of
+    each one are contiguous and in chain order, which turns scans into
+    sequential reads. The space they leave behind goes to the allocator.
+
+    Each step() moves a single block and relinks its neighbours, so every
+    chain stays valid in between and readers can carry on. Block objects are
+    updated in place, so data IOs holding them keep working. run() does
+    everything at once.
+    """
+
+    def __init__(self, fh, mbs):
+        self.fh = fh
+        self.mbs = mbs
+        self.moves = self.plan()
+
+    @staticmethod
+    def is_contiguous(structure):
+        blocks = structure.blocks
+        return all(a.start + a.get_total_size() == b.start
+                for a, b in zip(blocks, blocks[1:]))
+
+    def plan(self):
+        for structure in list(self.mbs.super_blocks):
+            # Compressed blocks are moved as they are on disk.
+            structure.flush(self.fh)
+            if self.is_contiguous(structure):
+                continue
+
+            total = sum(x.get_total_size() for x in structure.blocks)
+            position = self.reserve(total)
+            for block in list(structure.blocks):
+                self.move_block(structure, block, position)
+                position += block.get_total_size()
+                yield block
+
+    def reserve(self, total):
+        position, size = allocate(self.fh, self.mbs.allocator,
+                total - Block.SIZE_HEADER)
+        extra = size + Block.SIZE_HEADER - total
+        if extra > 0:
+            self.mbs.allocator.free_extent(self.fh, position + total, extra)
+        else:
+            # Extend the file so that nothing else gets placed in the region.
+            write_at(self.fh, position + total - 1, b'\xff')
+        return position
+
+    def move_block(self, structure, block, position):
+        with structure.lock:
+            index = structure.index_of(block)
+            block.copy_to(self.fh, position)
+            structure.relink(self.fh, block, position)
+            if index == 0:
+                self.mbs.write_entries()
+            self.fh.flush()
+
+    def step(self):
+        """
+        Moves one block. Returns False once there is nothing left to do.
+        """
+        return next(self.moves, None) is not None
+
+    def run(self):
+        while self.step():
+            pass
+
+
+def compact(path):
+    with open(path, "rb+") as fh:
+        Compactor(fh, MultiBlockStructure(fh)).run()
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        compact(path)
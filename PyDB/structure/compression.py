@@ -0,0 +1,75 @@
+import lzma
+import threading
+import zlib
+from collections import OrderedDict
+
+from PyDB.exceptions import PyDBInternalError
+
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2}]
+
+CODECS = {
+    CODEC_ZLIB: (zlib.compress, zlib.decompress),
+    CODEC_LZMA: (lambda data: lzma.compress(data, format=lzma.FORMAT_RAW,
+                    filters=LZMA_FILTERS),
+                 lambda data: lzma.decompress(data, format=lzma.FORMAT_RAW,
+                    filters=LZMA_FILTERS)),
+}
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+
+
+def get_codec(codec):
+    """
+    Returns the id of `codec`, given by name or id.
+    """
+    codec = CODEC_NAMES.get(codec, codec)
+    if codec not in CODECS:
+        raise PyDBInternalError("Unknown codec: {}.".format(codec))
+    return codec
+
+
+def compress(codec, data):
+    """
+    Returns | CODEC | COMPRESSED DATA |, or | CODEC_RAW | DATA | if
+    compressing doesn't make `data` any smaller.
+    """
+    res = CODECS[codec][0](bytes(data))
+    if len(res) >= len(data):
+        return bytes([CODEC_RAW]) + bytes(data)
+    return bytes([codec]) + res
+
+
+def decompress(payload):
+    codec = payload[0]
+    if codec == CODEC_RAW:
+        return bytes(payload[1:])
+    if codec not in CODECS:
+        raise PyDBInternalError("Unknown codec: {}.".format(codec))
+    return CODECS[codec][1](bytes(payload[1:]))
+
+
+class BlockCache(object):
+    """
+    Limits how many compressed blocks keep their data decompressed in memory.
+    The least recently used ones drop it once there are more than `capacity`,
+    unless they have changes that aren't written back yet.
+    """
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def touch(self, block):
+        with self.lock:
+            self.blocks[id(block)] = block
+            self.blocks.move_to_end(id(block))
+            for key, cached in list(self.blocks.items())[:-1]:
+                if len(self.blocks) <= self.capacity:
+                    break
+                if not cached.dirty:
+                    cached.buffer = None
+                    del self.blocks[key]
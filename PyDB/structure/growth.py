@@ -0,0 +1,56 @@
+from collections import deque
+
+
+class GrowthPolicy(object):
+    """
+    Decides the size of the next block added to a BlockStructure.
+    `pending` is the number of bytes still waiting to be written.
+    """
+    def next_block_size(self, block_structure, pending):
+        raise NotImplementedError
+
+    def record_write(self, size):
+        pass
+
+
+class FixedGrowth(GrowthPolicy):
+    def __init__(self, block_size=1024):
+        self.block_size = block_size
+
+    def next_block_size(self, block_structure, pending):
+        return self.block_size
+
+
+class GeometricGrowth(GrowthPolicy):
+    """
+    Each block is `factor` times as large as the last one in the chain, from
+    `block_size` up to `max_block_size`.
+    """
+    def __init__(self, block_size=1024, factor=2, max_block_size=64 * 1024 * 1024):
+        self.block_size = block_size
+        self.factor = factor
+        self.max_block_size = max_block_size
+
+    def next_block_size(self, block_structure, pending):
+        size = block_structure.blocks[-1].size * self.factor
+        return min(max(size, self.block_size), self.max_block_size)
+
+
+class WriteSizeGrowth(GrowthPolicy):
+    """
+    Sizes each block to hold as much data as the last `history` writes did
+    (or the pending data, if that is more), in multiples of `block_size` and
+    up to `max_block_size`.
+    """
+    def __init__(self, block_size=1024, history=16, max_block_size=64 * 1024 * 1024):
+        self.block_size = block_size
+        self.max_block_size = max_block_size
+        self.writes = deque(maxlen=history)
+
+    def record_write(self, size):
+        self.writes.append(size)
+
+    def next_block_size(self, block_structure, pending):
+        size = max(sum(self.writes), pending, self.block_size)
+        size = -(-size // self.block_size) * self.block_size
+        return min(size, self.max_block_size)
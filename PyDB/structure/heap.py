@@ -0,0 +1,197 @@
+import struct
+import bisect
+from collections import namedtuple
+
+from PyDB.exceptions import PyDBValueError
+
+
+RowId = namedtuple('RowId', ['page', 'slot'])
+
+
+class HeapFile(object):
+    """
+    Rows kept in slotted pages, one per block of `structure`. The slots
+    are at the start of a page and the rows at its end, and they grow
+    towards each other:
+
+    | COUNT | FREE_END | OFFSET | LENGTH | OFFSET | LENGTH | ... | ROW | ROW |
+
+    A row is found by its RowId: the index of its page in the chain and its
+    slot. The RowId stays valid when the row is updated or other rows are
+    deleted. A deleted row leaves a slot with an OFFSET of -1, which new rows
+    reuse. Pages that were never written hold the block fill, so their COUNT
+    is -1.
+
+    The free-space map holds the contiguous free space of every page. It is
+    rebuilt from the page headers on open. Rows go to the page with the least
+    room that is still enough, or to a new page of `page_size` bytes (the
+    size of the first block by default).
+    """
+
+    PAGE_HEADER = struct.Struct(">ii")
+    SLOT = struct.Struct(">ii")
+
+    def __init__(self, fh, structure, page_size=None):
+        self.fh = fh
+        self.structure = structure
+        self.page_size = page_size or structure.blocks[0].size
+        self.free = []
+        self.by_free = []
+        for page, block in enumerate(structure.blocks):
+            count, free_end = self.parse_header(block,
+                    block.read_data(fh, 0, self.PAGE_HEADER.size))
+            self.set_free(page, free_end - self.slots_end(count))
+
+    def parse_header(self, block, buf):
+        count, free_end = self.PAGE_HEADER.unpack_from(buf)
+        if count < 0:
+            return 0, block.size
+        return count, free_end
+
+    def slots_end(self, count):
+        return self.PAGE_HEADER.size + count * self.SLOT.size
+
+    def set_free(self, page, free):
+        if page < len(self.free):
+            del self.by_free[bisect.bisect_left(self.by_free, (self.free[page], page))]
+            self.free[page] = free
+        else:
+            self.free.append(free)
+        bisect.insort(self.by_free, (free, page))
+
+    def get_block(self, rowid):
+        page, slot = rowid
+        if not 0 <= page < len(self.structure.blocks) or slot < 0:
+            raise PyDBValueError("Invalid row id: {}.".format(tuple(rowid)))
+        return self.structure.blocks[page]
+
+    def load(self, block):
+        buf = bytearray(block.read_data(self.fh, 0, block.size))
+        count, free_end = self.parse_header(block, buf)
+        return buf, count, free_end
+
+    def find_slot(self, buf, count, rowid):
+        if rowid.slot < count:
+            offset, length = self.SLOT.unpack_from(buf, self.slots_end(rowid.slot))
+            if offset >= 0:
+                return offset, length
+        raise PyDBValueError("No row with id {}.".format(tuple(rowid)))
+
+    def get(self, rowid):
+        """
+        Returns the row, with one read of its page.
+        """
+        block = self.get_block(rowid)
+        buf = block.read_data(self.fh, 0, block.size)
+        count, _ = self.parse_header(block, buf)
+        offset, length = self.find_slot(buf, count, rowid)
+        return bytes(buf[offset:offset + length])
+
+    def insert(self, data):
+        """
+        Stores the row `data` and returns its RowId.
+        """
+        need = len(data) + self.SLOT.size
+        with self.structure.lock:
+            index = bisect.bisect_left(self.by_free, (need, -1))
+            if index < len(self.by_free):
+                page = self.by_free[index][1]
+            else:
+                page = self.add_page(need)
+
+            block = self.structure.blocks[page]
+            buf, count, free_end = self.load(block)
+            slots = self.SLOT.iter_unpack(buf[self.slots_end(0):self.slots_end(count)])
+            slot = next((i for i, (offset, _) in enumerate(slots) if offset < 0), count)
+
+            free_end -= len(data)
+            self.write(block, max(count, slot + 1), free_end, slot,
+                    (free_end, len(data)), data)
+            return RowId(page, slot)
+
+    def update(self, rowid, data):
+        """
+        Replaces the row. It stays in its page, so it must fit there.
+        """
+        with self.structure.lock:
+            block = self.get_block(rowid)
+            buf, count, free_end = self.load(block)
+            offset, length = self.find_slot(buf, count, rowid)
+            if len(data) <= length:
+                self.write(block, count, free_end, rowid.slot,
+                        (offset, len(data)), data)
+                return
+
+            buf, free_end = self.compact(buf, count, skip=rowid.slot)
+            if free_end - len(data) < self.slots_end(count):
+                raise PyDBValueError("Row doesn't fit in its page.")
+            free_end -= len(data)
+            buf[free_end:free_end + len(data)] = data
+            self.SLOT.pack_into(buf, self.slots_end(rowid.slot), free_end, len(data))
+            self.write_page(rowid.page, block, buf, count, free_end)
+
+    def delete(self, rowid):
+        with self.structure.lock:
+            block = self.get_block(rowid)
+            buf, count, _ = self.load(block)
+            self.find_slot(buf, count, rowid)
+            buf, free_end = self.compact(buf, count, skip=rowid.slot)
+            self.write_page(rowid.page, block, buf, count, free_end)
+
+    def rows(self):
+        """
+        Yields the RowId and data of every row, page by page.
+        """
+        for page, block in enumerate(self.structure.blocks):
+            buf = block.read_data(self.fh, 0, block.size)
+            count, _ = self.parse_header(block, buf)
+            slots = buf[self.slots_end(0):self.slots_end(count)]
+            for slot, (offset, length) in enumerate(self.SLOT.iter_unpack(slots)):
+                if offset >= 0:
+                    yield RowId(page, slot), buf[offset:offset + length]
+
+    def add_page(self, need):
+        block = self.structure.add_block(self.fh,
+                block_size=max(self.page_size, need + self.PAGE_HEADER.size))
+        page = self.structure.index_of(block)
+        self.set_free(page, block.size - self.PAGE_HEADER.size)
+        return page
+
+    def compact(self, buf, count, skip):
+        """
+        Returns a copy of the page with the rows packed at its end, the one in
+        slot `skip` left out, and where the rows start.
+        """
+        res = bytearray(len(buf))
+        res[:self.slots_end(count)] = buf[:self.slots_end(count)]
+        free_end = len(buf)
+        for slot in range(count):
+            offset, length = self.SLOT.unpack_from(buf, self.slots_end(slot))
+            if offset < 0 or slot == skip:
+                offset, length = -1, 0
+            else:
+                free_end -= length
+                res[free_end:free_end + length] = buf[offset:offset + length]
+                offset = free_end
+            self.SLOT.pack_into(res, self.slots_end(slot), offset, length)
+        return res, free_end
+
+    def write(self, block, count, free_end, slot, entry, data):
+        """
+        Writes the header, one slot and one row of a page.
+        """
+        self.mark_used(block)
+        block.write_data(self.fh, 0, self.PAGE_HEADER.pack(count, free_end))
+        block.write_data(self.fh, self.slots_end(slot), self.SLOT.pack(*entry))
+        block.write_data(self.fh, entry[0], data)
+        self.set_free(self.structure.index_of(block), free_end - self.slots_end(count))
+
+    def write_page(self, page, block, buf, count, free_end):
+        self.mark_used(block)
+        self.PAGE_HEADER.pack_into(buf, 0, count, free_end)
+        block.write_data(self.fh, 0, buf)
+        self.set_free(page, free_end - self.slots_end(count))
+
+    def mark_used(self, block):
+        if block.next_empty != block.size:
+            self.structure.set_next_empty(self.fh, block, block.size)
@@ -0,0 +1,54 @@
+from .backends import will_need
+
+
+class ReadAhead(object):
+    """
+    Watches the blocks a cursor visits. Once it has moved through `trigger`
+    blocks in chain order, the next blocks are announced to the OS (see
+    backends.will_need()) so that they are read while the current ones are
+    processed: `min_blocks` at first, twice as many each time the cursor gets
+    halfway through what was announced, up to `max_blocks`. Landing anywhere
+    else starts over, so random access costs nothing but the bookkeeping.
+    """
+    def __init__(self, fh, structure, trigger=2, min_blocks=4, max_blocks=64):
+        self.fh = fh
+        self.structure = structure
+        self.trigger = trigger
+        self.min_blocks = min_blocks
+        self.max_blocks = max_blocks
+        self.reset(-1)
+
+    def reset(self, index):
+        self.index = index
+        self.streak = 0
+        self.window = 0
+        self.ahead = index
+
+    def visit(self, block):
+        index = self.structure.index_of(block)
+        if index == self.index:
+            return
+        if index != self.index + 1:
+            self.reset(index)
+            return
+
+        self.index = index
+        self.streak += 1
+        if self.streak < self.trigger or index + self.window // 2 < self.ahead:
+            return
+
+        self.window = min(max(self.window * 2, self.min_blocks), self.max_blocks)
+        end = min(index + self.window, len(self.structure.blocks) - 1)
+        self.prefetch(self.structure.blocks[max(self.ahead, index) + 1:end + 1])
+        self.ahead = max(self.ahead, end)
+
+    def prefetch(self, blocks):
+        start = end = None
+        for block in blocks:
+            if block.start != end:
+                if start is not None:
+                    will_need(self.fh, start, end - start)
+                start = block.start
+            end = block.start + block.get_total_size()
+        if start is not None:
+            will_need(self.fh, start, end - start)
@@ -0,0 +1,402 @@
+import os
+import struct
+import threading
+import weakref
+import zlib
+from contextlib import contextmanager
+
+from PyDB.exceptions import PyDBInternalError
+
+
+class WriteAheadLog(object):
+    """
+    A file-like wrapper around `fh` that logs writes to `log_fh` before they
+    reach `fh`, usable wherever the block layer expects a file handle.
+
+    Writes are private to the writing thread until commit() (or flush(),
+    outside of a transaction()) appends them to the log as one frame:
+
+    | MAGIC | LENGTH | CRC32 | POSITION | SIZE | DATA | POSITION | SIZE | ...
+
+    Committed data is kept in memory in pages of PAGE_SIZE bytes and written
+    to `fh` by checkpoint(), which happens in the background once the log
+    grows beyond `checkpoint_size`. Commits and reads go on while a
+    checkpoint writes: pages changed meanwhile stay in memory, and the log is
+    only truncated if nothing was committed since the checkpoint started.
+    Frames that are complete and whose CRC matches are replayed into `fh`
+    when the log is opened again.
+
+    Space written past the end by a thread is claimed at once (see size()),
+    so other threads allocate after it even before it is committed. Block
+    structures on the log lock with self.structure_lock, which a thread
+    inside a transaction() keeps until the transaction ends: structures are
+    changed by one transaction at a time. When a transaction that wrote
+    something rolls back, the rollback listeners (such as MultiBlockStructure)
+    read their structures again; IOs over them need to seek() before they're
+    used again.
+
+    `durability` selects when the log is fsync'ed:
+     - DURABILITY_OFF: only on checkpoints.
+     - DURABILITY_COMMIT: before commit() returns. Threads committing at the
+       same time share a single fsync.
+     - DURABILITY_INTERVAL: every `interval` seconds, in the background.
+    """
+
+    DURABILITY_OFF = "off"
+    DURABILITY_COMMIT = "commit"
+    DURABILITY_INTERVAL = "interval"
+
+    MAGIC_VALUE = 1463894338
+    FRAME_HEADER = struct.Struct(">iII")
+    RECORD_HEADER = struct.Struct(">qI")
+    PAGE_SIZE = 4096
+
+    def __init__(self, fh, log_fh, durability=DURABILITY_COMMIT, interval=0.1,
+            checkpoint_size=4 * 1024 * 1024):
+        if durability not in (self.DURABILITY_OFF, self.DURABILITY_COMMIT,
+                self.DURABILITY_INTERVAL):
+            raise PyDBInternalError("Unknown durability: {}.".format(durability))
+
+        self.fh = fh
+        self.log = log_fh
+        self.durability = durability
+        self.interval = interval
+        self.checkpoint_size = checkpoint_size
+
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.local = threading.local()
+        self.listeners = weakref.WeakSet()
+        self.pages = {}
+        self.pos = 0
+        self.reserved = 0
+        self.log_end = 0
+        self.synced_end = 0
+        self.syncing = False
+        self.closed = False
+
+        self.recover()
+        self.length = fh.seek(0, os.SEEK_END)
+        self.structure_lock = TransactionLock(self)
+
+        self.wakeup = threading.Event()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def recover(self):
+        self.log.seek(0)
+        data = self.log.read()
+        offset = 0
+        while offset + self.FRAME_HEADER.size <= len(data):
+            magic, length, crc = self.FRAME_HEADER.unpack_from(data, offset)
+            payload = data[offset + self.FRAME_HEADER.size:
+                    offset + self.FRAME_HEADER.size + length]
+            if magic != self.MAGIC_VALUE or len(payload) != length or \
+                    zlib.crc32(payload) != crc:
+                break
+            for position, record in self.decode_frame(payload):
+                self.fh.seek(position)
+                self.fh.write(record)
+            offset += self.FRAME_HEADER.size + length
+
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.truncate_log()
+
+    def truncate_log(self):
+        self.log.seek(0)
+        self.log.truncate()
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_end = self.synced_end = 0
+
+    def encode_frame(self, records):
+        payload = b''.join(self.RECORD_HEADER.pack(position, len(data)) + bytes(data)
+                for position, data in records)
+        header = self.FRAME_HEADER.pack(self.MAGIC_VALUE, len(payload),
+                zlib.crc32(payload))
+        return header + payload
+
+    def decode_frame(self, payload):
+        offset = 0
+        while offset < len(payload):
+            position, size = self.RECORD_HEADER.unpack_from(payload, offset)
+            offset += self.RECORD_HEADER.size
+            yield position, payload[offset:offset + size]
+            offset += size
+
+    def get_pending(self):
+        if not hasattr(self.local, 'pending'):
+            self.local.pending = []
+            self.local.depth = 0
+            self.local.holds_lock = False
+        return self.local.pending
+
+    def in_transaction(self):
+        self.get_pending()
+        return self.local.depth > 0
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups all writes (and flushes) made by this thread in the block into a
+        single commit. If the block raises, the writes are discarded.
+        """
+        self.get_pending()
+        self.local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                try:
+                    self.rollback()
+                finally:
+                    self.release_structures()
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            try:
+                self.commit()
+            finally:
+                self.release_structures()
+
+    def release_structures(self):
+        if self.local.holds_lock:
+            self.local.holds_lock = False
+            self.structure_lock.release()
+
+    def add_rollback_listener(self, listener):
+        """
+        Has listener.reload(wal) called, with the structure lock held, when a
+        transaction that wrote something rolls back.
+        """
+        self.listeners.add(listener)
+
+    def rollback(self):
+        pending, self.local.pending = self.get_pending(), []
+        if pending and self.listeners:
+            with self.structure_lock:
+                for listener in list(self.listeners):
+                    listener.reload(self)
+
+    def commit(self):
+        pending = self.get_pending()
+        if not pending:
+            return
+        frame = self.encode_frame(pending)
+
+        with self.lock:
+            self.log.seek(self.log_end)
+            self.log.write(frame)
+            self.log.flush()
+            self.log_end += len(frame)
+            for position, data in pending:
+                self.apply(position, data)
+
+            if self.durability == self.DURABILITY_COMMIT:
+                self.wait_synced(self.log_end)
+            log_end = self.log_end
+        self.local.pending = []
+
+        if log_end >= self.checkpoint_size:
+            self.wakeup.set()
+
+    def wait_synced(self, end):
+        """
+        Group commit: the first thread to get here fsyncs the log for
+        everybody that has written to it so far; the others wait for it.
+        Must be called with self.lock held.
+        """
+        while self.synced_end < end:
+            if self.syncing:
+                self.synced.wait()
+                continue
+            self.syncing = True
+            target = self.log_end
+            self.lock.release()
+            try:
+                os.fsync(self.log.fileno())
+            finally:
+                self.lock.acquire()
+                self.syncing = False
+            self.synced_end = max(self.synced_end, target)
+            self.synced.notify_all()
+
+    def apply(self, position, data):
+        end = position + len(data)
+        offset = 0
+        while position + offset < end:
+            page_no, page_offset = divmod(position + offset, self.PAGE_SIZE)
+            page = self.pages.get(page_no)
+            if page is None:
+                page = bytearray(self.PAGE_SIZE)
+                with self.file_lock:
+                    self.fh.seek(page_no * self.PAGE_SIZE)
+                    self.fh.readinto(page)
+                self.pages[page_no] = page
+            size = min(self.PAGE_SIZE - page_offset, end - position - offset)
+            page[page_offset:page_offset + size] = data[offset:offset + size]
+            offset += size
+        self.length = max(self.length, end)
+
+    def checkpoint(self):
+        """
+        Writes the pages to `fh`. self.lock is only held to take a copy of
+        them and, once they are on disk, to drop those that weren't changed
+        since. `file_lock` keeps the position of `fh` to one thread at a time.
+        """
+        with self.checkpoint_lock:
+            with self.lock:
+                if not self.pages:
+                    return
+                self.wait_synced(self.log_end)
+                pages = {x: bytes(y) for x, y in self.pages.items()}
+                length = self.length
+                log_end = self.log_end
+
+            for page_no in sorted(pages):
+                start = page_no * self.PAGE_SIZE
+                with self.file_lock:
+                    self.fh.seek(start)
+                    self.fh.write(pages[page_no][:length - start])
+            with self.file_lock:
+                self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+            with self.lock:
+                for page_no, page in pages.items():
+                    if self.pages[page_no] == page:
+                        del self.pages[page_no]
+                # Frames committed meanwhile are only in the log: it is kept
+                # whole, and replaying the rest of it again is harmless.
+                if self.log_end == log_end:
+                    self.truncate_log()
+
+    def sync(self):
+        with self.lock:
+            self.wait_synced(self.log_end)
+
+    def run(self):
+        timeout = self.interval if self.durability == self.DURABILITY_INTERVAL else None
+        while not self.closed:
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            if self.closed:
+                break
+            if self.durability == self.DURABILITY_INTERVAL:
+                self.sync()
+            if self.log_end >= self.checkpoint_size:
+                self.checkpoint()
+
+    def close(self):
+        self.commit()
+        self.closed = True
+        self.wakeup.set()
+        self.worker.join()
+        self.checkpoint()
+
+    def size(self):
+        ends = [position + len(data) for position, data in self.get_pending()]
+        return max([self.length, self.reserved] + ends)
+
+    def read_at(self, position, size):
+        end = min(position + size, self.size())
+        if end <= position:
+            return b''
+
+        with self.lock:
+            res = bytearray(end - position)
+            with self.file_lock:
+                self.fh.seek(position)
+                self.fh.readinto(res)
+            for page_no in range(position // self.PAGE_SIZE,
+                    (end - 1) // self.PAGE_SIZE + 1):
+                page = self.pages.get(page_no)
+                if page is not None:
+                    self.overlay(res, position, page_no * self.PAGE_SIZE, page)
+        for record_pos, data in self.get_pending():
+            self.overlay(res, position, record_pos, data)
+        return bytes(res)
+
+    @staticmethod
+    def overlay(buf, position, data_pos, data):
+        start = max(position, data_pos)
+        end = min(position + len(buf), data_pos + len(data))
+        if start < end:
+            buf[start - position:end - position] = data[start - data_pos:end - data_pos]
+
+    def write_at(self, position, data):
+        end = position + len(data)
+        if end > self.reserved:
+            with self.lock:
+                self.reserved = max(self.reserved, end)
+        self.get_pending().append((position, bytes(data)))
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size()
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = max(0, self.size() - self.pos)
+        res = self.read_at(self.pos, size)
+        self.pos += len(res)
+        return res
+
+    def readinto(self, buf):
+        data = self.read_at(self.pos, len(buf))
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def write(self, data):
+        self.write_at(self.pos, data)
+        self.pos += len(data)
+        return len(data)
+
+    def flush(self):
+        """
+        Commits this thread's writes, unless inside a transaction().
+        """
+        self.get_pending()
+        if self.local.depth == 0:
+            self.commit()
+
+
+class TransactionLock(object):
+    """
+    The structure lock of a WriteAheadLog (see blocks.structure_lock()): a
+    reentrant lock that a thread inside a transaction() keeps, once taken,
+    until the transaction ends.
+    """
+
+    def __init__(self, wal):
+        self.wal = wal
+        self.lock = threading.RLock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        if self.wal.in_transaction() and not self.wal.local.holds_lock:
+            self.lock.acquire()
+            self.wal.local.holds_lock = True
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
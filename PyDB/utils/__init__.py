@@ -1,11 +1,14 @@
 from .io_utils import int_to_bytes
 from .io_utils import bytes_to_int
+from .io_utils import encode_varint
+from .io_utils import decode_varint
 from .io_utils import string_to_bytes
 from .io_utils import bytes_to_string
 from .io_utils import bytes_to_ints
 from .io_utils import bytes_to_gen
 from .io_utils import gen_to_bytes
 from .io_utils import SafeReader
+from .io_utils import BufferReader
 
 from .class_utils import custom_import
 from .class_utils import get_qualified_name
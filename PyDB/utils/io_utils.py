@@ -6,11 +6,38 @@ def int_to_bytes(val, size=4):
 def bytes_to_int(val):
     return int.from_bytes(val, byteorder='big', signed=True)
 
+def encode_varint(val):
+    """
+    Encodes a non-negative int as LEB128: 7 bits a byte, lowest first, with
+    the top bit set on all bytes but the last.
+    """
+    res = bytearray()
+    while val >= 0x80:
+        res.append(val & 0x7F | 0x80)
+        val >>= 7
+    res.append(val)
+    return bytes(res)
+
+def decode_varint(buf, offset=0):
+    """
+    Returns the LEB128 encoded int at `offset` in `buf`, and the offset after it.
+    """
+    res = shift = 0
+    while True:
+        if offset >= len(buf):
+            raise PyDBInternalError("Varint past the end of the buffer.")
+        byte = buf[offset]
+        offset += 1
+        res |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return res, offset
+        shift += 7
+
 def string_to_bytes(val, encoding='ascii'):
     return str.encode(val, encoding)
 
 def bytes_to_string(barr, encoding='ascii'):
-    return bytes.decode(barr, encoding)
+    return str(barr, encoding)
 
 def bytes_to_ints(val):
     return [bytes_to_int(val[x:x+4]) for x in range(0, len(val), 4)]
@@ -21,6 +48,20 @@ def bytes_to_gen(barr):
 def gen_to_bytes(barr):
     return b''.join(barr)
 
+class BufferReader(object):
+    """
+    Reads from a bytes-like object like a file would, returning memoryview
+    slices of it. Can be wrapped in a SafeReader.
+    """
+    def __init__(self, buf, offset=0):
+        self.buf = memoryview(buf)
+        self.offset = offset
+
+    def read(self, size):
+        res = self.buf[self.offset:self.offset + size]
+        self.offset += len(res)
+        return res
+
 class SafeReader(object):
     def __init__(self, io):
         self.io = io
@@ -0,0 +1,55 @@
+import asyncio
+
+from PyDB.structure.aio import AsyncBlockIO
+
+from ..base import BlockStructureBasedTest
+
+
+class TestAsyncBlockIO(BlockStructureBasedTest):
+    def test_batched_reads(self):
+        data = bytes(range(256)) * 2
+        self.io.write(data)
+        aio = AsyncBlockIO(self.io)
+        batches = []
+        read_ranges = aio.reads.handler
+        aio.reads.handler = lambda ranges: batches.append(ranges) or read_ranges(ranges)
+
+        async def main():
+            first = await asyncio.gather(aio.read(10, 100), aio.read(10, 0),
+                    aio.read(20, 5), aio.read(4, 300))
+            second = await aio.read(3, 510)
+            return first, second
+
+        first, second = asyncio.run(main())
+        aio.close()
+        assert first == [data[100:110], data[0:10], data[5:25], data[300:304]]
+        assert second == data[510:]
+        assert len(batches) == 2
+
+    def test_read_ranges(self):
+        self.io.write(bytes(range(200)))
+        aio = AsyncBlockIO(self.io)
+        reads = []
+        cursor = self.io.cursor
+        def counting_cursor():
+            res = cursor()
+            read = res.read
+            res.read = lambda size, pos: reads.append((pos, size)) or read(size, pos)
+            return res
+        self.io.cursor = counting_cursor
+
+        res = aio.read_ranges([(50, 10), (0, 5), (5, 10), (55, 20), (150, 1)])
+        assert reads == [(0, 15), (50, 25), (150, 1)]
+        assert res[3] == bytes(range(55, 75))
+        aio.close()
+
+    def test_writes(self):
+        aio = AsyncBlockIO(self.io)
+
+        async def main():
+            await asyncio.gather(aio.write(b'abc', 0), aio.write(b'def', 3),
+                    aio.write(b'x', 1))
+            return await aio.read(6, 0)
+
+        assert asyncio.run(main()) == b'axcdef'
+        aio.close()
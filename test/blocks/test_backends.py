@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from PyDB.exceptions import PyDBValueError
+from PyDB.structure.blocks import BlockStructure, MultiBlockStructure
+from PyDB.structure.blocks import BlockStructureOrderedDataIO
+from PyDB.structure.backends import MmapFile, read_at, write_at, file_size
+from PyDB.utils import string_to_bytes
+
+from ..base import FileBasedTest
+
+
+class TestMmapFile(FileBasedTest):
+    def test_same_layout_as_file(self):
+        msg = "A very very very very long string for no reason."
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        BlockStructureOrderedDataIO(self.f, bs, blocksize=16).write(string_to_bytes(msg))
+        self.f.seek(0)
+        expected = self.f.read()
+
+        self.f.seek(0)
+        self.f.truncate()
+        mf = MmapFile(self.f, increment=64)
+        bs = BlockStructure(mf, block_size=16, initialize=True)
+        BlockStructureOrderedDataIO(mf, bs, blocksize=16).write(string_to_bytes(msg))
+        mf.close()
+
+        assert os.path.getsize(self.file_path) == len(expected)
+        self.reopen_file()
+        assert self.f.read() == expected
+
+    def test_zero_copy_reads(self):
+        mf = MmapFile(self.f, increment=64)
+        mbs = MultiBlockStructure(mf, initialize=True, block_size=16)
+        bs = mbs.add_structure(mf, 16)
+        io = BlockStructureOrderedDataIO(mf, bs, blocksize=16)
+        io.write(b'0123456789' * 5)
+
+        data = bs.blocks[0].read_data(mf, 2, 4)
+        assert isinstance(data, memoryview)
+        assert data == b'2345'
+        assert list(io.iterdata(12, chunk_size=4))[:2] == [b'2345', b'6789']
+        data.release()
+        mf.close()
+
+        self.reopen_file()
+        mf = MmapFile(self.f)
+        mbs = MultiBlockStructure(mf)
+        io = BlockStructureOrderedDataIO(mf, mbs.super_blocks[0])
+        assert io.read(pos=0) == b'0123456789' * 5
+        mf.close()
+
+    def test_chunks_across_blocks(self):
+        mf = MmapFile(self.f, increment=64)
+        bs = BlockStructure(mf, block_size=16, initialize=True)
+        io = BlockStructureOrderedDataIO(mf, bs, blocksize=16)
+        data = bytes(range(50))
+        io.write(data)
+
+        chunks = list(io.iterdata(0, chunk_size=5))
+        assert [bytes(x) for x in chunks] == [data[x:x + 5] for x in range(0, 50, 5)]
+        assert io.tell() == 50
+        del chunks
+        mf.close()
+
+    def test_old_maps_closed(self):
+        mf = MmapFile(self.f, increment=64)
+        for x in range(10):
+            mf.write(bytes([x]) * 64)
+        assert mf.old_maps == []
+
+        view = mf.read_at(0, 4)
+        mf.write(b'x' * 64)
+        assert len(mf.old_maps) == 1
+        view.release()
+        mf.write(b'y' * 64)
+        assert mf.old_maps == []
+        mf.close()
+        assert os.path.getsize(self.file_path) == 12 * 64
+
+    def test_close_with_views(self):
+        mf = MmapFile(self.f, increment=64)
+        mf.write(b'0123456789')
+        view = mf.read_at(2, 4)
+        with pytest.raises(PyDBValueError):
+            mf.close()
+        assert os.path.getsize(self.file_path) == 64
+        assert view == b'2345'
+
+        view.release()
+        mf.close()
+        assert os.path.getsize(self.file_path) == 10
+
+
+class TestPositionalIO(FileBasedTest):
+    def test_file_position_untouched(self):
+        self.f.close()
+        self.f = open(self.file_path, "wb+", buffering=0)
+        write_at(self.f, 10, b'abc')
+        assert self.f.tell() == 0
+        assert read_at(self.f, 9, 10) == b'\x00abc'
+        assert file_size(self.f) == 13
+        assert self.f.tell() == 0
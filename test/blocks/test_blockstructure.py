@@ -1,9 +1,13 @@
 import os
+import array
+import threading
 
 import pytest
 
 from PyDB.structure.blocks import BlockStructure, Block, MultiBlockStructure
+from PyDB.structure.blocks import BlockAllocator, MappedBlock
 from PyDB.structure.blocks import BlockStructureOrderedDataIO
+from PyDB.structure import backends
 from PyDB.utils import bytes_to_ints, bytes_to_int, int_to_bytes, string_to_bytes
 from PyDB.exceptions import PyDBIterationError, PyDBInternalError
 
@@ -91,6 +95,24 @@ class TestBlockStructure(FileBasedTest):
                 (h[2].size, h[2].next, h[2].prev, h[2].next_empty)]
         assert expected == got
 
+    def test_find_block(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        bs.add_block(self.f, 32)
+        bs.add_block(self.f, 8, after=bs.blocks[0])
+
+        assert [x.size for x in bs.blocks] == [16, 8, 32]
+        assert bs.find_block(0) == (bs.blocks[0], 0)
+        assert bs.find_block(15) == (bs.blocks[0], 15)
+        assert bs.find_block(16) == (bs.blocks[1], 0)
+        assert bs.find_block(30) == (bs.blocks[2], 6)
+        assert bs.find_block(56) == (bs.blocks[2], 32)
+        with pytest.raises(PyDBIterationError):
+            bs.find_block(57)
+
+        bs.truncate_blocks(self.f, after=bs.blocks[0])
+        with pytest.raises(PyDBIterationError):
+            bs.find_block(17)
+
     def test_bad_magic(self):
         bs = BlockStructure(self.f, block_size=16, initialize=True)
         orig = Block.MAGIC_BYTES
@@ -142,6 +164,158 @@ class TestMultiBlockStructure(FileBasedTest):
         ]
         assert expected == got
 
+    def test_read_structure(self):
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=16)
+        mbs.add_structure(self.f, 16)
+        mbs.add_structure(self.f, 16)
+        self.reopen_file()
+
+        mbs2 = MultiBlockStructure(self.f)
+        assert [x.blocks[0].start for x in mbs2.super_blocks] == [36, 72]
+
+
+class TestBlockAllocator(FileBasedTest):
+    def test_merge_extents(self):
+        allocator = BlockAllocator(self.f)
+        allocator.add_extent(100, 36)
+        allocator.add_extent(200, 36)
+        allocator.add_extent(136, 64)
+        allocator.add_extent(300, 36)
+        assert allocator.extents == [(100, 136), (300, 36)]
+
+    def test_reuse_truncated_blocks(self):
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=16)
+        bs1 = mbs.add_structure(self.f, 16)
+        io = BlockStructureOrderedDataIO(self.f, bs1, blocksize=16)
+        io.write(b'x' * 64)
+        assert [x.start for x in bs1.blocks] == [36, 72, 108, 144]
+
+        io.seek(4)
+        io.write(b'y', truncate=True)
+        assert mbs.allocator.extents == [(72, 108)]
+        end = self.f.seek(0, os.SEEK_END)
+
+        bs2 = mbs.add_structure(self.f, 16)
+        bs2.add_block(self.f, 32)
+        assert [x.start for x in bs2.blocks] == [72, 108]
+        assert [x.size for x in bs2.blocks] == [16, 52]
+        assert mbs.allocator.extents == []
+        assert self.f.seek(0, os.SEEK_END) == end
+
+    def test_persisted(self):
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=16)
+        bs1 = mbs.add_structure(self.f, 16)
+        bs1.add_block(self.f, 64)
+        bs1.add_block(self.f, 16)
+        bs1.truncate_blocks(self.f, after=bs1.blocks[0])
+        self.reopen_file()
+
+        mbs2 = MultiBlockStructure(self.f)
+        assert len(mbs2.super_blocks) == 1
+        assert mbs2.allocator.extents == [(72, 120)]
+        bs2 = mbs2.add_structure(self.f, 16)
+        assert bs2.blocks[0].start == 72
+        assert mbs2.allocator.extents == [(108, 84)]
+
+
+class TestExtentMap(FileBasedTest):
+    def create(self, blocks):
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=16)
+        mbs.add_structure(self.f, 16)
+        bs = mbs.add_structure(self.f, 16)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(bytes(range(blocks * 16)))
+        return bs
+
+    def test_small_structures_unmapped(self):
+        bs = self.create(7)
+        assert bs.extent_map.structure is None
+        self.reopen_file()
+
+        mbs = MultiBlockStructure(self.f)
+        assert [type(x) for x in mbs.super_blocks[1].blocks] == [Block] * 7
+
+    def test_open_from_map(self):
+        bs = self.create(12)
+        expected = [(x.start, x.size, False) for x in bs.blocks]
+        assert bs.extent_map.read_extents() == expected
+        self.reopen_file()
+
+        mbs = MultiBlockStructure(self.f)
+        bs2 = mbs.super_blocks[1]
+        assert [(x.start, x.size, False) for x in bs2.blocks] == expected
+        assert all(isinstance(x, MappedBlock) for x in bs2.blocks)
+        loaded = [True] + [False] * 10 + [True]
+        assert [x.header is not None for x in bs2.blocks] == loaded
+
+        # The map says which blocks are full: their headers aren't needed for
+        # the size of the data.
+        io = BlockStructureOrderedDataIO(self.f, bs2, blocksize=16)
+        assert io.size() == 12 * 16
+        assert [x.header is not None for x in bs2.blocks] == loaded
+        assert io.read(pos=0) == bytes(range(12 * 16))
+
+        io.seek(20)
+        io.write(b'x', truncate=True)
+        assert bs2.extent_map.read_extents() == [expected[0], expected[1][:2] + (True,)]
+        self.reopen_file()
+        io = BlockStructureOrderedDataIO(self.f, MultiBlockStructure(self.f).super_blocks[1])
+        assert io.size() == 21
+
+    def test_fill_levels(self):
+        bs = self.create(10)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        for pos, data, truncate in [(160, b'abc', False), (50, b'x' * 7, True),
+                (57, b'y' * 100, False), (0, b'z', False)]:
+            io.seek(pos)
+            io.write(data, truncate=truncate)
+            size = io.size()
+            self.reopen_file()
+
+            bs = MultiBlockStructure(self.f).super_blocks[1]
+            io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+            assert io.size() == size
+            blocks = bs.read_structure(self.f, bs.blocks[0].start)
+            assert size == sum(x.next_empty for x in blocks)
+
+    def test_stale_map(self):
+        bs = self.create(10)
+        extent_map, bs.extent_map = bs.extent_map, None
+        bs.add_block(self.f, 16)
+        assert len(extent_map.read_extents()) == 10
+        self.reopen_file()
+
+        mbs = MultiBlockStructure(self.f)
+        bs2 = mbs.super_blocks[1]
+        assert [x.start for x in bs2.blocks] == [x.start for x in bs.blocks]
+        assert [type(x) for x in bs2.blocks] == [Block] * 11
+        assert len(bs2.extent_map.read_extents()) == 11
+
+    def test_stale_middle_entry(self):
+        bs = self.create(10)
+        bs.extent_map = None
+        # As if the process died after linking the new block in, before
+        # the map was updated.
+        bs.add_block(self.f, 16, after=bs.blocks[4])
+        self.reopen_file()
+
+        mbs = MultiBlockStructure(self.f)
+        bs2 = mbs.super_blocks[1]
+        assert all(isinstance(x, MappedBlock) for x in bs2.blocks)
+        io = BlockStructureOrderedDataIO(self.f, bs2, blocksize=16)
+        data = bytes(range(160))
+        assert io.read(pos=0) == data
+        assert [x.start for x in bs2.blocks] == [x.start for x in bs.blocks]
+        new = bs.blocks[5].start
+        assert bs2.extent_map.read_extents() == [(x.start, x.size, x.start == new)
+                for x in bs.blocks]
+        assert io.size() == 160
+
+        self.reopen_file()
+        mbs = MultiBlockStructure(self.f)
+        io = BlockStructureOrderedDataIO(self.f, mbs.super_blocks[1], blocksize=16)
+        assert io.read(pos=0) == data
+
 
 class TestDataIterator(FileBasedTest):
     def test_basic_data_io(self):
@@ -250,6 +424,56 @@ class TestDataIterator(FileBasedTest):
         expected = msg.encode()
         assert expected == got
 
+    def test_chunked_iteration(self):
+        msg = "A very very very very long string for no reason."
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(string_to_bytes(msg))
+
+        got = list(io.iterdata(3, chunk_size=5))
+        expected = [msg[x:x+5].encode() for x in range(3, len(msg), 5)]
+        assert expected == got
+
+        it = io.iterdata(0, chunk_size=7)
+        next(it)
+        next(it)
+        next(it)
+        assert io.read(4) == msg[21:25].encode()
+
+    def test_vectored_write(self):
+        calls = []
+
+        class CountingFile(object):
+            def __init__(self, fh):
+                self.fh = fh
+
+            def writev_at(self, position, buffers):
+                calls.append((position, [len(x) for x in buffers]))
+                self.fh.seek(position)
+                for buf in buffers:
+                    self.fh.write(buf)
+
+            def __getattr__(self, name):
+                return getattr(self.fh, name)
+
+        fh = CountingFile(self.f)
+        bs = BlockStructure(fh, block_size=16, initialize=True)
+        bs.add_block(fh, 16)
+        bs.add_block(fh, 16)
+        io = BlockStructureOrderedDataIO(fh, bs, blocksize=16)
+
+        io.write(bytearray(b'0123456789'))
+        io.write(memoryview(b'abcdefghij' * 3))
+        assert calls == [
+            (0, [20, 10]),
+            (30, [6, 20, 16, 20, 8]),
+        ]
+        assert io.read(pos=0) == b'0123456789' + b'abcdefghij' * 3
+
+        io.seek(0)
+        io.write(array.array('i', [1, 2]))
+        assert io.read(pos=0)[:8] == array.array('i', [1, 2]).tobytes()
+
     def test_multiple_write(self):
         msg = "A very very very very long string for no reason."
         bs = BlockStructure(self.f, block_size=16, initialize=True)
@@ -295,3 +519,120 @@ class TestDataIterator(FileBasedTest):
         io.write(string_to_bytes(msg3))
 
         assert io.size() == len(msg[:6] + msg2 + msg3)
+
+    def test_deferred_headers(self):
+        msg = "A very very very very long string for no reason."
+        bs = BlockStructure(self.f, block_size=16, initialize=True, defer_headers=True)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(string_to_bytes(msg[:5]))
+        io.write(string_to_bytes(msg[5:]))
+        assert io.size() == len(msg)
+        self.f.flush()
+
+        # Headers that lie between the pieces of a write go out with it.
+        assert [x.next_empty for x in BlockStructure(self.f).blocks] == [5, 16, 16]
+        assert list(bs.dirty_headers) == [bs.blocks[0].start]
+
+        io.flush()
+        assert bs.dirty_headers == {}
+        self.reopen_file()
+
+        bs2 = BlockStructure(self.f)
+        assert [x.next_empty for x in bs2.blocks] == [16, 16, 16]
+        assert BlockStructureOrderedDataIO(self.f, bs2).read(pos=0) == msg.encode()
+
+
+class TestConcurrentReaders(FileBasedTest):
+    def read_in_threads(self, fh, bs, expected, writer=None):
+        io = BlockStructureOrderedDataIO(fh, bs, blocksize=16)
+        errors = []
+
+        def reader(offset):
+            cursor = io.cursor()
+            try:
+                for _ in range(50):
+                    data = cursor.read(100, pos=offset)
+                    assert data == expected[offset:offset + 100]
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader, args=(x * 37,)) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        if writer is not None:
+            writer(io)
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+    def write_data(self, fh):
+        bs = BlockStructure(fh, block_size=16, initialize=True)
+        data = bytes(range(256)) * 4
+        BlockStructureOrderedDataIO(fh, bs, blocksize=16).write(data)
+        return bs, data
+
+    def test_shared_buffered_file(self):
+        bs, data = self.write_data(self.f)
+        self.read_in_threads(self.f, bs, data)
+
+    def test_positional_io(self):
+        self.f.close()
+        self.f = open(self.file_path, "wb+", buffering=0)
+        bs, data = self.write_data(self.f)
+        self.f.seek(5)
+
+        def append(io):
+            for _ in range(20):
+                io.seek(io.size())
+                io.write(b'x' * 40)
+
+        self.read_in_threads(self.f, bs, data, writer=append)
+        assert self.f.tell() == 5
+        assert bs.data_size() == len(data) + 800
+        assert len(BlockStructure(self.f).blocks) == len(bs.blocks)
+
+    def test_unbuffered_reads_take_no_lock(self, monkeypatch):
+        self.f.close()
+        self.f = open(self.file_path, "wb+", buffering=0)
+        bs, data = self.write_data(self.f)
+
+        def no_lock(fh):
+            raise AssertionError("Unbuffered reads shouldn't lock the file.")
+        monkeypatch.setattr(backends, "file_lock", no_lock)
+        self.read_in_threads(self.f, bs, data)
+
+
+class TestIndexUpdates(FileBasedTest):
+    def test_appends_keep_old_index(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        for _ in range(3):
+            bs.add_block(self.f, 16)
+        old = bs.index
+        blocks = list(bs.blocks)
+
+        bs.add_block(self.f, 16)
+        assert old[0] is bs.blocks
+        assert old[3:] == (64, 4)
+        assert bs.index[3:] == (80, 5)
+        assert bs.find_block(80) == (bs.blocks[4], 16)
+
+        held = bs.index
+        bs.truncate_blocks(self.f, after=blocks[1])
+        assert bs.blocks == blocks[:2]
+        assert bs.index[3:] == (32, 2)
+        assert sorted(bs.positions.values()) == [0, 1]
+        # A reader that took the index before the truncate still has all of it.
+        assert len(held[0]) == len(held[1]) == 5
+        assert sorted(held[2].values()) == [0, 1, 2, 3, 4]
+
+    def test_relink_copies_positions(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        bs.add_block(self.f, 16)
+        block = bs.blocks[1]
+        positions = bs.positions
+        block.copy_to(self.f, 200)
+        bs.relink(self.f, block, 200)
+
+        assert positions == {0: 0, 36: 1}
+        assert bs.index_of(block) == 1
+        assert sorted(bs.positions) == [0, 200]
@@ -0,0 +1,92 @@
+import pytest
+
+from PyDB.structure.blocks import BlockStructure, MultiBlockStructure
+from PyDB.structure.blocks import BlockStructureOrderedDataIO
+from PyDB.structure.bufferpool import BufferPool
+from PyDB.exceptions import PyDBInternalError
+from PyDB.utils import string_to_bytes
+
+from ..base import FileBasedTest
+
+
+class TestBufferPool(FileBasedTest):
+    def teardown(self):
+        pool = BufferPool.for_file(self.f)
+        if pool is not None:
+            pool.detach()
+        super().teardown()
+
+    def test_write_back_on_flush(self):
+        msg = "A very very very very long string for no reason."
+        pool = BufferPool.attach(self.f)
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(string_to_bytes(msg))
+
+        self.f.seek(0)
+        assert self.f.read() == b''
+
+        pool.flush()
+        pool.detach()
+        self.reopen_file()
+
+        io2 = BlockStructureOrderedDataIO(self.f, BlockStructure(self.f))
+        assert io2.read(pos=0) == msg.encode()
+
+    def test_hits_and_misses(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(string_to_bytes("0123456789" * 4))
+        self.reopen_file()
+
+        pool = BufferPool.attach(self.f)
+        io = BlockStructureOrderedDataIO(self.f, BlockStructure(self.f))
+        # Opening the structure looked for the block headers in the pool.
+        assert (pool.hits, pool.misses) == (0, 3)
+        io.read(pos=0)
+        assert (pool.hits, pool.misses) == (0, 6)
+        io.read(pos=0)
+        assert (pool.hits, pool.misses) == (3, 6)
+        assert pool.peek(0, 4) is not None
+        assert (pool.hits, pool.misses) == (4, 6)
+
+    def test_evicts_least_recently_used(self):
+        pool = BufferPool.attach(self.f, capacity=64)
+        pool.pin(16, 16)
+        for start in range(0, 160, 16):
+            pool.get_page(start, 16)
+        assert list(pool.pages) == [16, 112, 128, 144]
+        assert pool.used == 64
+
+    def test_eviction(self):
+        pool = BufferPool.attach(self.f, capacity=72)
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(string_to_bytes("0123456789" * 4))
+
+        assert len(pool.pages) == 2
+        assert pool.used == 72
+        assert 0 not in pool
+
+        pool.pin(bs.blocks[1].start, 36)
+        io.read(pos=0)
+        assert bs.blocks[1].start in pool
+        pool.unpin(bs.blocks[1].start)
+        with pytest.raises(PyDBInternalError):
+            pool.unpin(bs.blocks[1].start)
+
+    def test_shared_between_structures(self):
+        pool = BufferPool.attach(self.f)
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=16)
+        bs1 = mbs.add_structure(self.f, 16)
+        bs2 = mbs.add_structure(self.f, 16)
+        bs1.add_block(self.f, 16)
+
+        assert [x.start for x in bs1.blocks] == [36, 108]
+        assert [x.start for x in bs2.blocks] == [72]
+        assert sorted(pool.pages) == [0, 36, 72, 108]
+        pool.detach()
+        self.reopen_file()
+
+        mbs2 = MultiBlockStructure(self.f)
+        assert [[y.start for y in x.blocks] for x in mbs2.super_blocks] == [[36, 108], [72]]
@@ -0,0 +1,60 @@
+from PyDB.structure.blocks import MultiBlockStructure, BlockStructureOrderedDataIO
+from PyDB.structure.compaction import Compactor
+
+from ..base import FileBasedTest
+
+
+class TestCompactor(FileBasedTest):
+    def create(self):
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=16)
+        ios = [BlockStructureOrderedDataIO(self.f, mbs.add_structure(self.f, 16),
+                blocksize=16) for _ in range(3)]
+        for x in range(10):
+            for index, io in enumerate(ios):
+                io.write(bytes([index * 16 + x]) * 16)
+        return mbs
+
+    def expected(self, index):
+        return b''.join(bytes([index * 16 + x]) * 16 for x in range(10))
+
+    def test_run(self):
+        mbs = self.create()
+        assert not any(Compactor.is_contiguous(x) for x in mbs.super_blocks)
+
+        Compactor(self.f, mbs).run()
+        assert all(Compactor.is_contiguous(x) for x in mbs.super_blocks)
+        for index, structure in enumerate(mbs.super_blocks):
+            io = BlockStructureOrderedDataIO(self.f, structure)
+            assert io.read(pos=0) == self.expected(index)
+
+        self.reopen_file()
+        mbs = MultiBlockStructure(self.f)
+        assert all(Compactor.is_contiguous(x) for x in mbs.super_blocks)
+        for index, structure in enumerate(mbs.super_blocks):
+            io = BlockStructureOrderedDataIO(self.f, structure)
+            assert io.read(pos=0) == self.expected(index)
+            assert structure.extent_map.read_extents() == \
+                    [(x.start, x.size, x.start in structure.partial)
+                    for x in structure.blocks]
+
+    def test_steps_with_reader(self):
+        mbs = self.create()
+        io = BlockStructureOrderedDataIO(self.f, mbs.super_blocks[1])
+        compactor = Compactor(self.f, mbs)
+
+        io.seek(0)
+        got = b''
+        while compactor.step():
+            got += io.read(5)
+        got += io.read()
+        assert got == self.expected(1)
+
+    def test_reuses_free_space(self):
+        mbs = self.create()
+        Compactor(self.f, mbs).run()
+        size = self.f.seek(0, 2)
+
+        io = BlockStructureOrderedDataIO(self.f, mbs.super_blocks[0], blocksize=16)
+        io.seek(io.size())
+        io.write(b'x' * 64)
+        assert self.f.seek(0, 2) == size
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from PyDB.structure.blocks import BlockStructure, CompressedBlock, MultiBlockStructure
+from PyDB.structure.blocks import BlockStructureOrderedDataIO
+from PyDB.structure.compression import compress, decompress, get_codec
+from PyDB.structure.compression import CODEC_RAW, CODEC_ZLIB, CODEC_LZMA
+from PyDB.exceptions import PyDBInternalError
+
+from ..base import FileBasedTest
+
+
+DATA = b''.join(("row %04d: the same old string;" % x).encode() for x in range(200))
+
+
+class TestCodecs(object):
+    def test_round_trip(self):
+        for codec in (CODEC_ZLIB, CODEC_LZMA):
+            payload = compress(codec, DATA)
+            assert payload[0] == codec
+            assert len(payload) < len(DATA) // 3
+            assert decompress(payload) == DATA
+
+    def test_incompressible(self):
+        data = os.urandom(100)
+        assert compress(CODEC_ZLIB, data) == bytes([CODEC_RAW]) + data
+        assert decompress(compress(CODEC_ZLIB, data)) == data
+
+    def test_get_codec(self):
+        assert get_codec("lzma") == CODEC_LZMA
+        assert get_codec(CODEC_ZLIB) == CODEC_ZLIB
+        with pytest.raises(PyDBInternalError):
+            get_codec("snappy")
+
+
+class TestCompressedStructure(FileBasedTest):
+    def test_write_and_reopen(self):
+        bs = BlockStructure(self.f, block_size=256, initialize=True, compression="lzma")
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=256)
+        io.write(DATA)
+        io.flush()
+        assert all(isinstance(x, CompressedBlock) for x in bs.blocks)
+        assert io.read(10, pos=1000) == DATA[1000:1010]
+        self.reopen_file()
+
+        bs = BlockStructure(self.f)
+        assert bs.codec == CODEC_LZMA
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=256)
+        assert io.read(pos=0) == DATA
+        io.seek(5)
+        io.write(b'hello')
+        assert io.read(pos=0) == DATA[:5] + b'hello' + DATA[10:]
+
+    def test_only_flushed_data_is_stored(self):
+        bs = BlockStructure(self.f, block_size=256, initialize=True, compression="zlib")
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=256)
+        io.write(DATA[:300])
+        assert bs.blocks[0].stored > 0
+        assert bs.blocks[1].stored == 0
+
+        io.flush()
+        self.reopen_file()
+        io = BlockStructureOrderedDataIO(self.f, BlockStructure(self.f))
+        assert io.read(pos=0) == DATA[:300]
+
+    def test_reopen_without_flush(self):
+        bs = BlockStructure(self.f, block_size=256, initialize=True, compression="zlib")
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=256)
+        io.write(DATA[:120])
+        self.reopen_file()
+        io = BlockStructureOrderedDataIO(self.f, BlockStructure(self.f))
+        assert io.size() == 0
+
+        io.write(DATA[:600])
+        io.seek(0)
+        io.write(b'x' * 10)
+        self.reopen_file()
+        # Full blocks were written back; the partial one isn't there yet.
+        io = BlockStructureOrderedDataIO(self.f, BlockStructure(self.f))
+        assert io.read(pos=0) == b'x' * 10 + DATA[10:256]
+
+    def test_full_blocks_shrink(self):
+        mbs = MultiBlockStructure(self.f, initialize=True, block_size=64)
+        plain = mbs.add_structure(self.f, 256)
+        packed = mbs.add_structure(self.f, 256, compression="zlib")
+        for bs in (plain, packed):
+            io = BlockStructureOrderedDataIO(self.f, bs, blocksize=256)
+            for pos in range(0, len(DATA), 100):
+                io.write(DATA[pos:pos + 100])
+            io.flush()
+
+        plain_size = sum(x.get_total_size() for x in plain.blocks)
+        packed_size = sum(x.get_total_size() for x in packed.blocks)
+        assert packed_size * 2 < plain_size
+        assert packed.extent_map is None
+        self.reopen_file()
+
+        mbs = MultiBlockStructure(self.f)
+        for bs in mbs.super_blocks:
+            assert BlockStructureOrderedDataIO(self.f, bs).read(pos=0) == DATA
@@ -0,0 +1,37 @@
+from PyDB.structure.blocks import BlockStructure, BlockStructureOrderedDataIO
+from PyDB.structure.growth import FixedGrowth, GeometricGrowth, WriteSizeGrowth
+
+from ..base import FileBasedTest
+
+
+class TestGrowth(FileBasedTest):
+    def test_fixed(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True,
+                growth=FixedGrowth(32))
+        io = BlockStructureOrderedDataIO(self.f, bs, blocksize=16)
+        io.write(b'x' * 100)
+        assert [x.size for x in bs.blocks] == [16, 32, 32, 32]
+
+    def test_geometric(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True,
+                growth=GeometricGrowth(16, max_block_size=128))
+        io = BlockStructureOrderedDataIO(self.f, bs)
+        io.write(b'x' * 500)
+        assert [x.size for x in bs.blocks] == [16, 32, 64, 128, 128, 128, 128]
+
+        self.reopen_file()
+        bs2 = BlockStructure(self.f)
+        assert [x.size for x in bs2.blocks] == [16, 32, 64, 128, 128, 128, 128]
+        assert BlockStructureOrderedDataIO(self.f, bs2).read(pos=0) == b'x' * 500
+
+    def test_write_size(self):
+        bs = BlockStructure(self.f, block_size=16, initialize=True,
+                growth=WriteSizeGrowth(16, history=4))
+        io = BlockStructureOrderedDataIO(self.f, bs)
+        for _ in range(3):
+            io.write(b'x' * 10)
+        assert [x.size for x in bs.blocks] == [16, 32]
+
+        io.write(b'y' * 100)
+        assert [x.size for x in bs.blocks] == [16, 32, 144]
+        assert bs.add_block(self.f).size == 144
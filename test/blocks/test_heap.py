@@ -0,0 +1,65 @@
+import pytest
+
+from PyDB.structure.blocks import BlockStructure
+from PyDB.structure.heap import HeapFile, RowId
+from PyDB.exceptions import PyDBValueError
+
+from ..base import FileBasedTest
+
+
+class TestHeapFile(FileBasedTest):
+    def setup(self):
+        super().setup()
+        self.structure = BlockStructure(self.f, block_size=128, initialize=True)
+        self.heap = HeapFile(self.f, self.structure)
+
+    def reopen(self):
+        self.reopen_file()
+        self.structure = BlockStructure(self.f)
+        self.heap = HeapFile(self.f, self.structure)
+
+    def test_insert_get(self):
+        rows = [("row %d" % x).encode() * (x % 5 + 1) for x in range(40)]
+        rowids = [self.heap.insert(x) for x in rows]
+        assert rowids[0] == RowId(0, 0)
+        assert len(self.structure.blocks) > 1
+        assert [self.heap.get(x) for x in rowids] == rows
+
+        self.reopen()
+        assert [self.heap.get(x) for x in rowids] == rows
+        assert [x for _, x in self.heap.rows()] == [self.heap.get(x)
+                for x, _ in self.heap.rows()]
+        assert sorted(x for x, _ in self.heap.rows()) == sorted(rowids)
+
+    def test_update_delete(self):
+        rowids = [self.heap.insert(str(x).encode() * 10) for x in range(5)]
+        self.heap.update(rowids[1], b"short")
+        self.heap.update(rowids[2], b"x" * 30)
+        self.heap.delete(rowids[3])
+        assert self.heap.get(rowids[1]) == b"short"
+        assert self.heap.get(rowids[2]) == b"x" * 30
+        assert self.heap.get(rowids[4]) == b"4" * 10
+        with pytest.raises(PyDBValueError):
+            self.heap.get(rowids[3])
+
+        # The slot is reused, so the other row ids stay as they were.
+        assert self.heap.insert(b"new") == rowids[3]
+        with pytest.raises(PyDBValueError):
+            self.heap.update(rowids[0], b"y" * 200)
+
+    def test_free_space_map(self):
+        first = self.heap.insert(b"a" * 80)
+        second = self.heap.insert(b"b" * 80)
+        assert second.page != first.page
+        # The best fit for a small row is the first page.
+        assert self.heap.insert(b"c" * 10).page == first.page
+
+        self.reopen()
+        assert self.heap.insert(b"d" * 6).page == first.page
+        big = self.heap.insert(b"e" * 500)
+        assert self.heap.get(big) == b"e" * 500
+
+    def test_invalid_row_ids(self):
+        for rowid in (RowId(5, 0), RowId(-1, 0), RowId(0, 3)):
+            with pytest.raises(PyDBValueError):
+                self.heap.get(rowid)
@@ -0,0 +1,35 @@
+from PyDB.structure import readahead
+from PyDB.structure.blocks import BlockStructure, BlockStructureOrderedDataIO
+
+from ..base import FileBasedTest
+
+
+class TestReadAhead(FileBasedTest):
+    def setup(self):
+        super().setup()
+        bs = BlockStructure(self.f, block_size=16, initialize=True)
+        BlockStructureOrderedDataIO(self.f, bs, blocksize=16).write(bytes(320))
+        self.io = BlockStructureOrderedDataIO(self.f, bs, read_ahead=True)
+
+    def record_hints(self, monkeypatch):
+        hints = []
+        monkeypatch.setattr(readahead, 'will_need',
+                lambda fh, pos, size: hints.append((pos, size)))
+        return hints
+
+    def test_sequential_scan(self, monkeypatch):
+        hints = self.record_hints(monkeypatch)
+        assert len(self.io.read(pos=0)) == 320
+        assert hints == [(72, 144), (216, 216), (432, 288)]
+
+    def test_random_access(self, monkeypatch):
+        hints = self.record_hints(monkeypatch)
+        for pos in (160, 48, 300, 0, 200, 100):
+            self.io.read(4, pos=pos)
+        assert hints == []
+
+    def test_cursor(self):
+        assert self.io.cursor().read_ahead is not None
+        assert self.io.cursor(read_ahead=False).read_ahead is None
+        # Real hints don't change what's read.
+        assert self.io.cursor().read(pos=0) == bytes(320)
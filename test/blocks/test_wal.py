@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+
+import pytest
+
+from PyDB.structure.blocks import BlockStructure, MultiBlockStructure
+from PyDB.structure.blocks import BlockStructureOrderedDataIO
+from PyDB.structure.wal import WriteAheadLog
+from PyDB.exceptions import PyDBInternalError
+
+from ..base import FileBasedTest
+
+
+class TestWriteAheadLog(FileBasedTest):
+    log_path = "/tmp/block.test-wal"
+
+    def setup(self):
+        super().setup()
+        self.log = open(self.log_path, "wb+")
+
+    def teardown(self):
+        self.log.close()
+        os.unlink(self.log_path)
+        super().teardown()
+
+    def crash(self, wal):
+        wal.closed = True
+        wal.wakeup.set()
+        wal.worker.join()
+
+    def test_commit_and_checkpoint(self):
+        wal = WriteAheadLog(self.f, self.log)
+        bs = BlockStructure(wal, block_size=16, initialize=True)
+        io = BlockStructureOrderedDataIO(wal, bs, blocksize=16)
+        log_size = os.path.getsize(self.log_path)
+        with wal.transaction():
+            io.write(b'0123456789' * 4)
+            assert io.read(pos=0) == b'0123456789' * 4
+            assert os.path.getsize(self.log_path) == log_size
+
+        assert os.path.getsize(self.log_path) > log_size
+        assert os.path.getsize(self.file_path) == 0
+        assert io.read(pos=0) == b'0123456789' * 4
+
+        wal.close()
+        assert os.path.getsize(self.log_path) == 0
+        self.reopen_file()
+        io = BlockStructureOrderedDataIO(self.f, BlockStructure(self.f))
+        assert io.read(pos=0) == b'0123456789' * 4
+
+    def test_rollback(self):
+        wal = WriteAheadLog(self.f, self.log)
+        mbs = MultiBlockStructure(wal, initialize=True, block_size=16)
+        with pytest.raises(ValueError):
+            with wal.transaction():
+                mbs.add_structure(wal, 16)
+                raise ValueError()
+        # The space stays claimed, but nothing was committed.
+        assert wal.length == 36
+        assert mbs.super_blocks == []
+
+        structure = mbs.add_structure(wal, 16)
+        io = BlockStructureOrderedDataIO(wal, structure, blocksize=16)
+        io.write(b'a' * 10)
+        wal.flush()
+        with pytest.raises(ValueError):
+            with wal.transaction():
+                io.write(b'b' * 30)
+                mbs.add_structure(wal, 16)
+                raise ValueError()
+        assert mbs.super_blocks == [structure]
+        assert len(structure.blocks) == 1
+        assert BlockStructureOrderedDataIO(wal, structure).read(pos=0) == b'a' * 10
+
+        mbs.add_structure(wal, 16)
+        wal.close()
+        self.reopen_file()
+        mbs = MultiBlockStructure(self.f)
+        # Both go after the space claimed by the rolled back transactions.
+        assert [x.blocks[0].start for x in mbs.super_blocks] == [72, 216]
+        io = BlockStructureOrderedDataIO(self.f, mbs.super_blocks[0])
+        assert io.read(pos=0) == b'a' * 10
+
+    def test_recovery(self):
+        wal = WriteAheadLog(self.f, self.log, durability=WriteAheadLog.DURABILITY_OFF)
+        mbs = MultiBlockStructure(wal, initialize=True, block_size=16)
+        mbs.add_structure(wal, 16)
+        with wal.transaction():
+            mbs.add_structure(wal, 16)
+        wal.write_at(0, b'uncommitted')
+        self.crash(wal)
+
+        self.log.seek(0, os.SEEK_END)
+        self.log.write(b'\x57\x41\x4c\x42\x00\x00\x00\x10torn')
+        self.log.flush()
+        assert os.path.getsize(self.file_path) == 0
+
+        wal = WriteAheadLog(self.f, self.log)
+        assert os.path.getsize(self.log_path) == 0
+        self.crash(wal)
+
+        self.reopen_file()
+        mbs = MultiBlockStructure(self.f)
+        assert [x.blocks[0].start for x in mbs.super_blocks] == [36, 72]
+
+    def test_concurrent_structures(self):
+        wal = WriteAheadLog(self.f, self.log)
+        mbs = MultiBlockStructure(wal, initialize=True, block_size=16)
+        added = threading.Event()
+        counts = []
+
+        def first():
+            with wal.transaction():
+                io = BlockStructureOrderedDataIO(wal, mbs.add_structure(wal, 16))
+                io.write(b'a' * 40)
+                added.set()
+                # The other transaction waits for this one to end.
+                time.sleep(0.05)
+                counts.append(len(mbs.super_blocks))
+
+        def second():
+            added.wait()
+            with wal.transaction():
+                io = BlockStructureOrderedDataIO(wal, mbs.add_structure(wal, 16))
+                io.write(b'b' * 40)
+
+        threads = [threading.Thread(target=x) for x in (first, second)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert counts == [1]
+
+        # Space written past the end is claimed before it is committed.
+        with wal.transaction():
+            wal.write_at(wal.size(), b'c' * 10)
+            size = wal.size()
+            thread = threading.Thread(target=lambda: wal.write_at(wal.size(), b'd'))
+            thread.start()
+            thread.join()
+        assert wal.size() == size + 1
+        wal.close()
+
+        self.reopen_file()
+        mbs = MultiBlockStructure(self.f)
+        assert [BlockStructureOrderedDataIO(self.f, x).read(pos=0)
+                for x in mbs.super_blocks] == [b'a' * 40, b'b' * 40]
+
+    def test_group_commit(self):
+        wal = WriteAheadLog(self.f, self.log)
+
+        def worker(index):
+            for x in range(20):
+                with wal.transaction():
+                    wal.write_at((index * 20 + x) * 4, bytes([index]) * 4)
+
+        threads = [threading.Thread(target=worker, args=(x,)) for x in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert wal.read_at(0, 640) == b''.join(bytes([x]) * 80 for x in range(8))
+        wal.close()
+
+    def test_commit_during_checkpoint(self):
+        started = threading.Event()
+        resume = threading.Event()
+
+        class SlowFile(object):
+            # Stops checkpoints at the fsync of the pages they wrote.
+            def __init__(self, fh):
+                self.fh = fh
+                self.slow = False
+
+            def __getattr__(self, name):
+                return getattr(self.fh, name)
+
+            def fileno(self):
+                if self.slow:
+                    started.set()
+                    resume.wait()
+                return self.fh.fileno()
+
+        fh = SlowFile(self.f)
+        wal = WriteAheadLog(fh, self.log)
+        with wal.transaction():
+            wal.write_at(0, b'a' * 10)
+            wal.write_at(9000, b'd' * 10)
+
+        fh.slow = True
+        thread = threading.Thread(target=wal.checkpoint)
+        thread.start()
+        started.wait()
+        with wal.transaction():
+            wal.write_at(0, b'c')
+            wal.write_at(5000, b'b' * 10)
+        assert wal.read_at(0, 3) == b'caa'
+        resume.set()
+        thread.join()
+        fh.slow = False
+
+        assert sorted(wal.pages) == [0, 1]
+        assert os.path.getsize(self.log_path) > 0
+        wal.close()
+        assert os.path.getsize(self.log_path) == 0
+        self.reopen_file()
+        assert self.f.read(3) == b'caa'
+        self.f.seek(5000)
+        assert self.f.read(10) == b'b' * 10
+
+    def test_bad_durability(self):
+        with pytest.raises(PyDBInternalError):
+            WriteAheadLog(self.f, self.log, durability="sometimes")
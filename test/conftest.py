@@ -0,0 +1,7 @@
+import sys
+
+collect_ignore = []
+
+# The async modules use asyncio.run() and get_running_loop(), new in 3.7.
+if sys.version_info < (3, 7):
+    collect_ignore += ["blocks/test_aio.py", "store/test_aio.py"]
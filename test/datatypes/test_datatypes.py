@@ -3,6 +3,7 @@ import pytest
 from PyDB.datatypes import IntegerType, StringType
 from PyDB.datatypes import TypeHeader
 from PyDB.exceptions import PyDBTypeError, PyDBValueError, PyDBTypeConstraintError
+from PyDB.exceptions import PyDBInternalError
 from PyDB.utils import int_to_bytes, bytes_to_int, bytes_to_gen
 
 
@@ -16,6 +17,12 @@ class TestTypeHeader(object):
         assert th.null == 0
         assert th.size == 1203
 
+    def test_decode_from(self):
+        th, offset = TypeHeader.decode_from(memoryview(b'xx\x01\x00\x00\x04\xB3'), 2)
+        assert (th.null, th.size, offset) == (1, 1203, 7)
+        with pytest.raises(PyDBInternalError):
+            TypeHeader.decode_from(b'\x01\x00\x00', 0)
+
 
 class TestGenericType(object):
     def test_check_value(self):
@@ -92,6 +99,42 @@ class TestIntegerType(object):
         assert IntegerType().decode(barr) is None
 
 
+class TestVarintEncoding(object):
+    def test_encode(self):
+        it = IntegerType(encoding="varint")
+        assert it.encode(None) == b'\x00'
+        assert it.encode(0) == b'\x01'
+        assert it.encode(-1) == b'\x02'
+        assert it.encode(1) == b'\x03'
+        assert it.encode(63) == b'\x7f'
+        assert it.encode(-64) == b'\x80\x01'
+
+    def test_round_trip(self):
+        it = IntegerType(encoding="varint")
+        values = [None, 0, 1, -1, 200, -200, 2**31 - 1, -2**31]
+        buf = bytearray()
+        for val in values:
+            it.encode_into(buf, val)
+        assert len(buf) < 5 * len(values)
+
+        offset = 0
+        for val in values:
+            res, offset = it.decode_from(buf, offset)
+            assert res == val
+        assert offset == len(buf)
+        assert it.decode(bytes_to_gen(it.encode(-200))) == -200
+
+    def test_bounds(self):
+        with pytest.raises(OverflowError):
+            IntegerType(size=2, encoding="varint").encode(2**15)
+        assert len(IntegerType(size=8, encoding="varint").encode(-2**63)) == 10
+        assert IntegerType(size=8, encoding="varint").get_max_size() == 10
+        with pytest.raises(PyDBInternalError):
+            IntegerType(encoding="varint").decode_from(b'\x80\x80')
+        with pytest.raises(PyDBValueError):
+            IntegerType(encoding="zigzag")
+
+
 class TestStringType(object):
     def test_encode(self):
         res = StringType(16).encode("test everything.")
@@ -109,6 +152,19 @@ class TestStringType(object):
         barr = bytes_to_gen(b'\x01\x00\x00\x00\x00')
         assert StringType(16).decode(barr) is None
 
+    def test_encode_into_decode_from(self):
+        buf = bytearray(b'head')
+        StringType(16).encode_into(buf, "test func")
+        StringType(16).encode_into(buf, None)
+        IntegerType(size=2).encode_into(buf, -3)
+
+        view = memoryview(buf)
+        assert StringType(16).decode_from(view, 4) == ('test func', 18)
+        assert StringType(16).decode_from(view, 18) == (None, 23)
+        assert IntegerType(size=2).decode_from(view, 23) == (-3, 30)
+        with pytest.raises(PyDBInternalError):
+            StringType(16).decode_from(view[:10], 4)
+
     def test_constraint(self):
         with pytest.raises(PyDBTypeConstraintError) as ex:
             StringType(16).check_value("This is a rather long string.")
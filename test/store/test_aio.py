@@ -0,0 +1,124 @@
+import asyncio
+
+from PyDB.datatypes import IntegerType, StringType
+from PyDB.exceptions import PyDBTypeError
+from PyDB.store.record import Record, RecordStore
+from PyDB.store.aio import AsyncRecordStore
+
+from ..base import BlockStructureBasedTest
+
+
+class Person(Record):
+    name = StringType(50)
+    age = IntegerType(required=True)
+
+
+class UnboundedString(StringType):
+    def get_max_size(self):
+        return None
+
+
+class Note(Record):
+    n = IntegerType()
+    text = UnboundedString(1000)
+
+
+class TestAsyncRecordStore(BlockStructureBasedTest):
+    def setup(self):
+        super().setup()
+        self.store = AsyncRecordStore(RecordStore(self.io, Person))
+
+    def teardown(self):
+        self.store.close()
+        super().teardown()
+
+    def test_add_and_get(self):
+        people = [Person(name="p" * x, age=x) for x in range(20)]
+
+        async def main():
+            positions = await asyncio.gather(*[self.store.add_record(x) for x in people])
+            records = await asyncio.gather(*[self.store.get_record(x)
+                    for x in reversed(positions)])
+            return positions, records
+
+        positions, records = asyncio.run(main())
+        assert positions == sorted(positions)
+        assert records == people[::-1]
+
+    def test_errors_are_per_call(self):
+        async def main():
+            return await asyncio.gather(self.store.add_record(Person(name="x", age=1)),
+                    self.store.add_record(Person(name=2, age=2)),
+                    return_exceptions=True)
+
+        pos, error = asyncio.run(main())
+        assert pos == 0
+        assert isinstance(error, PyDBTypeError)
+
+    def test_get_records_reads_once(self):
+        store = AsyncRecordStore(RecordStore(self.io, Person,
+                row_format=RecordStore.ROW_FORMAT_FIXED))
+        people = [Person(name=str(x), age=x) for x in range(10)]
+        positions = store.add_records(people)
+        reads = []
+        cursor = self.io.cursor
+        def counting_cursor():
+            res = cursor()
+            read = res.read
+            res.read = lambda size, pos: reads.append((pos, size)) or read(size, pos)
+            return res
+        self.io.cursor = counting_cursor
+
+        picked = [positions[x] for x in (5, 1, 2, 3, 9)]
+        width = positions[1]
+        res = store.get_records(picked + [20 * width])
+        store.close()
+        assert res[:5] == [people[x] for x in (5, 1, 2, 3, 9)]
+        assert reads == [(width, 3 * width), (5 * width, width), (9 * width, width),
+                (20 * width, width)]
+        assert isinstance(res[5], Exception)
+
+    def test_get_unbounded_records(self):
+        store = AsyncRecordStore(RecordStore(self.io, Note))
+        store.store.codec.READ_SIZE = 64
+        notes = [Note(n=x, text="t" * (x % 4 * 40)) for x in range(40)]
+        positions = store.add_records(notes)
+        reads = []
+        cursor = self.io.cursor
+        def counting_cursor():
+            res = cursor()
+            read = res.read
+            res.read = lambda size, pos=-1: reads.append(size) or read(size, pos)
+            return res
+        self.io.cursor = counting_cursor
+
+        picked = [3, 0, 1, 20]
+        res = store.get_records([positions[x] for x in picked])
+        store.close()
+        assert res == [notes[x] for x in picked]
+        # Rows 0 and 1 share a read. Row 3 doesn't fit in its 64 bytes, so it is
+        # read again on its own, in growing chunks.
+        assert reads == [78, 64, 64, 128, 64]
+
+    def test_add_records_writes_once(self):
+        writes = []
+        write = self.io.write
+        self.io.write = lambda data: writes.append(len(data)) or write(data)
+        people = [Person(name=str(x), age=x) for x in range(10)]
+
+        async def main():
+            return await asyncio.gather(*[self.store.add_record(x) for x in people])
+
+        positions = asyncio.run(main())
+        assert len(writes) == 1
+        assert [self.store.store.get_record(x) for x in positions] == people
+
+    def test_scan(self):
+        people = [Person(name=str(x), age=x) for x in range(50)]
+        for person in people:
+            self.store.store.add_record(person)
+
+        async def main():
+            return [x async for x in self.store.scan(batch_size=7)]
+
+        assert asyncio.run(main()) == people
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from PyDB.datatypes import IntegerType, StringType
+from PyDB.exceptions import PyDBUniqueKeyViolation, PyDBKeyNotFoundError
+from PyDB.exceptions import PyDBValueError
+from PyDB.structure.blocks import MultiBlockStructure
+from PyDB.store.btree import BTreeIndex
+
+from ..base import FileBasedTest
+
+
+class TestBTreeIndex(FileBasedTest):
+    def setup(self):
+        super().setup()
+        self.mbs = MultiBlockStructure(self.f, initialize=True, block_size=64)
+        self.index = BTreeIndex.create(self.f, self.mbs, IntegerType(), page_size=128)
+
+    def reopen(self):
+        self.reopen_file()
+        self.mbs = MultiBlockStructure(self.f)
+        self.index = BTreeIndex(self.f, self.mbs.super_blocks[0], IntegerType())
+
+    def depth(self):
+        depth, node = 1, self.index.read_node(BTreeIndex.ROOT)
+        while not node.is_leaf():
+            depth, node = depth + 1, self.index.read_node(node.values[0])
+        return depth
+
+    def test_insert_get(self):
+        keys = list(range(0, 3000, 3))
+        random.Random(4).shuffle(keys)
+        for key in keys:
+            self.index.insert(key, key * 10)
+        assert self.depth() >= 3
+
+        self.reopen()
+        assert all(self.index.get(x) == x * 10 for x in keys)
+        assert 4 not in self.index
+        with pytest.raises(PyDBKeyNotFoundError):
+            self.index.get(4)
+        with pytest.raises(PyDBUniqueKeyViolation):
+            self.index.insert(300, 1)
+
+    def test_point_lookup_reads(self, monkeypatch):
+        for key in range(1000):
+            self.index.insert(key, key)
+        depth = self.depth()
+        reads = []
+        read_node = self.index.read_node
+        monkeypatch.setattr(self.index, "read_node", lambda x: reads.append(x) or read_node(x))
+        assert self.index.get(567) == 567
+        assert len(reads) == depth <= 4
+
+    def test_range(self):
+        for key in range(500, 0, -1):
+            self.index.insert(key, -key)
+        assert list(self.index.range(100, 105)) == [(x, -x) for x in range(100, 105)]
+        assert [x for x, _ in self.index.range()] == list(range(1, 501))
+        assert [x for x, _ in self.index.range(start=498)] == [498, 499, 500]
+
+        self.index.remove(101)
+        with pytest.raises(PyDBKeyNotFoundError):
+            self.index.remove(101)
+        assert [x for x, _ in self.index.range(100, 104)] == [100, 102, 103]
+
+    def test_bulk_load(self):
+        self.index.bulk_load((x, x + 1) for x in range(0, 4000, 2))
+        leaf = self.index.read_node(self.index.find_leaf(0)[0])
+        # Full leaves: one more entry wouldn't fit.
+        assert len(self.index.encode_node(leaf)) + 9 + 8 > 128
+
+        self.reopen()
+        assert self.index.get(1234) == 1235
+        assert [x for x, _ in self.index.range(10, 20)] == [10, 12, 14, 16, 18]
+        assert len(list(self.index.range())) == 2000
+        self.index.insert(1235, 0)
+        assert [x for x, _ in self.index.range(1232, 1238)] == [1232, 1234, 1235, 1236]
+
+        with pytest.raises(PyDBValueError):
+            self.index.bulk_load([(1, 1)])
+
+    def test_bulk_load_order(self):
+        with pytest.raises(PyDBValueError):
+            self.index.bulk_load([(1, 1), (3, 3), (2, 2)])
+
+    def test_string_keys(self):
+        index = BTreeIndex.create(self.f, self.mbs, StringType(20), page_size=128)
+        words = ["key%04d" % x for x in range(300)]
+        for word in reversed(words):
+            index.insert(word, len(word))
+        assert [x for x, _ in index.range("key0100", "key0103")] == words[100:103]
@@ -0,0 +1,182 @@
+import pytest
+
+from PyDB.datatypes import IntegerType, StringType, GenericType
+from PyDB.store import Record
+from PyDB.store.codec import RecordCodec, IntegerRun, StringColumn, Column
+from PyDB.store.codec import FixedRowCodec, CompactRowCodec
+from PyDB.exceptions import PyDBValueError, PyDBInternalError
+
+
+class OddInteger(IntegerType):
+    pass
+
+
+class UnboundedString(StringType):
+    def get_max_size(self):
+        return None
+
+
+class Note(Record):
+    n = IntegerType()
+    text = UnboundedString(1000)
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.reads = []
+
+    def read(self, size, pos=-1):
+        if pos >= 0:
+            self.pos = pos
+        self.reads.append(size)
+        res = self.data[self.pos:self.pos + size]
+        self.pos += len(res)
+        return res
+
+
+class Row(Record):
+    a = IntegerType()
+    b = IntegerType(size=8)
+    c = StringType(10)
+    d = IntegerType(size=3)
+    e = OddInteger(size=2)
+    f = IntegerType(size=2)
+
+
+class TestRecordCodec(object):
+    def test_compiled_steps(self):
+        codec = RecordCodec.for_class(Row)
+        assert RecordCodec.for_class(Row) is codec
+        assert [type(x) for x in codec.steps] == [IntegerRun, StringColumn, Column,
+                Column, IntegerRun]
+        assert codec.steps[0].names == ['a', 'b']
+        assert codec.max_size == 59
+
+    def test_same_format_as_types(self):
+        codec = RecordCodec.for_class(Row)
+        for values in [dict(a=1, b=-2, c="xyz", d=4, e=5, f=6),
+                dict(a=None, b=2**40, c=None, d=None, e=None, f=-7),
+                dict(a=3)]:
+            expected = b''.join(col_type.encode(values.get(name))
+                    for name, col_type in Row._get_columns())
+            assert codec.encode(values) == expected
+
+            data = b'junk' + expected + b'more junk'
+            decoded, end = codec.decode_from(memoryview(data), 4)
+            assert end == 4 + len(expected)
+            assert decoded == {x: values.get(x) for x in "abcdef"}
+
+    def test_out_of_range(self):
+        with pytest.raises(OverflowError):
+            RecordCodec.for_class(Row).encode(dict(a=2**40))
+
+    def test_varint_columns(self):
+        class Counters(Record):
+            x = IntegerType(encoding="varint")
+            y = IntegerType()
+            z = IntegerType(size=8, encoding="varint")
+
+        codec = RecordCodec.for_class(Counters)
+        assert [type(x) for x in codec.steps] == [Column, IntegerRun, Column]
+        assert codec.max_size == 5 + 9 + 10
+        data = codec.encode(dict(x=3, y=7, z=None))
+        assert len(data) == 1 + 9 + 1
+        assert codec.decode_from(data) == (dict(x=3, y=7, z=None), 11)
+
+    def test_max_size(self):
+        class Small(Record):
+            x = IntegerType(size=2)
+            y = StringType(20)
+        assert RecordCodec.for_class(Small).max_size == 7 + 25
+
+
+    def test_read_from_unbounded(self):
+        codec = RecordCodec(Note._get_columns())
+        codec.READ_SIZE = 64
+        assert codec.max_size is None
+        rows = [bytes(codec.encode(dict(n=x, text="t" * (x * 50)))) for x in range(20)]
+        data = b''.join(rows) * 10
+        pos = sum(len(x) for x in rows[:19])
+
+        reader = Reader(data)
+        assert codec.read_from(reader, 0) == (dict(n=0, text=""), len(rows[0]))
+        assert reader.reads == [64]
+
+        # Rows that go past the first read are read in growing chunks, not to
+        # the end of the data.
+        reader = Reader(data)
+        values, end = codec.read_from(reader, pos)
+        assert values == dict(n=19, text="t" * 950)
+        assert end == pos + len(rows[19])
+        assert reader.reads == [64, 128, 256, 512, 1024]
+
+        with pytest.raises(PyDBInternalError):
+            codec.read_from(Reader(data[:pos + 500]), pos)
+
+
+class TestFixedRowCodec(object):
+    def test_layout(self):
+        codec = FixedRowCodec.for_class(Row)
+        assert codec.max_size == 1 + 4 + 8 + (1 + 10) + 3 + 2 + 2
+
+        data = codec.encode(dict(a=1, b=None, c="xyz", d=-4, e=None, f=6))
+        assert len(data) == codec.max_size
+        assert data[0] == 0b10010
+        assert data[13:17] == b'\x03xyz'
+        values, end = codec.decode_from(b'..' + data, 2)
+        assert values == dict(a=1, b=None, c="xyz", d=-4, e=None, f=6)
+        assert end == 2 + codec.max_size
+
+    def test_errors(self):
+        codec = FixedRowCodec.for_class(Row)
+        with pytest.raises(OverflowError):
+            codec.encode(dict(f=2**20))
+        with pytest.raises(PyDBValueError):
+            codec.encode(dict(c="\u00e9" * 6))
+
+        class Unbounded(Record):
+            x = GenericType()
+        with pytest.raises(PyDBValueError):
+            FixedRowCodec.for_class(Unbounded)
+
+
+class TestCompactRowCodec(object):
+    def test_layout(self):
+        codec = CompactRowCodec.for_class(Row)
+        assert codec.max_size == 1 + 4 + 8 + (1 + 10) + 3 + 2 + 2
+
+        data = codec.encode(dict(a=1, b=None, c="xyz", d=-4, e=None, f=6))
+        assert len(data) == 1 + 4 + 4 + 3 + 2
+        assert data[0] == 0b10010
+        assert data[5:9] == b'\x03xyz'
+        values, end = codec.decode_from(b'..' + data, 2)
+        assert values == dict(a=1, b=None, c="xyz", d=-4, e=None, f=6)
+        assert end == 2 + len(data)
+
+    def test_smaller_than_variable(self):
+        values = dict(a=1, b=2, c="xyz", d=None, e=None, f=3)
+        compact = CompactRowCodec.for_class(Row).encode(values)
+        variable = RecordCodec.for_class(Row).encode(values)
+        assert len(compact) < len(variable) // 2
+
+    def test_long_values(self):
+        class Long(Record):
+            x = StringType(1000)
+            y = IntegerType(encoding=IntegerType.ENCODING_VARINT)
+        codec = CompactRowCodec.for_class(Long)
+        assert codec.max_size == 1 + (2 + 1000) + 5
+
+        data = codec.encode(dict(x="ab" * 150, y=-3))
+        assert len(data) == 1 + 2 + 300 + 1
+        assert codec.decode_from(data) == (dict(x="ab" * 150, y=-3), len(data))
+
+
+def test_projection():
+    values = dict(a=1, b=None, c="xyz", d=-4, e=None, f=6)
+    for codec in (RecordCodec.for_class(Row), FixedRowCodec.for_class(Row),
+            CompactRowCodec.for_class(Row)):
+        data = codec.encode(values)
+        assert codec.decode_from(data, 0, {"b", "c", "f"}) == (
+                dict(b=None, c="xyz", f=6), len(data))
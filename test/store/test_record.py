@@ -1,11 +1,17 @@
+import io
+
 import pytest
 
 from PyDB.exceptions import PyDBMetadataError, PyDBValueError
 from PyDB.datatypes import IntegerType, StringType
-from PyDB.exceptions import PyDBTypeError
-from PyDB.store import Record
+from PyDB.exceptions import PyDBTypeError, PyDBIterationError
+from PyDB.exceptions import PyDBUniqueKeyViolation, PyDBKeyNotFoundError
+from PyDB.structure.blocks import MultiBlockStructure, BlockStructureOrderedDataIO
+from PyDB.structure.blocks import BlockStructure
+from PyDB.store import Record, TableMetadata
+from PyDB.store.record import RecordStore
 
-from ..base import BlockStructureBasedTest
+from ..base import FileBasedTest, BlockStructureBasedTest
 
 class TempTable(Record):
     record_no = IntegerType(primary_key=True)
@@ -70,3 +76,178 @@ class TestRecord(BlockStructureBasedTest):
             t._decode_obj(self.io)
         assert objs == got
 
+
+
+class TestFixedWidthRows(BlockStructureBasedTest):
+    def test_get_row(self):
+        store = RecordStore(self.io, TempTable, row_format=RecordStore.ROW_FORMAT_FIXED)
+        objs = [TempTable(record_no=x, first_name="f" * x, last_name=None,
+                ssn=x * 3 if x % 2 else None, age=x) for x in range(40)]
+        positions = [store.add_record(x) for x in objs]
+
+        assert store.row_width == 1 + 4 * 3 + 2 * (1 + 50)
+        assert positions == [x * store.row_width for x in range(40)]
+        assert store.row_count() == 40
+        assert store.get_row(17) == objs[17]
+        assert store.get_record(positions[3]) == objs[3]
+        assert store.get_rows(10, 25) == objs[10:25]
+
+        with pytest.raises(PyDBIterationError):
+            store.get_row(40)
+
+    def test_add_records(self):
+        store = RecordStore(self.io, TempTable, row_format=RecordStore.ROW_FORMAT_FIXED)
+        objs = [TempTable(record_no=x, first_name="f", age=x) for x in range(25)]
+        positions = store.add_records(objs, batch_size=10)
+        assert positions == [x * store.row_width for x in range(25)]
+        assert store.get_rows(0, 25) == objs
+
+        with pytest.raises(PyDBValueError):
+            store.add_records([TempTable(record_no=99, age=1), TempTable(record_no=98)])
+        assert store.row_count() == 25
+
+    def test_variable_rows_have_no_numbers(self):
+        store = RecordStore(self.io, TempTable)
+        with pytest.raises(PyDBValueError):
+            store.get_row(0)
+
+
+class TestCompactRows(BlockStructureBasedTest):
+    def test_read_write(self):
+        metadata = TableMetadata(TempTable, format_version=TableMetadata.FORMAT_COMPACT)
+        store = RecordStore.from_metadata(self.io, TempTable, metadata)
+        objs = [TempTable(record_no=x, first_name="f" * x, last_name=None,
+                ssn=None, age=x) for x in range(20)]
+        positions = [store.add_record(x) for x in objs]
+
+        assert positions[1] - positions[0] == 1 + 4 + 1 + 4
+        assert [store.get_record(x) for x in positions] == objs
+
+
+class TestCompiledRecord(object):
+    def test_slots(self):
+        obj = TempTable(record_no=1, age=3)
+        assert not hasattr(obj, '__dict__')
+        assert obj.first_name is None
+        assert TempTable._metadata.column_names == ['age', 'first_name', 'last_name',
+                'record_no', 'ssn']
+        assert TempTable.dummy_val == 2
+
+    def test_inherited_columns(self):
+        class Extended(TempTable):
+            zip_code = IntegerType()
+        obj = Extended(record_no=1, zip_code=5)
+        assert [x for x, _ in Extended._get_columns()] == ['age', 'first_name',
+                'last_name', 'record_no', 'ssn', 'zip_code']
+        assert (obj.record_no, obj.zip_code) == (1, 5)
+
+
+class TestScan(BlockStructureBasedTest):
+    def add_records(self, row_format):
+        store = RecordStore(self.io, TempTable, row_format=row_format)
+        objs = [TempTable(record_no=x, first_name="f" * (x % 30), last_name=None,
+                ssn=x * 3 if x % 2 else None, age=x % 7) for x in range(100)]
+        for obj in objs:
+            store.add_record(obj)
+        return store, objs
+
+    def check_scan(self, row_format):
+        store, objs = self.add_records(row_format)
+        assert list(store.scan()) == objs
+        # Rows straddling the chunks get read whole.
+        assert list(store.scan(chunk_size=50)) == objs
+
+    def test_scan_variable(self):
+        self.check_scan(RecordStore.ROW_FORMAT_VARIABLE)
+
+    def test_scan_fixed(self):
+        self.check_scan(RecordStore.ROW_FORMAT_FIXED)
+
+    def test_scan_compact(self):
+        self.check_scan(RecordStore.ROW_FORMAT_COMPACT)
+
+    def test_projection_and_where(self):
+        store, objs = self.add_records(RecordStore.ROW_FORMAT_COMPACT)
+        got = list(store.scan(columns=["record_no", "ssn"], where={"age": 3}))
+        assert got == [TempTable(record_no=x.record_no, ssn=x.ssn) for x in objs
+                if x.age == 3]
+
+        got = list(store.scan(columns=["first_name"],
+                where={"ssn": lambda x: x is not None and x > 250}))
+        assert got == [TempTable(first_name=x.first_name) for x in objs
+                if x.ssn is not None and x.ssn > 250]
+
+        with pytest.raises(PyDBValueError):
+            store.scan(columns=["blah"])
+
+    def test_batches(self):
+        store, objs = self.add_records(RecordStore.ROW_FORMAT_VARIABLE)
+        batches = list(store.scan(batch_size=30, chunk_size=100))
+        assert [len(x) for x in batches] == [30, 30, 30, 10]
+        assert sum(batches, []) == objs
+
+    def test_in_memory(self):
+        fh = io.BytesIO()
+        bs = BlockStructure(fh, block_size=64, initialize=True)
+        self.io = BlockStructureOrderedDataIO(fh, bs, blocksize=64)
+        self.check_scan(RecordStore.ROW_FORMAT_VARIABLE)
+
+
+class TestHeapStorage(BlockStructureBasedTest):
+    def test_row_ids(self):
+        store = RecordStore(self.io, TempTable, row_format=RecordStore.ROW_FORMAT_COMPACT,
+                storage=RecordStore.STORAGE_HEAP)
+        objs = [TempTable(record_no=x, first_name="f" * x, age=x) for x in range(30)]
+        rowids = store.add_records(objs[:20]) + [store.add_record(x) for x in objs[20:]]
+        assert [store.get(x) for x in rowids] == objs
+
+        store.update(rowids[3], TempTable(record_no=3, first_name="changed", age=4))
+        store.delete(rowids[4])
+        assert store.get(rowids[3]).first_name == "changed"
+        assert len(list(store.scan())) == 29
+        with pytest.raises(PyDBValueError):
+            store.get(rowids[4])
+        with pytest.raises(PyDBValueError):
+            store.get_record(0)
+
+
+class TestPrimaryKeyIndex(FileBasedTest):
+    def setup(self):
+        super().setup()
+        self.mbs = MultiBlockStructure(self.f, initialize=True, block_size=64)
+        self.index = RecordStore.create_pk_index(self.f, self.mbs, TempTable, page_size=256)
+        self.data = self.mbs.add_structure(self.f, 256)
+
+    def objs(self, count):
+        return [TempTable(record_no=x * 7 % count, first_name="f", age=x) for x in range(count)]
+
+    def test_stream(self):
+        store = RecordStore(BlockStructureOrderedDataIO(self.f, self.data), TempTable,
+                pk_index=self.index)
+        objs = self.objs(200)
+        store.add_records(objs[:150], batch_size=40)
+        store.add_record(objs[150])
+        store.add_records(objs[151:])
+        for obj in objs:
+            assert store.get_by_pk(obj.record_no) == obj
+
+        with pytest.raises(PyDBUniqueKeyViolation):
+            store.add_records([TempTable(record_no=500, age=1), TempTable(record_no=3, age=1)])
+        with pytest.raises(PyDBUniqueKeyViolation):
+            store.add_records([TempTable(record_no=501, age=1), TempTable(record_no=501, age=2)])
+        with pytest.raises(PyDBKeyNotFoundError):
+            store.get_by_pk(500)
+
+    def test_heap(self):
+        store = RecordStore(BlockStructureOrderedDataIO(self.f, self.data), TempTable,
+                storage=RecordStore.STORAGE_HEAP, pk_index=self.index)
+        objs = self.objs(50)
+        rowids = store.add_records(objs)
+        assert store.get_by_pk(objs[10].record_no) == objs[10]
+
+        store.update(rowids[10], TempTable(record_no=1000, age=3))
+        store.delete(rowids[11])
+        assert store.get_by_pk(1000).age == 3
+        for key in (objs[10].record_no, objs[11].record_no):
+            with pytest.raises(PyDBKeyNotFoundError):
+                store.get_by_pk(key)
@@ -1,3 +1,4 @@
+import io
 import os
 import struct
 
@@ -81,3 +82,71 @@ class TestTableMetadata(BlockStructureBasedTest):
             m.decode_metadata(self.io)
         expected = "Internal Error. Possibly corrupt database. Invalid metatadata."
         assert ex.value.message == expected
+
+    def test_format_version(self):
+        m1 = TableMetadata(TempTable, format_version=TableMetadata.FORMAT_COMPACT)
+        m1.encode_metadata(self.io)
+        self.io.seek(0)
+        m2 = TableMetadata(TempTable)
+        m2.decode_metadata(self.io)
+        assert m2.format_version == TableMetadata.FORMAT_COMPACT
+
+    def test_legacy_format_version(self):
+        # Metadata written before format versions has the old magic and ends
+        # at the row count. A row may follow it.
+        m1 = TableMetadata(TempTable, format_version=TableMetadata.FORMAT_COMPACT)
+        buf = io.BytesIO()
+        m1.encode_metadata(buf)
+        data = buf.getvalue()
+        legacy = struct.pack(">i", TableMetadata.LEGACY_MAGIC_VALUE) + data[8:-4]
+        legacy = io.BytesIO(legacy + b"\x00\x00\x00\x07row")
+
+        m2 = TableMetadata(TempTable, format_version=TableMetadata.FORMAT_FIXED)
+        m2.decode_metadata(legacy)
+        assert m2.format_version == TableMetadata.FORMAT_VARIABLE
+        assert m2.row_count == 0
+        assert legacy.read() == b"\x00\x00\x00\x07row"
+
+    def test_legacy_round_trip(self):
+        m1 = TableMetadata(TempTable)
+        buf = io.BytesIO()
+        m1.encode_metadata(buf)
+        legacy = struct.pack(">i", TableMetadata.LEGACY_MAGIC_VALUE) + buf.getvalue()[8:-4]
+        buf = io.BytesIO(legacy + b"row")
+
+        m2 = TableMetadata(TempTable)
+        m2.decode_metadata(buf)
+        m2.row_count = 5
+        m2.encode_metadata(buf)
+        assert buf.tell() == len(legacy)
+        assert buf.getvalue()[len(legacy):] == b"row"
+
+        buf.seek(0)
+        m3 = TableMetadata(TempTable)
+        m3.decode_metadata(buf)
+        assert m3.row_count == 5
+        assert m3.legacy
+
+        m3.format_version = TableMetadata.FORMAT_COMPACT
+        with pytest.raises(PyDBValueError):
+            m3.encode_metadata(buf)
+
+    def test_reads_own_bytes(self):
+        m1 = TableMetadata(TempTable, format_version=TableMetadata.FORMAT_FIXED)
+        buf = io.BytesIO()
+        m1.encode_metadata(buf)
+        size = buf.tell()
+        buf.write(b"\x00\x00\x00\x02row")
+        buf.seek(0)
+
+        m2 = TableMetadata(TempTable)
+        m2.decode_metadata(buf)
+        assert m2.format_version == TableMetadata.FORMAT_FIXED
+        assert buf.tell() == size
+
+    def test_truncated(self):
+        m1 = TableMetadata(TempTable)
+        buf = io.BytesIO()
+        m1.encode_metadata(buf)
+        with pytest.raises(PyDBInternalError):
+            TableMetadata(TempTable).decode_metadata(io.BytesIO(buf.getvalue()[:-2]))
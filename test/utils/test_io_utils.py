@@ -1,7 +1,7 @@
 from PyDB.utils import int_to_bytes, bytes_to_int, bytes_to_ints
 from PyDB.utils import byte_chunker, bytes_to_gen, gen_to_bytes
 from PyDB.utils import bytes_to_string, string_to_bytes
-from PyDB.utils import SafeReader
+from PyDB.utils import SafeReader, BufferReader
 from PyDB.exceptions import PyDBInternalError
 from ..base import BlockStructureBasedTest
 
@@ -70,3 +70,11 @@ class TestSafeReader(BlockStructureBasedTest):
         with pytest.raises(PyDBInternalError):
             reader.next_string(10)
 
+
+    def test_buffer_reader(self):
+        buf = BufferReader(b'\x00\x00\x00\x0Atesttest..\x00\x00\x00\x07')
+        reader = SafeReader(buf)
+
+        assert reader.next_string(10) == 'testtest..'
+        assert reader.next_int() == 7
+        assert buf.offset == 18